@@ -0,0 +1,197 @@
+"""Admission control for Blogly.
+
+When Postgres slows down, requests hold a worker's threads for longer and new
+ones queue behind them until everything times out. Admission control turns
+requests away with a quick 503 and a Retry-After header instead, while the
+worker still has threads free to do so, keeping the requests it does take fast.
+
+Each worker counts the requests it is handling. Reads are high priority and
+are admitted while fewer than ADMISSION_MAX_IN_FLIGHT requests are in flight.
+Writes, and the expensive reads in ADMISSION_LOW_PRIORITY, stop being admitted
+sooner, at ADMISSION_MAX_IN_FLIGHT_LOW. Keep both below the worker's threads,
+see gunicorn.conf.py, so there are threads left to send the 503s.
+
+The time each request's first database connection takes to come out of the
+pool is timed around the pool's connect, so it is time spent waiting for the
+pool once the pool is exhausted and nothing the request did before. Checkouts
+that open a new connection are left out, that time is spent connecting.
+
+Requests only wait for the pool when it has fewer connections than the worker
+has threads, so app.py sizes it with DB_POOL_SIZE and DB_MAX_OVERFLOW, four
+connections and no overflow by default against gunicorn's eight threads. Once
+Postgres slows down, queries hold their connections longer and the other
+threads queue for them. The moving average of the waits, halving every ADMISSION_HALF_LIFE seconds once requests stop
+reporting, is compared with ADMISSION_POOL_WAIT_TARGET for high priority
+requests and ADMISSION_POOL_WAIT_TARGET_LOW for low priority ones. Requests
+that waited in a proxy's queue for longer than ADMISSION_MAX_QUEUE_TIME, going
+by the X-Request-Start header Heroku's router and nginx can add, are turned
+away as well, their client has most likely given up.
+
+Monitoring is never turned away. The long-lived /events/posts streams are not
+counted here, they are capped by EVENTS_MAX_STREAMS instead, see events.py.
+Every decision is counted in blogly_admission_decisions_total.
+"""
+
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from models import db
+
+DECISIONS = Counter('blogly_admission_decisions_total',
+                    'Requests admitted or turned away by admission control', ['priority', 'decision'])
+POOL_WAIT = Histogram('blogly_db_pool_wait_seconds',
+                      'Time a request waited for its first database connection')
+
+# Weight of each new pool wait in the moving average
+SMOOTHING = 0.2
+
+
+def queue_time(header, now):
+    """Returns how many seconds ago a proxy received the request according to X-Request-Start, or None"""
+
+    if not header:
+        return None
+    try:
+        start = float(header[2:] if header.startswith('t=') else header)
+    except ValueError:
+        return None
+    # nginx sends seconds, Heroku milliseconds, and some proxies microseconds
+    while start > 1e11:
+        start /= 1000
+    return max(now - start, 0.0)
+
+
+class Admission:
+    """Counts the requests a worker is handling and decides whether to take on more"""
+
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = 0
+        self.wait = 0.0
+        self.measured = time.monotonic()
+        self.lock = threading.Lock()
+
+    def decayed_wait(self, now):
+        """Returns the moving average of pool waits, halved for every ADMISSION_HALF_LIFE since the last one"""
+
+        return self.wait * 0.5 ** ((now - self.measured) / self.app.config['ADMISSION_HALF_LIFE'])
+
+    def pool_wait(self):
+        """Returns the current estimate of how long requests wait for a connection"""
+
+        with self.lock:
+            return self.decayed_wait(time.monotonic())
+
+    def record_wait(self, seconds):
+        """Adds a request's pool wait to the moving average"""
+
+        POOL_WAIT.observe(seconds)
+        with self.lock:
+            now = time.monotonic()
+            self.wait = (1 - SMOOTHING) * self.decayed_wait(now) + SMOOTHING * seconds
+            self.measured = now
+
+    def watch(self, pool):
+        """Times the first connection each request takes out of pool, once per pool"""
+
+        if getattr(pool, 'admission_watched', False):
+            return
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            connection = connect()
+            if not has_request_context() or g.pop('admission_opened', False):
+                return connection
+            # Only the first connection of a request, later ones say nothing about the queue
+            if 'admission_start' in g and not g.get('admission_waited'):
+                g.admission_waited = True
+                self.record_wait(time.perf_counter() - start)
+            return connection
+
+        pool.connect = timed_connect
+        pool.admission_watched = True
+
+    def admit(self, priority, queued):
+        """Takes on a request, or returns why it should be turned away"""
+
+        config = self.app.config
+        low = priority == 'low'
+        if queued is not None and queued > config['ADMISSION_MAX_QUEUE_TIME']:
+            return 'queue_time'
+        with self.lock:
+            if self.in_flight >= config['ADMISSION_MAX_IN_FLIGHT_LOW' if low else 'ADMISSION_MAX_IN_FLIGHT']:
+                return 'in_flight'
+            if self.decayed_wait(time.monotonic()) > config[
+                    'ADMISSION_POOL_WAIT_TARGET_LOW' if low else 'ADMISSION_POOL_WAIT_TARGET']:
+                return 'pool_wait'
+            self.in_flight += 1
+        return None
+
+    def release(self):
+        """Marks an admitted request as finished"""
+
+        with self.lock:
+            self.in_flight -= 1
+
+
+def request_priority(app):
+    """Returns whether the current request is a high priority read or a low priority write or expensive read"""
+
+    if request.method in ('GET', 'HEAD') and request.endpoint not in app.config['ADMISSION_LOW_PRIORITY']:
+        return 'high'
+    return 'low'
+
+
+def busy_response(app):
+    """A quick 503 telling the client when to try again"""
+
+    response = Response('Blogly is busy, please try again shortly.\n', 503, mimetype='text/plain')
+    response.headers['Retry-After'] = str(app.config['ADMISSION_RETRY_AFTER'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def init_admission(app):
+    """Registers admission control on the app, call before anything else registers request hooks"""
+
+    app.config.setdefault('ADMISSION_ENABLED', True)
+    app.config.setdefault('ADMISSION_MAX_IN_FLIGHT', 6)
+    app.config.setdefault('ADMISSION_MAX_IN_FLIGHT_LOW', 3)
+    app.config.setdefault('ADMISSION_POOL_WAIT_TARGET', 0.5)
+    app.config.setdefault('ADMISSION_POOL_WAIT_TARGET_LOW', 0.1)
+    app.config.setdefault('ADMISSION_HALF_LIFE', 2.0)
+    app.config.setdefault('ADMISSION_MAX_QUEUE_TIME', 10.0)
+    app.config.setdefault('ADMISSION_RETRY_AFTER', 2)
+    app.config.setdefault('ADMISSION_LOW_PRIORITY', {'search_users', 'show_tag_analytics', 'show_most_viewed'})
+    app.config.setdefault('ADMISSION_EXEMPT', {'show_metrics', 'show_memory', 'post_events'})
+    admission = app.extensions['admission'] = Admission(app)
+
+    @app.before_request
+    def admit_request():
+        if not app.config['ADMISSION_ENABLED'] or request.endpoint in app.config['ADMISSION_EXEMPT']:
+            return None
+        priority = request_priority(app)
+        reason = admission.admit(priority, queue_time(request.headers.get('X-Request-Start'), time.time()))
+        if reason is not None:
+            DECISIONS.labels(priority, f'shed_{reason}').inc()
+            return busy_response(app)
+        DECISIONS.labels(priority, 'admitted').inc()
+        g.admission_start = time.perf_counter()
+        # The engine replaces its pool when disposed, so this is checked on every request
+        admission.watch(db.engine.pool)
+        return None
+
+    @app.teardown_request
+    def release_request(exc):
+        if g.pop('admission_start', None) is not None:
+            admission.release()
+
+    @event.listens_for(Pool, 'connect')
+    def note_new_connection(dbapi_connection, connection_record):
+        if has_request_context():
+            g.admission_opened = True
@@ -0,0 +1,136 @@
+"""Tag analytics for Blogly.
+
+build_tag_analytics reads post_tag joined to post a chunk of posts at a time,
+so memory stays bounded by the chunk size and the number of tags. Each chunk
+becomes a sparse posts x tags incidence matrix A, and A.T @ A is added to the
+running count of posts sharing each pair of tags. Posts per tag and month are
+counted with numpy in the same pass.
+
+The results replace the contents of tag_pair, whose diagonal (a tag paired with
+itself) holds each tag's number of posts, tag_month and tag_size_bucket. The
+dashboard at /tags/analytics only reads those tables.
+"""
+
+from datetime import date
+
+import click
+import numpy as np
+from scipy import sparse
+
+from jobs import handler
+from models import db, Post, PostTag, Tag, TagPair, TagMonth, TagSizeBucket
+
+
+def month_number(year, month):
+    """Counts months from year 0 so months can index a matrix"""
+
+    return year * 12 + month - 1
+
+
+def chunks(chunk_size):
+    """Yields post_tag rows as arrays of post id, tag id, year and month, for chunk_size posts at a time"""
+
+    last = 0
+    while True:
+        post_ids = [post_id for (post_id,) in db.session.query(Post.id)
+                    .filter(Post.id > last).order_by(Post.id).limit(chunk_size)]
+        if not post_ids:
+            return
+        rows = (db.session.query(PostTag.post_id, PostTag.tag_id,
+                                 db.extract('year', Post.created_at), db.extract('month', Post.created_at))
+                .join(Post, Post.id == PostTag.post_id)
+                .filter(PostTag.post_id.between(post_ids[0], post_ids[-1]))
+                .all())
+        last = post_ids[-1]
+        if rows:
+            yield np.array(rows, dtype=np.int64).reshape(-1, 4).T
+
+
+def build_tag_analytics(chunk_size=10000):
+    """Recomputes the tag analytics summary tables"""
+
+    tag_ids = np.array([tag_id for (tag_id,) in db.session.query(Tag.id).order_by(Tag.id)], dtype=np.int64)
+    pairs = sparse.csr_matrix((len(tag_ids), len(tag_ids)), dtype=np.int64)
+    months = {}
+
+    for post_ids, post_tag_ids, years, month_of_year in chunks(chunk_size):
+        # Tags made since tag_ids was read would land on another tag's index
+        known = np.isin(post_tag_ids, tag_ids)
+        post_ids, post_tag_ids, years, month_of_year = (
+            post_ids[known], post_tag_ids[known], years[known], month_of_year[known])
+        tags = np.searchsorted(tag_ids, post_tag_ids)
+        posts, rows = np.unique(post_ids, return_inverse=True)
+        incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, tags)),
+                                      shape=(len(posts), len(tag_ids)))
+        pairs = pairs + incidence.T @ incidence
+
+        keys, counts = np.unique(np.stack([tags, month_number(years, month_of_year)]), axis=1, return_counts=True)
+        for (tag, month), count in zip(keys.T, counts):
+            months[tag, month] = months.get((tag, month), 0) + int(count)
+
+    TagPair.query.delete(synchronize_session=False)
+    TagMonth.query.delete(synchronize_session=False)
+    TagSizeBucket.query.delete(synchronize_session=False)
+
+    # Each pair once, with the smaller id first, plus the diagonal
+    pairs = sparse.triu(pairs).tocoo()
+    if pairs.nnz:
+        db.session.execute(TagPair.__table__.insert(), [
+            {'tag_id': int(tag_ids[tag]), 'other_id': int(tag_ids[other]), 'posts': int(count)}
+            for tag, other, count in zip(pairs.row, pairs.col, pairs.data)])
+    if months:
+        db.session.execute(TagMonth.__table__.insert(), [
+            {'tag_id': int(tag_ids[tag]), 'month': date(int(month) // 12, int(month) % 12 + 1, 1), 'posts': count}
+            for (tag, month), count in months.items()])
+
+    # Buckets of 0, 1, 2-3, 4-7, ... posts
+    sizes = np.zeros(len(tag_ids), dtype=np.int64)
+    diagonal = pairs.row == pairs.col
+    sizes[pairs.row[diagonal]] = pairs.data[diagonal]
+    buckets = np.where(sizes > 0, np.floor(np.log2(np.maximum(sizes, 1))).astype(np.int64) + 1, 0)
+    bucket_ids, bucket_counts = np.unique(buckets, return_counts=True)
+    if len(bucket_ids):
+        db.session.execute(TagSizeBucket.__table__.insert(), [
+            {'min_posts': 0 if bucket == 0 else 2 ** (int(bucket) - 1),
+             'max_posts': 0 if bucket == 0 else 2 ** int(bucket) - 1,
+             'tags': int(count)}
+            for bucket, count in zip(bucket_ids, bucket_counts)])
+
+    db.session.commit()
+
+
+def tag_analytics(top=20):
+    """Reads the summaries for the dashboard: top tag pairs, monthly usage of the top tags and the size distribution"""
+
+    totals = (TagPair.query.options(db.joinedload(TagPair.tag))
+              .filter(TagPair.tag_id == TagPair.other_id)
+              .order_by(TagPair.posts.desc(), TagPair.tag_id).limit(top).all())
+    pairs = (TagPair.query.options(db.joinedload(TagPair.tag), db.joinedload(TagPair.other))
+             .filter(TagPair.tag_id != TagPair.other_id)
+             .order_by(TagPair.posts.desc(), TagPair.tag_id, TagPair.other_id).limit(top).all())
+    top_ids = [total.tag_id for total in totals]
+    usage = {}
+    for month in (TagMonth.query.filter(TagMonth.tag_id.in_(top_ids))
+                  .order_by(TagMonth.month, TagMonth.tag_id) if top_ids else []):
+        usage.setdefault(month.month, {})[month.tag_id] = month.posts
+    buckets = TagSizeBucket.query.order_by(TagSizeBucket.min_posts).all()
+    return {'totals': totals, 'pairs': pairs, 'usage': usage, 'buckets': buckets}
+
+
+@handler('build_tag_analytics')
+def build_tag_analytics_job(job):
+    """Recomputes the tag analytics summary tables"""
+
+    build_tag_analytics()
+
+
+def init_analytics(app):
+    """Registers the command that rebuilds the tag analytics"""
+
+    @app.cli.command('build-tag-analytics')
+    @click.option('--chunk-size', default=10000, help='How many posts to process at a time')
+    def build_tag_analytics_command(chunk_size):
+        """Recomputes the tag analytics summary tables"""
+
+        build_tag_analytics(chunk_size)
+        click.echo(f'Built tag analytics, {TagPair.query.count()} tag pairs')
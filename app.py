@@ -1,24 +1,113 @@
 """Blogly application."""
 
 from flask_debugtoolbar import DebugToolbarExtension
-from flask import Flask, redirect, render_template, request, send_file
-from models import db, connect_db, User, Post, Tag, PostTag, DEFAULT_IMAGE
+from flask import Flask, abort, jsonify, redirect, render_template, request, send_file
+from models import db, connect_db, User, Post, Tag, PostTag, RelatedPost, Job, DEFAULT_IMAGE
+from admission import init_admission
+from profiler import init_profiler
+from metrics import init_metrics
+from memory import init_memory
+from slow_queries import init_slow_queries
+from template_cache import init_template_cache
+from compression import init_compression
+from fragments import init_fragment_cache
+from related import init_related, related_posts
+from analytics import init_analytics, tag_analytics
+from views import init_views, most_viewed, record_view
+from object_cache import init_object_cache
+import object_cache
+from events import init_events
+import events
+from feeds import init_feeds, refresh_feeds
+from freeze import init_freeze
+from surrogate import init_surrogate, add_keys, purge
+from avatars import InvalidAvatar, init_avatars, save_avatar
+from migrations import init_migrations
+import jobs
 import os
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///blogly')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = True
+# Fewer connections than GUNICORN_THREADS, so a slow Postgres leaves requests waiting
+# for the pool, which is what admission control watches, see admission.py
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 4)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 0)),
+    }
 
 connect_db(app)
 
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'JohnathonAppleseed452')
+# Run background jobs inline instead of handing them to worker.py
+app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '') == '1'
+# Load shedding, registered first so turned away requests skip every other hook, see admission.py
+app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+# Keep these below GUNICORN_THREADS so a busy worker still has threads to answer 503s
+app.config['ADMISSION_MAX_IN_FLIGHT'] = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 6))
+app.config['ADMISSION_MAX_IN_FLIGHT_LOW'] = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT_LOW', 3))
+init_admission(app)
+# Sampling profiler, see profiler.py
+app.config['PROFILER_ENABLED'] = os.environ.get('PROFILER_ENABLED', '') == '1'
+app.config['PROFILER_SAMPLE_RATE'] = float(os.environ.get('PROFILER_SAMPLE_RATE', 0))
+app.config['PROFILER_DIR'] = os.environ.get('PROFILER_DIR', 'profiles')
+# Seconds the profiler and /debug/memory headers keep working, see signed_headers.py
+app.config['DEBUG_TOKEN_MAX_AGE'] = int(os.environ.get('DEBUG_TOKEN_MAX_AGE', 3600))
+init_profiler(app)
+init_metrics(app)
+# Opt-in allocation tracking, snapshots are written to MEMORY_DIR, see memory.py
+app.config['MEMORY_TRACKING'] = os.environ.get('MEMORY_TRACKING', '') == '1'
+app.config['MEMORY_DIR'] = os.environ.get('MEMORY_DIR', 'memory_snapshots')
+init_memory(app)
+# Statements slower than this many seconds go to the slow-query log, see slow_queries.py
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.environ['SLOW_QUERY_THRESHOLD']) \
+    if 'SLOW_QUERY_THRESHOLD' in os.environ else None
+init_slow_queries(app)
+# Compiled templates are cached here across worker restarts, see template_cache.py
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR', '.jinja_cache')
+init_template_cache(app)
+init_fragment_cache(app)
+init_related(app)
+init_analytics(app)
+# Post views are counted in memory and written every this many seconds, see views.py
+app.config['VIEWS_FLUSH_INTERVAL'] = float(os.environ.get('VIEWS_FLUSH_INTERVAL', 5))
+init_views(app)
+# Users and tags are cached for this many seconds, see object_cache.py
+app.config['OBJECT_CACHE_TTL'] = float(os.environ.get('OBJECT_CACHE_TTL', 60))
+init_object_cache(app)
+# Each open event stream holds a thread, keep this small next to GUNICORN_THREADS, see events.py
+app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', 2))
+init_events(app)
+# Feeds and sitemaps link here and are cached in FEED_CACHE_DIR, see feeds.py
+app.config['SITE_URL'] = os.environ.get('SITE_URL', 'http://localhost:5000')
+app.config['FEED_CACHE_DIR'] = os.environ.get('FEED_CACHE_DIR', '.feed_cache')
+init_feeds(app)
+init_freeze(app)
+# Where to send surrogate key purges for the caching proxy, see surrogate.py
+app.config['SURROGATE_PURGE_URL'] = os.environ.get('SURROGATE_PURGE_URL')
+init_surrogate(app)
+# Uploaded avatars are stored here, see avatars.py
+app.config['AVATAR_DIR'] = os.environ.get('AVATAR_DIR', '.avatars')
+init_avatars(app)
+init_compression(app)
+init_migrations(app)
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 # debug = DebugToolbarExtension(app)
 
 db.create_all()
 
 
+def get_checked_tags():
+    """Returns the tags whose ids were submitted with the form, ignoring ids that are not tags"""
+
+    tag_ids = {int(tag_id) for tag_id in request.form.getlist('tags') if tag_id.isdigit()}
+    if not tag_ids:
+        return []
+    return Tag.query.filter(Tag.id.in_(tag_ids)).all()
+
+
 @app.route('/')
 def redirect_to_users():
     """Main page is /users redirect to there"""
@@ -42,15 +131,30 @@ def show_users():
     """Show all users"""
 
     users = User.query.all()
+    add_keys('users')
     return render_template('users/users.html', users=users)
 
 
+@app.route('/users/search')
+def search_users():
+    """Show a page of users whose name resembles the search, best matches first"""
+
+    text = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    results = User.search(text, page=page) if text else None
+    # Any new user could match, so results are purged along with the user list
+    add_keys('users')
+    return render_template('users/search.html', text=text, results=results)
+
+
 @app.route('/users/<int:userid>')
 def show_user(userid):
     """Show a specific user"""
 
-    user = User.query.get_or_404(userid)
-    return render_template('users/user.html', user=user, posts=user.posts)
+    user = object_cache.get_or_404(User, userid)
+    # The user may come from the object cache, so their posts are a query of their own
+    posts = Post.query.with_parent(user, 'posts').all()
+    return render_template('users/user.html', user=user, posts=posts)
 
 
 @app.route('/users/new', methods=['GET'])
@@ -78,6 +182,11 @@ def create_user():
     if missing_first_name or missing_last_name:
         return render_template('users/new_user.html', missing_first_name=missing_first_name, missing_last_name=missing_last_name)
 
+    try:
+        image_url = save_avatar(request.files.get('avatar'), app) or image_url
+    except InvalidAvatar as error:
+        return render_template('users/new_user.html', invalid_avatar=error), 400
+
     if not image_url:
         new_user = User(first_name=first_name, last_name=last_name)
     else:
@@ -85,6 +194,8 @@ def create_user():
                         last_name=last_name, image_url=image_url)
     db.session.add(new_user)
     db.session.commit()
+    refresh_feeds(users=[new_user.id])
+    purge('users')
 
     return redirect(f'/users')
 
@@ -93,7 +204,7 @@ def create_user():
 def show_edit_user_form(userid):
     """Shows the form for editing the specified user"""
 
-    user = User.query.get_or_404(userid)
+    user = object_cache.get_or_404(User, userid)
     return render_template('users/edit_user.html', user=user)
 
 
@@ -106,8 +217,21 @@ def edit_user(userid):
     last_name = request.form.get('last_name', None)
     image_url = request.form.get('image_url', None)
 
+    try:
+        image_url = save_avatar(request.files.get('avatar'), app) or image_url
+    except InvalidAvatar as error:
+        return render_template('users/edit_user.html', user=user, invalid_avatar=error), 400
+
     user.update_user(first_name, last_name, image_url)
     db.session.commit()
+    object_cache.invalidate(User, userid)
+    # Tag feeds name the authors of their posts
+    tag_ids = [tag_id for (tag_id,) in db.session.query(PostTag.tag_id).distinct()
+               .join(Post, Post.id == PostTag.post_id).filter(Post.user_id == userid)]
+    refresh_feeds(user_feeds=[userid], tag_feeds=tag_ids)
+    # Other workers may render the old row until their object cache expires
+    purge(f'user-{userid}', *(f'tag-{tag_id}' for tag_id in tag_ids),
+          again_after=app.config['OBJECT_CACHE_TTL'])
 
     return redirect('/users')
 
@@ -117,8 +241,9 @@ def delete_user(userid):
     """Delete user in database"""
 
     user = User.query.get_or_404(userid)
-    db.session.delete(user)
-    db.session.commit()
+    # Users with many posts take a while to delete, so hand it to the job worker
+    jobs.enqueue('delete_user', userid=user.id)
+    object_cache.invalidate(User, userid)
 
     return redirect('/users')
 
@@ -131,9 +256,8 @@ def delete_user(userid):
 def show_new_post_form(userid):
     """Shows the form for creating a new post for the specified user"""
 
-    user = User.query.get_or_404(userid)
-    tags = Tag.query.all()
-    return render_template('posts/new_post.html', user=user, tags=tags)
+    user = object_cache.get_or_404(User, userid)
+    return render_template('posts/new_post.html', user=user, tags=[])
 
 
 @app.route('/users/<int:userid>/posts/new', methods=['POST'])
@@ -143,7 +267,7 @@ def create_post(userid):
     user = User.query.get_or_404(userid)
     title = request.form.get('title', None)
     content = request.form.get('content', None)
-    tags = request.form.getlist('tags')
+    tags = get_checked_tags()
 
     # If information is somehow not provided, will show warnings to user
     missing_title = False
@@ -153,7 +277,6 @@ def create_post(userid):
     if not content:
         missing_content = True
     if missing_title or missing_content:
-        tags = Tag.query.all()
         return render_template('posts/new_post.html', user=user, missing_content=missing_content, missing_title=missing_title, tags=tags)
 
     new_post = Post(title=title, content=content, user_id=user.id)
@@ -162,48 +285,69 @@ def create_post(userid):
     db.session.commit()
 
     for tag in tags:
-        new_post_tag = PostTag(post_id=new_post.id, tag_id=int(tag))
+        new_post_tag = PostTag(post_id=new_post.id, tag_id=tag.id)
         db.session.add(new_post_tag)
 
     db.session.commit()
 
+    events.publish('created', new_post.id, user.id, [tag.id for tag in tags])
+    refresh_feeds(user_feeds=[user.id], tag_feeds=[tag.id for tag in tags], posts=[new_post.id])
+    purge('posts', f'user-{user.id}', *(f'tag-{tag.id}' for tag in tags))
+    if tags:
+        jobs.enqueue('refresh_related', post_ids=[new_post.id], tag_ids=[tag.id for tag in tags])
+
     return redirect(f'/users/{userid}')
 
 
+@app.route('/posts/most-viewed')
+def show_most_viewed():
+    """Shows the most viewed posts"""
+
+    add_keys('posts')
+    return render_template('posts/most_viewed.html', posts=most_viewed())
+
+
 @app.route('/posts/<int:postid>')
 def show_post(postid):
     """Shows the specified post"""
 
-    post = Post.query.get_or_404(postid)
-    return render_template('posts/post.html', post=post, user=post.user, tags=post.tags)
+    post = Post.query.options(db.joinedload(Post.post_tags)).get_or_404(postid)
+    record_view(postid)
+    user = object_cache.get(User, post.user_id)
+    tags = object_cache.get_many(Tag, [post_tag.tag_id for post_tag in post.post_tags])
+    return render_template('posts/post.html', post=post, user=user, tags=tags, related=related_posts(postid))
 
 
 @app.route('/posts/<int:postid>/edit', methods=['GET'])
 def show_edit_post_form(postid):
     """Shows the form for editing a post for the specified post"""
 
-    post = Post.query.get_or_404(postid)
-    tags = Tag.query.all()
-    return render_template('posts/edit_post.html', post=post, user=post.user, tags=tags)
+    post = Post.query.options(db.joinedload(Post.post_tags)).get_or_404(postid)
+    user = object_cache.get(User, post.user_id)
+    tags = object_cache.get_many(Tag, [post_tag.tag_id for post_tag in post.post_tags])
+    return render_template('posts/edit_post.html', post=post, user=user, tags=tags)
 
 
 @app.route('/posts/<int:postid>/edit', methods=['POST'])
 def edit_post(postid):
     """Edits the specified post"""
 
-    post = Post.query.get_or_404(postid)
+    post = Post.query.options(db.joinedload(Post.post_tags)).get_or_404(postid)
     post_tags = post.post_tags
-    tags = Tag.query.all()
     title = request.form.get('title', None)
     content = request.form.get('content', None)
-    checked_tags = request.form.getlist('tags')
+    checked_tags = get_checked_tags()
+    # Tags whose posts now share one more or one less tag with this post
+    changed_tags = {post_tag.tag_id for post_tag in post_tags} ^ {tag.id for tag in checked_tags}
+    # Tags whose pages showed the post before or show it now
+    event_tags = {post_tag.tag_id for post_tag in post_tags} | {tag.id for tag in checked_tags}
 
     # Removes current post tags
     for post_tag in post_tags:
         db.session.delete(post_tag)
     # Adds new post tags for all tags that were checked
     for checked_tag in checked_tags:
-        new_post_tag = PostTag(post_id=postid, tag_id=int(checked_tag))
+        new_post_tag = PostTag(post_id=postid, tag_id=checked_tag.id)
         db.session.add(new_post_tag)
     db.session.commit()
 
@@ -233,6 +377,12 @@ def edit_post(postid):
     post.update_post(title, content)
     db.session.commit()
 
+    events.publish('updated', postid, post.user_id, event_tags)
+    refresh_feeds(user_feeds=[post.user_id], tag_feeds=event_tags)
+    purge(f'post-{postid}', f'user-{post.user_id}', *(f'tag-{tag_id}' for tag_id in event_tags))
+    if changed_tags:
+        jobs.enqueue('refresh_related', post_ids=[postid], tag_ids=list(changed_tags))
+
     return redirect(f'/posts/{postid}')
 
 
@@ -240,12 +390,38 @@ def edit_post(postid):
 def delete_post(postid):
     """Deletes the specified post"""
 
-    post = Post.query.get_or_404(postid)
-    user = post.user
+    post = Post.query.options(db.joinedload(Post.post_tags)).get_or_404(postid)
+    user_id = post.user_id
+    tag_ids = [post_tag.tag_id for post_tag in post.post_tags]
     db.session.delete(post)
     db.session.commit()
 
-    return redirect(f'/users/{user.id}')
+    events.publish('deleted', postid, user_id, tag_ids)
+    refresh_feeds(user_feeds=[user_id], tag_feeds=tag_ids, posts=[postid])
+    purge(f'post-{postid}', 'posts', f'user-{user_id}', *(f'tag-{tag_id}' for tag_id in tag_ids))
+    if tag_ids:
+        jobs.enqueue('refresh_related', tag_ids=tag_ids)
+
+    return redirect(f'/users/{user_id}')
+
+###########
+# Archive #
+###########
+
+
+@app.route('/archive/<int:year>/<int:month>')
+def show_archive(year, month):
+    """Shows a page of the posts made in a month, oldest first"""
+
+    if not 1 <= month <= 12 or not 1 <= year < 9999:
+        abort(404)
+    page = request.args.get('page', 1, type=int)
+    posts = Post.archive(year, month, page=page)
+    add_keys('posts')
+    previous = (year - 1, 12) if month == 1 else (year, month - 1)
+    following = (year + 1, 1) if month == 12 else (year, month + 1)
+    return render_template('posts/archive.html', year=year, month=month, posts=posts,
+                           previous=previous, following=following)
 
 ########
 # Tags #
@@ -257,15 +433,36 @@ def show_tags():
     """Shows all the tags"""
 
     tags = Tag.query.all()
+    add_keys('tags')
     return render_template('tags/tags.html', tags=tags)
 
 
+@app.route('/tags/search')
+def search_tags():
+    """Returns the tags whose name starts with the q parameter as JSON, for autocompleting tags on the post forms"""
+
+    prefix = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    add_keys('tags')
+    if not prefix:
+        return jsonify([])
+    return jsonify([{'id': tag.id, 'name': tag.name} for tag in Tag.search(prefix, limit)])
+
+
+@app.route('/tags/analytics')
+def show_tag_analytics():
+    """Shows which tags go together, how tag usage changes over time and how many posts tags have"""
+
+    return render_template('tags/analytics.html', **tag_analytics())
+
+
 @app.route('/tags/<int:tagid>')
 def show_tag(tagid):
     """Shows the specified tag"""
 
-    tag = Tag.query.get_or_404(tagid)
-    posts = tag.posts
+    tag = object_cache.get_or_404(Tag, tagid)
+    # The tag may come from the object cache, so its posts are a query of their own
+    posts = Post.query.with_parent(tag, 'posts').all()
     return render_template('tags/tag.html', tag=tag, posts=posts)
 
 
@@ -290,6 +487,8 @@ def create_tag():
 
     db.session.add(new_tag)
     db.session.commit()
+    refresh_feeds(tags=[new_tag.id])
+    purge('tags')
     db.session.commit()
 
     return redirect('/tags')
@@ -299,7 +498,7 @@ def create_tag():
 def show_edit_tag_form(tagid):
     """Shows the form to edit a tag"""
 
-    tag = Tag.query.get_or_404(tagid)
+    tag = object_cache.get_or_404(Tag, tagid)
     return render_template('tags/edit_tag.html', tag=tag)
 
 
@@ -312,15 +511,103 @@ def edit_tag(tagid):
 
     tag.update_tag(name)
     db.session.commit()
+    object_cache.invalidate(Tag, tagid)
+    refresh_feeds(tag_feeds=[tagid])
+    # Other workers may render the old tag until their object cache expires
+    purge(f'tag-{tagid}', again_after=app.config['OBJECT_CACHE_TTL'])
 
     return redirect('/tags')
 
 
+def get_bulk_targets():
+    """Returns the post ids or the user id a bulk tagging request applies to, from JSON or form data"""
+
+    data = request.get_json(silent=True)
+    if data is None:
+        post_ids = request.form.getlist('posts')
+        user_id = request.form.get('user')
+    elif not isinstance(data, dict):
+        abort(400)
+    else:
+        post_ids = data.get('posts', [])
+        user_id = data.get('user')
+        # bool is an int, so JSON true and false would pass as 1 and 0
+        if isinstance(user_id, bool) or (isinstance(post_ids, list)
+                                         and any(isinstance(post_id, bool) for post_id in post_ids)):
+            abort(400)
+
+    try:
+        if user_id is not None:
+            return None, int(user_id)
+        if isinstance(post_ids, list) and post_ids:
+            return [int(post_id) for post_id in post_ids], None
+    except (TypeError, ValueError):
+        pass
+    abort(400)
+
+
+@app.route('/tags/<int:tagid>/attach', methods=['POST'])
+def attach_tag(tagid):
+    """Tags many posts at once, either a list of posts or every post by a user"""
+
+    tag = Tag.query.get_or_404(tagid)
+    post_ids, user_id = get_bulk_targets()
+    affected = tag.attach(post_ids=post_ids, user_id=user_id)
+    db.session.commit()
+
+    if affected:
+        jobs.enqueue('refresh_related', tag_ids=[tag.id])
+        refresh_feeds(tag_feeds=[tag.id])
+        purge(f'tag-{tag.id}', *(f'post-{post_id}' for post_id in post_ids or []),
+              *([f'user-{user_id}'] if user_id is not None else []))
+
+    return jsonify({'tag': tag.id, 'attached': affected})
+
+
+@app.route('/tags/<int:tagid>/detach', methods=['POST'])
+def detach_tag(tagid):
+    """Untags many posts at once, either a list of posts or every post by a user"""
+
+    tag = Tag.query.get_or_404(tagid)
+    post_ids, user_id = get_bulk_targets()
+    affected = tag.detach(post_ids=post_ids, user_id=user_id)
+    db.session.commit()
+
+    if affected:
+        jobs.enqueue('refresh_related', post_ids=post_ids or [post.id for post in Post.query.filter_by(user_id=user_id)],
+                     tag_ids=[tag.id])
+        refresh_feeds(tag_feeds=[tag.id])
+        purge(f'tag-{tag.id}', *(f'post-{post_id}' for post_id in post_ids or []),
+              *([f'user-{user_id}'] if user_id is not None else []))
+
+    return jsonify({'tag': tag.id, 'detached': affected})
+
+
 @app.route('/tags/<int:tagid>/delete', methods=['POST'])
 def delete_tag(tagid):
     """Deletes the specified tag"""
 
     tag = Tag.query.get_or_404(tagid)
+    post_ids = [post_id for (post_id,) in db.session.query(PostTag.post_id).filter_by(tag_id=tagid)]
+    PostTag.query.filter_by(tag_id=tagid).delete(synchronize_session=False)
     db.session.delete(tag)
     db.session.commit()
+    object_cache.invalidate(Tag, tagid)
+    refresh_feeds(tag_feeds=[tagid], tags=[tagid])
+    purge(f'tag-{tagid}', 'tags', again_after=app.config['OBJECT_CACHE_TTL'])
+
+    if post_ids:
+        jobs.enqueue('refresh_related', post_ids=post_ids)
     return redirect('/tags')
+
+########
+# Jobs #
+########
+
+
+@app.route('/jobs/<int:jobid>')
+def show_job(jobid):
+    """Shows the status and progress of a background job as JSON"""
+
+    job = Job.query.get_or_404(jobid)
+    return job.to_dict()
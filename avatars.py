@@ -0,0 +1,127 @@
+"""Avatar uploads for Blogly.
+
+Uploaded files are streamed to a temporary file on disk as the request body
+is parsed, never held in memory, and requests over MAX_CONTENT_LENGTH are
+refused before they are read. The upload is checked to be a JPEG, PNG, GIF or
+WebP of at most AVATAR_MAX_PIXELS, decoded at reduced size where the format
+allows, downscaled to fit AVATAR_SIZE and re-encoded without metadata, as PNG
+if it has transparency and JPEG otherwise.
+
+The result is stored in AVATAR_DIR named by the SHA-256 of its bytes, so
+identical uploads share one file, and served from /avatars/<name> with headers
+letting browsers and proxies cache it forever. `flask prune-avatars` removes
+files no user points to any more.
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+
+import click
+from flask import Request, send_from_directory
+from PIL import Image, ImageOps
+from models import User
+
+FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+# Cache-Control for content-addressed files, whose contents never change
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class InvalidAvatar(ValueError):
+    """The upload is not an image we accept"""
+
+
+class StreamingRequest(Request):
+    """Request that writes every uploaded file to a temporary file instead of memory"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.TemporaryFile('wb+')
+
+
+def downscale(stream, size, max_pixels):
+    """Validates an uploaded image and returns it downscaled to fit size, encoded, with its extension"""
+
+    try:
+        image = Image.open(stream)
+    except Exception:
+        raise InvalidAvatar('not an image')
+    if image.format not in FORMATS:
+        raise InvalidAvatar(f'{image.format} images are not accepted')
+    if image.width * image.height > max_pixels:
+        raise InvalidAvatar('image is too large')
+
+    try:
+        # Lets JPEG decode straight to a fraction of the size
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+    except Exception:
+        raise InvalidAvatar('image is damaged')
+
+    transparent = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    output = io.BytesIO()
+    if transparent:
+        image.convert('RGBA').save(output, 'PNG', optimize=True)
+        return output.getvalue(), 'png'
+    image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+    return output.getvalue(), 'jpg'
+
+
+def store(data, extension, directory):
+    """Stores image bytes under their hash unless an identical file is already there, returns the file name"""
+
+    name = f'{hashlib.sha256(data).hexdigest()}.{extension}'
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+    return name
+
+
+def save_avatar(upload, app):
+    """Processes an uploaded avatar, returns its URL or None if no file was sent
+
+    Raises InvalidAvatar if the file is not an acceptable image."""
+
+    if upload is None or not upload.filename:
+        return None
+    data, extension = downscale(upload.stream, app.config['AVATAR_SIZE'], app.config['AVATAR_MAX_PIXELS'])
+    return f'/avatars/{store(data, extension, app.config["AVATAR_DIR"])}'
+
+
+def init_avatars(app):
+    """Streams uploads to disk and registers the avatar endpoint and prune command on the app"""
+
+    app.config.setdefault('AVATAR_DIR', '.avatars')
+    app.config.setdefault('AVATAR_SIZE', 256)
+    app.config.setdefault('AVATAR_MAX_PIXELS', 40_000_000)
+    # Applies to every request, uploads are the only large bodies Blogly accepts
+    app.config.setdefault('MAX_CONTENT_LENGTH', 10 * 1024 * 1024)
+    app.request_class = StreamingRequest
+
+    @app.route('/avatars/<name>')
+    def show_avatar(name):
+        """Sends an uploaded avatar, cacheable forever as its name is its hash"""
+
+        response = send_from_directory(os.path.abspath(app.config['AVATAR_DIR']), name, conditional=True)
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+    @app.cli.command('prune-avatars')
+    def prune_avatars():
+        """Deletes the avatars no user points to"""
+
+        directory = app.config['AVATAR_DIR']
+        used = {url.rpartition('/')[2] for (url,) in User.query.with_entities(User.image_url)
+                .filter(User.image_url.like('/avatars/%'))}
+        removed = 0
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            if name not in used and not name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+                removed += 1
+        click.echo(f'Removed {removed} unused avatars')
@@ -0,0 +1,31 @@
+"""Background threads for Blogly.
+
+Threads do not survive a fork, so a thread started while the app is imported
+would be missing from every gunicorn worker. ProcessThread starts its thread
+the first time it is needed in each process instead, so forked workers each
+start their own.
+"""
+
+import os
+import threading
+
+
+class ProcessThread:
+    """A daemon thread running target, started at most once per process"""
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts the thread unless this process already has one"""
+
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self.target, name=self.name, daemon=True).start()
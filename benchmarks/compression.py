@@ -0,0 +1,74 @@
+"""Measures bandwidth and CPU cost of compressing Blogly pages at each gzip level and brotli quality.
+
+Seeds a throwaway sqlite database (or uses DATABASE_URL) with enough rows to
+make the list pages realistically large, renders them once, then compresses
+each body repeatedly with the functions the app uses.
+
+    python benchmarks/compression.py [--users 2000] [--repeat 20]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ['/users', '/users/1', '/posts/1', '/posts/1/edit', '/tags', '/tags/1']
+
+
+def render_pages(users):
+    """Seeds the database and returns the uncompressed body of each route"""
+
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/bench.db')
+    from app import app, db, User, Post, Tag, PostTag
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    if not User.query.get(1):
+        db.session.bulk_insert_mappings(
+            User, [{'first_name': f'First{i}', 'last_name': f'Last{i}'} for i in range(users)])
+        db.session.bulk_insert_mappings(
+            Tag, [{'name': f'Tag {i}'} for i in range(users // 10)])
+        db.session.bulk_insert_mappings(
+            Post, [{'title': f'Post {i}', 'content': 'Lorem ipsum dolor sit amet. ' * 20, 'user_id': 1}
+                   for i in range(users)])
+        db.session.bulk_insert_mappings(
+            PostTag, [{'post_id': i + 1, 'tag_id': 1} for i in range(users)])
+        db.session.commit()
+
+    client = app.test_client()
+    return {route: client.get(route).get_data() for route in ROUTES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    pages = render_pages(args.users)
+    import compression
+
+    settings = [('gzip', level) for level in range(1, 10)]
+    if compression.brotli is not None:
+        settings += [('br', quality) for quality in range(0, 12)]
+    else:
+        print('Brotli is not installed, only measuring gzip\n')
+
+    total = sum(len(body) for body in pages.values())
+    print(f'{len(pages)} pages, {total / 1024:.1f} KiB uncompressed\n')
+    print(f'{"encoding":10}{"level":>6}{"size KiB":>11}{"ratio":>8}{"ms/page":>10}{"MiB/s":>9}')
+    for encoding, level in settings:
+        size = sum(len(compression.compress_body(body, encoding, level)) for body in pages.values())
+        start = time.process_time()
+        for _ in range(args.repeat):
+            for body in pages.values():
+                compression.compress_body(body, encoding, level)
+        elapsed = (time.process_time() - start) / args.repeat
+        print(f'{encoding:10}{level:>6}{size / 1024:>11.1f}{total / size:>8.2f}'
+              f'{elapsed / len(pages) * 1000:>10.3f}{total / elapsed / 1024 / 1024:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Measures first-request latency of the read routes with and without the Jinja bytecode cache.
+
+Each sample starts a fresh interpreter, as a new gunicorn worker would, and
+times the first request to every route. Uses DATABASE_URL if set, otherwise a
+throwaway sqlite database.
+
+    python benchmarks/first_request.py [--runs 10]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ['/users', '/users/1', '/users/1/posts/new', '/posts/1',
+          '/posts/1/edit', '/tags', '/tags/1', '/users/new', '/tags/new']
+
+# Runs in the fresh interpreter, prints the first-request time of each route as JSON
+SAMPLE = '''
+import json, sys, time
+from app import app, db, User, Post, Tag, PostTag
+app.config['SQLALCHEMY_ECHO'] = False
+if not User.query.get(1):
+    db.session.add(User(first_name='John', last_name='Doe'))
+    db.session.add(Tag(name='Testing'))
+    db.session.commit()
+    db.session.add(Post(title='A Test', content='Testing posts', user_id=1))
+    db.session.commit()
+    db.session.add(PostTag(post_id=1, tag_id=1))
+    db.session.commit()
+client = app.test_client()
+times = {}
+for route in sys.argv[1:]:
+    start = time.perf_counter()
+    client.get(route)
+    times[route] = time.perf_counter() - start
+print(json.dumps(times))
+'''
+
+
+def sample(env):
+    """Times the first request to every route in a fresh interpreter"""
+
+    out = subprocess.run([sys.executable, '-c', SAMPLE] + ROUTES, cwd=ROOT, env=env,
+                         check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return json.loads(out.stdout.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', f'sqlite:///{workdir}/bench.db')
+    cache = os.path.join(workdir, 'jinja')
+    try:
+        results = {}
+        for label in ['no cache', 'cold cache', 'warm cache']:
+            runs = []
+            for _ in range(args.runs):
+                if label == 'no cache':
+                    env['TEMPLATE_CACHE_DIR'] = ''
+                else:
+                    env['TEMPLATE_CACHE_DIR'] = cache
+                    if label == 'cold cache':
+                        shutil.rmtree(cache, ignore_errors=True)
+                runs.append(sample(env))
+            results[label] = runs
+
+        print(f'{"route":24}' + ''.join(f'{label:>14}' for label in results))
+        for route in ROUTES + ['total']:
+            row = f'{route:24}'
+            for runs in results.values():
+                values = [sum(run.values()) if route == 'total' else run[route] for run in runs]
+                row += f'{statistics.median(values) * 1000:11.2f} ms'
+            print(row)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
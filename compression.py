@@ -0,0 +1,141 @@
+"""Response compression for Blogly.
+
+Gunicorn serves the app directly, so responses are compressed here. Brotli is
+used when the client accepts it and the Brotli package is installed, otherwise
+gzip. Bodies smaller than COMPRESS_MIN_SIZE and types that are already
+compressed, such as the PNG at DEFAULT_IMAGE, are sent as they are. Streamed
+responses are compressed chunk by chunk and flushed as they go.
+"""
+
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {'text/html', 'text/css', 'text/plain', 'text/xml', 'text/csv',
+                'application/json', 'application/javascript', 'application/xml',
+                'application/atom+xml', 'application/rss+xml', 'image/svg+xml'}
+
+
+def accepted_encodings(header):
+    """Parses an Accept-Encoding header into a dictionary of encoding to q-value"""
+
+    encodings = {}
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name.strip().lower()] = q
+    return encodings
+
+
+def choose_encoding(header):
+    """Returns the best encoding the client accepts, or None to send the body as it is"""
+
+    encodings = accepted_encodings(header)
+    wildcard = encodings.get('*', 0.0)
+    candidates = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = max(candidates, key=lambda name: encodings.get(name, wildcard))
+    if encodings.get(best, wildcard) <= 0:
+        return None
+    return best
+
+
+class Compressor:
+    """Incremental compressor with the same interface for gzip and brotli"""
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=level)
+        else:
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """Compresses a chunk and flushes it so it can be sent straight away"""
+
+        if self.encoding == 'br':
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """Returns the end of the compressed stream"""
+
+        if self.encoding == 'br':
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+def compress_body(data, encoding, level):
+    """Compresses a whole body in one go"""
+
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, compressor):
+    """Compresses an iterable of chunks, closing it once done"""
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def init_compression(app):
+    """Registers the compression hook on the app"""
+
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+
+    @app.after_request
+    def compress_response(response):
+        if (response.mimetype not in COMPRESSIBLE
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers
+                or request.method == 'HEAD'):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+        level = app.config['COMPRESS_BROTLI_QUALITY'] if encoding == 'br' else app.config['COMPRESS_GZIP_LEVEL']
+
+        if response.is_streamed or response.direct_passthrough:
+            chunks = response.response
+            response.direct_passthrough = False
+            response.response = compress_stream(chunks, Compressor(encoding, level))
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress_body(data, encoding, level))
+
+        response.headers['Content-Encoding'] = encoding
+        # A strong ETag names the uncompressed bytes
+        if response.headers.get('ETag', '').startswith('"'):
+            response.headers['ETag'] = 'W/' + response.headers['ETag']
+        return response
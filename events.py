@@ -0,0 +1,182 @@
+"""Server-sent events for Blogly.
+
+/events/posts streams a small JSON event whenever a post is created, edited or
+deleted, so pages can refresh when something changes instead of polling. The
+stream can be narrowed to one user's or one tag's posts with ?user= and ?tag=.
+
+publish sends events through Postgres NOTIFY. Each worker process holds one
+connection that LISTENs on the channel, started when the first subscriber
+connects, and hands every notification to the queues of the worker's open
+streams, however many there are. A subscriber whose queue fills up is dropped,
+and the browser's EventSource reconnects. Without Postgres, or with
+EVENTS_NOTIFY turned off, events only reach subscribers in the same process.
+
+Each open stream holds one of the worker's threads, see threads in
+gunicorn.conf.py, so a worker serves at most EVENTS_MAX_STREAMS at once and
+answers further ones with a 503 and Retry-After. Keep it well below the
+threads, admission control does not count streams. Pages only open a stream
+when the reader turns live updates on.
+"""
+
+import json
+import queue
+import select
+import threading
+import time
+
+from flask import Response, current_app, request
+from admission import DECISIONS, busy_response
+from background import ProcessThread
+from models import db
+
+CHANNEL = 'blogly_posts'
+
+
+class Broker:
+    """Fans the notifications received by this process out to its subscribers"""
+
+    def __init__(self, app):
+        self.app = app
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = ProcessThread(self.run, 'event-listener')
+
+    def subscribe(self):
+        """Returns a new queue that receives every event, or None if this worker has EVENTS_MAX_STREAMS already"""
+
+        subscriber = queue.Queue(self.app.config['EVENTS_QUEUE_SIZE'])
+        with self.lock:
+            if len(self.subscribers) >= self.app.config['EVENTS_MAX_STREAMS']:
+                return None
+            self.subscribers.add(subscriber)
+        if self.app.config['EVENTS_NOTIFY']:
+            self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Stops delivering events to a queue"""
+
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def broadcast(self, event):
+        """Hands an event to every subscriber, dropping those that have fallen behind"""
+
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                self.drop(subscriber)
+
+    def drop(self, subscriber):
+        """Unsubscribes a queue and wakes its stream so it ends and the client reconnects"""
+
+        self.unsubscribe(subscriber)
+        try:
+            while True:
+                subscriber.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            subscriber.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def run(self):
+        """Listens for notifications, reconnecting after errors"""
+
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                self.app.logger.exception('Lost the event listener connection')
+                time.sleep(self.app.config['EVENTS_RECONNECT_DELAY'])
+
+    def listen(self):
+        """Holds a connection that LISTENs on the channel and broadcasts what arrives"""
+
+        # Taken out of the pool for good, it is closed when the loop fails
+        connection = db.get_engine(self.app).raw_connection()
+        connection.detach()
+        try:
+            dbapi = connection.connection
+            dbapi.autocommit = True
+            with dbapi.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            while True:
+                if select.select([dbapi], [], [], 60) == ([], [], []):
+                    continue
+                dbapi.poll()
+                while dbapi.notifies:
+                    self.broadcast(json.loads(dbapi.notifies.pop(0).payload))
+        finally:
+            connection.close()
+
+
+def publish(kind, post_id, user_id, tag_ids):
+    """Sends an event about a post to every worker's subscribers, call after committing the change"""
+
+    event = {'event': kind, 'post': post_id, 'user': user_id, 'tags': sorted(tag_ids)}
+    if current_app.config['EVENTS_NOTIFY']:
+        db.session.execute(db.select([db.func.pg_notify(CHANNEL, json.dumps(event))]))
+        db.session.commit()
+    else:
+        current_app.extensions['events'].broadcast(event)
+
+
+def format_event(event):
+    """Formats an event for the text/event-stream wire format"""
+
+    return f'event: {event["event"]}\ndata: {json.dumps(event)}\n\n'
+
+
+def stream(broker, subscriber, user_id, tag_id, keepalive):
+    """Yields the events a subscriber asked for, and a comment when nothing has happened for keepalive seconds"""
+
+    try:
+        # Tells EventSource how long to wait before reconnecting
+        yield 'retry: 3000\n\n'
+        while True:
+            try:
+                event = subscriber.get(timeout=keepalive)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event is None:
+                return
+            if user_id is not None and event['user'] != user_id:
+                continue
+            if tag_id is not None and tag_id not in event['tags']:
+                continue
+            yield format_event(event)
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+def init_events(app):
+    """Sets up the event broker and registers the /events/posts endpoint on the app"""
+
+    app.config.setdefault('EVENTS_NOTIFY', db.get_engine(app).dialect.name == 'postgresql')
+    app.config.setdefault('EVENTS_QUEUE_SIZE', 100)
+    app.config.setdefault('EVENTS_KEEPALIVE', 15)
+    app.config.setdefault('EVENTS_RECONNECT_DELAY', 5)
+    app.config.setdefault('EVENTS_MAX_STREAMS', 2)
+    broker = app.extensions['events'] = Broker(app)
+
+    @app.route('/events/posts')
+    def post_events():
+        """Streams post events, optionally only those of one user or one tag"""
+
+        subscriber = broker.subscribe()
+        if subscriber is None:
+            DECISIONS.labels('stream', 'shed_streams').inc()
+            return busy_response(app)
+        response = Response(stream(broker, subscriber, request.args.get('user', type=int),
+                                   request.args.get('tag', type=int), app.config['EVENTS_KEEPALIVE']),
+                            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Stops nginx from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
@@ -0,0 +1,292 @@
+"""Atom feeds and sitemaps for Blogly.
+
+Every user and tag has an Atom feed of its latest FEED_ENTRIES posts, and
+/sitemap.xml indexes sitemap shards listing every post, user and tag page.
+Shard n of a kind holds the ids from n * SITEMAP_SHARD_SIZE + 1 up to
+(n + 1) * SITEMAP_SHARD_SIZE, so a shard never has more than the 50,000 URLs
+the sitemap protocol allows and a row always lives in the same shard.
+
+Documents are written to FEED_CACHE_DIR a chunk at a time and served from
+there, so crawlers cost a file read and one primary key lookup. Each document
+has a token in the feed_stamp table and its file is named after it. When
+posts, users or tags change, routes call refresh_feeds naming what changed,
+which gives those feeds and shards new tokens, so whichever process serves one
+next, on whichever machine, no longer finds its file and generates it again.
+Absolute URLs start with SITE_URL.
+"""
+
+from datetime import datetime, timezone
+import glob
+import os
+import tempfile
+import uuid
+from xml.sax.saxutils import escape, quoteattr
+
+from flask import abort, current_app, send_file
+from sqlalchemy.dialects import postgresql
+from surrogate import add_keys
+from models import db, FeedStamp, Post, PostTag, Tag, User
+
+SITEMAP_KINDS = {'posts': Post, 'users': User, 'tags': Tag}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def cache_path(document):
+    """Returns the file holding the current version of a document, such as users/3.atom"""
+
+    token = db.session.query(FeedStamp.token).filter_by(document=document).scalar() or 'initial'
+    root, ext = os.path.splitext(document)
+    return os.path.join(current_app.config['FEED_CACHE_DIR'], f'{root}.{token}{ext}')
+
+
+def other_versions(path):
+    """Returns the files of the other versions of the document whose current file is path"""
+
+    root, ext = path.rsplit('.', 2)[0], os.path.splitext(path)[1]
+    return [other for other in glob.glob(glob.escape(root) + '.*' + ext) if other != path]
+
+
+def write_document(path, chunks):
+    """Writes chunks of text to path, replacing the old file only once the new one is complete"""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w', encoding='utf-8') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    remove_document(path, keep_current=True)
+
+
+def remove_document(path, keep_current=False):
+    """Removes every version of a cached document, or only the stale ones"""
+
+    for stale in other_versions(path) + ([] if keep_current else [path]):
+        try:
+            os.remove(stale)
+        except FileNotFoundError:
+            pass
+
+
+def url(path):
+    """Returns the absolute URL of a page"""
+
+    return current_app.config['SITE_URL'].rstrip('/') + path
+
+
+def timestamp(moment):
+    """Formats a time as RFC 3339, treating naive times as UTC"""
+
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+#########
+# Feeds #
+#########
+
+
+def atom_feed(title, path, posts):
+    """Yields an Atom feed of posts, newest first, a few lines at a time"""
+
+    posts = list(posts)
+    updated = posts[0].created_at if posts else EPOCH
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    yield (f'<title>{escape(title)}</title>\n<id>{escape(url(path))}</id>\n'
+           f'<link rel="alternate" href={quoteattr(url(path))}/>\n'
+           f'<link rel="self" href={quoteattr(url(path + "/feed.atom"))}/>\n'
+           f'<updated>{timestamp(updated)}</updated>\n')
+    for post in posts:
+        link = url(f'/posts/{post.id}')
+        yield (f'<entry>\n<title>{escape(post.title)}</title>\n<id>{escape(link)}</id>\n'
+               f'<link href={quoteattr(link)}/>\n<updated>{timestamp(post.created_at)}</updated>\n'
+               f'<author><name>{escape(post.user.first_name)} {escape(post.user.last_name)}</name></author>\n'
+               f'<content type="text">{escape(post.content)}</content>\n</entry>\n')
+    yield '</feed>\n'
+
+
+def latest_posts(query):
+    """Returns the newest FEED_ENTRIES posts of a query, with their authors"""
+
+    return (query.options(db.joinedload(Post.user))
+            .order_by(Post.created_at.desc(), Post.id.desc())
+            .limit(current_app.config['FEED_ENTRIES']))
+
+
+def write_user_feed(path, user_id):
+    """Regenerates a user's feed, returns False if there is no such user"""
+
+    user = User.query.get(user_id)
+    if user is None:
+        remove_document(path)
+        return False
+    write_document(path, atom_feed(f'Posts by {user.first_name} {user.last_name}', f'/users/{user.id}',
+                                   latest_posts(Post.query.filter_by(user_id=user.id))))
+    return True
+
+
+def write_tag_feed(path, tag_id):
+    """Regenerates a tag's feed, returns False if there is no such tag"""
+
+    tag = Tag.query.get(tag_id)
+    if tag is None:
+        remove_document(path)
+        return False
+    posts = Post.query.join(PostTag, PostTag.post_id == Post.id).filter(PostTag.tag_id == tag.id)
+    write_document(path, atom_feed(f'Posts tagged {tag.name}', f'/tags/{tag.id}', latest_posts(posts)))
+    return True
+
+
+############
+# Sitemaps #
+############
+
+
+def shard_of(ident):
+    """Returns the number of the sitemap shard that lists a row"""
+
+    return (ident - 1) // current_app.config['SITEMAP_SHARD_SIZE']
+
+
+def shard_count(model):
+    """Returns how many shards it takes to list every row of a model"""
+
+    highest = db.session.query(db.func.max(model.id)).scalar()
+    return shard_of(highest) + 1 if highest else 0
+
+
+def sitemap_shard(kind, shard):
+    """Yields the sitemap shard listing the pages of a kind of row, reading the rows in batches"""
+
+    model = SITEMAP_KINDS[kind]
+    size = current_app.config['SITEMAP_SHARD_SIZE']
+    columns = [model.id, model.created_at] if model is Post else [model.id]
+    rows = (db.session.query(*columns)
+            .filter(model.id.between(shard * size + 1, (shard + 1) * size))
+            .order_by(model.id)
+            .yield_per(1000))
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for row in rows:
+        lastmod = f'<lastmod>{timestamp(row.created_at)}</lastmod>' if model is Post else ''
+        yield f'<url><loc>{escape(url(f"/{kind}/{row.id}"))}</loc>{lastmod}</url>\n'
+    yield '</urlset>\n'
+
+
+def sitemap_index():
+    """Yields the sitemap index listing every shard"""
+
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for kind, model in SITEMAP_KINDS.items():
+        for shard in range(shard_count(model)):
+            yield f'<sitemap><loc>{escape(url(f"/sitemaps/{kind}-{shard}.xml"))}</loc></sitemap>\n'
+    yield '</sitemapindex>\n'
+
+
+def write_sitemap_shard(path, kind, shard):
+    """Regenerates a sitemap shard, returns False if it is past the last row"""
+
+    if shard >= shard_count(SITEMAP_KINDS[kind]):
+        remove_document(path)
+        return False
+    write_document(path, sitemap_shard(kind, shard))
+    return True
+
+
+def write_sitemap_index(path):
+    """Regenerates the sitemap index"""
+
+    write_document(path, sitemap_index())
+    return True
+
+
+###########
+# Refresh #
+###########
+
+
+def mark_stale(documents):
+    """Gives documents new tokens, so their cached files are no longer served anywhere"""
+
+    rows = [{'document': document, 'token': uuid.uuid4().hex} for document in sorted(documents)]
+    if not rows:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(FeedStamp.__table__)
+        statement = statement.on_conflict_do_update(index_elements=['document'],
+                                                    set_={'token': statement.excluded.token})
+    else:
+        statement = FeedStamp.__table__.insert().prefix_with('OR REPLACE', dialect='sqlite')
+    db.session.execute(statement, rows)
+
+
+def refresh_feeds(user_feeds=(), tag_feeds=(), posts=(), users=(), tags=()):
+    """Marks the feeds of the given users and tags and the shards listing the given rows stale, and commits
+
+    Call after committing the change and before purging the proxy, so the
+    proxy's next request gets the document generated afresh."""
+
+    stale = {f'users/{user_id}.atom' for user_id in user_feeds}
+    stale |= {f'tags/{tag_id}.atom' for tag_id in tag_feeds}
+    for kind, ids in (('posts', posts), ('users', users), ('tags', tags)):
+        stale |= {f'sitemaps/{kind}-{shard}.xml' for shard in {shard_of(ident) for ident in ids}}
+    if posts or users or tags:
+        # A few lines long, marked in case a shard was added or emptied
+        stale.add('sitemap.xml')
+    mark_stale(stale)
+    db.session.commit()
+
+
+def serve(document, write, *args, mimetype):
+    """Sends the current version of a cached document, generating it first if needed"""
+
+    path = cache_path(document)
+    if not os.path.exists(path) and not write(path, *args):
+        abort(404)
+    return send_file(os.path.abspath(path), mimetype=mimetype, conditional=True)
+
+
+def init_feeds(app):
+    """Registers the feed and sitemap endpoints on the app"""
+
+    app.config.setdefault('FEED_CACHE_DIR', '.feed_cache')
+    app.config.setdefault('FEED_ENTRIES', 20)
+    app.config.setdefault('SITEMAP_SHARD_SIZE', 50000)
+    app.config.setdefault('SITE_URL', 'http://localhost:5000')
+
+    @app.route('/users/<int:userid>/feed.atom')
+    def user_feed(userid):
+        """Atom feed of a user's latest posts"""
+
+        # Served from a file, so the rows are named here rather than as they load
+        add_keys(f'user-{userid}')
+        return serve(f'users/{userid}.atom', write_user_feed, userid,
+                     mimetype='application/atom+xml')
+
+    @app.route('/tags/<int:tagid>/feed.atom')
+    def tag_feed(tagid):
+        """Atom feed of the latest posts with a tag"""
+
+        add_keys(f'tag-{tagid}')
+        return serve(f'tags/{tagid}.atom', write_tag_feed, tagid,
+                     mimetype='application/atom+xml')
+
+    @app.route('/sitemap.xml')
+    def sitemap():
+        """Sitemap index of every shard"""
+
+        add_keys(*SITEMAP_KINDS)
+        return serve('sitemap.xml', write_sitemap_index, mimetype='application/xml')
+
+    @app.route('/sitemaps/<any(posts, users, tags):kind>-<int:shard>.xml')
+    def sitemap_shard_page(kind, shard):
+        """Sitemap shard listing up to SITEMAP_SHARD_SIZE pages"""
+
+        add_keys(kind)
+        return serve(f'sitemaps/{kind}-{shard}.xml', write_sitemap_shard, kind, shard,
+                     mimetype='application/xml')
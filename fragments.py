@@ -0,0 +1,108 @@
+"""Template fragment cache for Blogly.
+
+Templates can wrap markup that depends on a single row in
+
+    {% cache 'user-item', user %}...{% endcache %}
+
+The rendered markup is kept in a per-worker LRU keyed by the fragment name and
+each model's table, id and version. Versioned models bump their version in the
+database whenever they are updated, so an edit in any worker makes every
+worker render the fragment afresh, and stale entries simply age out. The cache
+holds at most FRAGMENT_CACHE_MAX_BYTES of markup.
+"""
+
+from collections import OrderedDict
+import threading
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """LRU of rendered fragments, bounded by the total size of the markup"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached markup for key, or None"""
+
+        with self.lock:
+            markup = self.entries.get(key)
+            if markup is not None:
+                self.entries.move_to_end(key)
+            return markup
+
+    def set(self, key, markup):
+        """Caches markup for key, evicting the least recently used fragments to stay within max_bytes"""
+
+        if len(markup) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = markup
+            self.size += len(markup)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        """Drops every fragment"""
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def fragment_key(parts):
+    """Turns the arguments of a cache tag into a hashable key, using table, id and version for models"""
+
+    key = []
+    for part in parts:
+        if hasattr(part, '__table__'):
+            key.append((part.__tablename__, part.id, getattr(part, 'version', None)))
+        else:
+            key.append(part)
+    return tuple(key)
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the {% cache name, model, ... %} ... {% endcache %} tag"""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(parts)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        cache = current_app.extensions['fragment_cache']
+        key = fragment_key(parts)
+        markup = cache.get(key)
+        if markup is None:
+            markup = caller()
+            cache.set(key, markup)
+        return Markup(markup)
+
+
+def init_fragment_cache(app):
+    """Adds the cache tag to the app's templates"""
+
+    app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+    app.extensions['fragment_cache'] = FragmentCache(
+        app.config['FRAGMENT_CACHE_MAX_BYTES'])
+    # Must be set before the environment is first used, which is when Flask creates it
+    app.jinja_options = dict(app.jinja_options, extensions=list(
+        app.jinja_options.get('extensions', [])) + [FragmentCacheExtension])
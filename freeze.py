@@ -0,0 +1,206 @@
+"""Static export of Blogly.
+
+`flask freeze` renders /users, /tags and every user, post and tag page into a
+directory, along with the static files, so the site can be served by any web
+server while it is read-heavy. /users/1 is written to users/1/index.html.
+Pages are rendered through the app itself, shared between --jobs processes.
+
+While a page renders, every row loaded for it is recorded. The manifest kept
+in the output directory holds those rows for each page, the version of every
+user, post and tag, and the post_tag and related_post pairs. The next run
+compares them with the database and renders only the pages that used a row
+whose version changed or that is gone, the pages of new rows, the lists that
+new users and tags appear in, the author page of new posts, and the pages on
+either side of a changed tag or related post pair. Pages of deleted rows are
+removed. View counts do not bump versions, so they are as of the last render.
+"""
+
+from contextlib import contextmanager
+import json
+import multiprocessing
+import os
+import shutil
+
+import click
+from sqlalchemy import event
+from models import db, Post, PostTag, RelatedPost, Tag, User
+from object_cache import ObjectCache
+
+MANIFEST = '.freeze-manifest.json'
+
+VERSIONED = {'users': User, 'post': Post, 'tag': Tag}
+
+# Pages showing a row, by table
+PAGES = {'users': '/users/{}', 'post': '/posts/{}', 'tag': '/tags/{}'}
+
+# Set in the parent before forking, so the worker processes inherit them
+_app = None
+_output = None
+
+
+@contextmanager
+def track_loads():
+    """Collects the (table, id) of every versioned row loaded inside the block"""
+
+    loaded = set()
+
+    def record(target, context, attrs=None):
+        if target.__tablename__ in VERSIONED:
+            loaded.add((target.__tablename__, target.id))
+
+    event.listen(db.Model, 'load', record, propagate=True)
+    event.listen(db.Model, 'refresh', record, propagate=True)
+    try:
+        yield loaded
+    finally:
+        event.remove(db.Model, 'load', record)
+        event.remove(db.Model, 'refresh', record)
+
+
+def page_file(output, path):
+    """Returns the file a page is written to"""
+
+    return os.path.join(output, path.strip('/'), 'index.html')
+
+
+def render_pages(paths):
+    """Renders pages into the output directory, returns each path with the rows it used, or None if it is gone"""
+
+    results = []
+    with _app.test_client() as client:
+        for path in paths:
+            with track_loads() as loaded:
+                resp = client.get(path)
+            target = page_file(_output, path)
+            if resp.status_code != 200:
+                if os.path.exists(target):
+                    os.remove(target)
+                results.append((path, None))
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as file:
+                file.write(resp.get_data())
+            results.append((path, sorted(loaded)))
+    return results
+
+
+def snapshot():
+    """Reads the version of every versioned row and the post_tag and related_post pairs"""
+
+    return {
+        'rows': {table: {str(ident): version for ident, version in db.session.query(model.id, model.version)}
+                 for table, model in VERSIONED.items()},
+        'post_tags': sorted(list(pair) for pair in db.session.query(PostTag.post_id, PostTag.tag_id)),
+        'related': sorted(list(pair) for pair in db.session.query(RelatedPost.post_id, RelatedPost.related_id)),
+    }
+
+
+def all_pages(current):
+    """Returns every page of the site"""
+
+    pages = ['/users', '/tags']
+    for table, versions in current['rows'].items():
+        pages += [PAGES[table].format(ident) for ident in versions]
+    return pages
+
+
+def stale_pages(manifest, current):
+    """Returns the pages to render again and the pages to remove since the export described by manifest"""
+
+    changed = set()
+    render = set()
+    remove = set()
+    for table, versions in current['rows'].items():
+        old = manifest['rows'].get(table, {})
+        changed |= {(table, int(ident)) for ident, version in old.items() if versions.get(ident) != version}
+        remove |= {PAGES[table].format(ident) for ident in old.keys() - versions.keys()}
+        render |= {PAGES[table].format(ident) for ident in versions.keys() - old.keys()}
+        if versions.keys() - old.keys() and table in ('users', 'tag'):
+            render.add('/users' if table == 'users' else '/tags')
+
+    new_posts = [int(ident) for ident in current['rows']['post'].keys() - manifest['rows'].get('post', {}).keys()]
+    if new_posts:
+        render |= {f'/users/{user_id}' for (user_id,) in db.session.query(Post.user_id)
+                   .filter(Post.id.in_(new_posts)).distinct()}
+
+    for post_id, tag_id in set(map(tuple, manifest['post_tags'])) ^ set(map(tuple, current['post_tags'])):
+        render |= {f'/posts/{post_id}', f'/tags/{tag_id}'}
+    for post_id, related_id in set(map(tuple, manifest['related'])) ^ set(map(tuple, current['related'])):
+        render.add(f'/posts/{post_id}')
+
+    for path, rows in manifest['pages'].items():
+        if any(tuple(row) in changed for row in rows):
+            render.add(path)
+    return render - remove, remove
+
+
+def freeze(app, output, jobs=1, full=False):
+    """Exports the site to output, only the pages that changed unless full, returns how many were rendered and removed"""
+
+    global _app, _output
+    manifest_path = os.path.join(output, MANIFEST)
+    manifest = None
+    if not full and os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+
+    current = snapshot()
+    if manifest is None:
+        render, remove = all_pages(current), set()
+        pages = {}
+    else:
+        render, remove = stale_pages(manifest, current)
+        pages = manifest['pages']
+
+    os.makedirs(output, exist_ok=True)
+    if app.static_folder:
+        shutil.copytree(app.static_folder, os.path.join(output, 'static'), dirs_exist_ok=True)
+    for path in remove:
+        pages.pop(path, None)
+        if os.path.exists(page_file(output, path)):
+            os.remove(page_file(output, path))
+
+    # Rendering must not count views, and every row has to be loaded to be recorded
+    counting, cache = app.config['VIEWS_COUNTING'], app.extensions['object_cache']
+    app.config['VIEWS_COUNTING'] = False
+    app.extensions['object_cache'] = ObjectCache(0, 0)
+    _app, _output = app, output
+    try:
+        render = sorted(render)
+        if jobs > 1 and len(render) > 1:
+            # Forked workers must not share the parent's connections
+            db.session.remove()
+            db.get_engine(app).dispose()
+            chunks = [render[start::jobs] for start in range(jobs)]
+            with multiprocessing.get_context('fork').Pool(jobs) as pool:
+                results = [result for chunk in pool.map(render_pages, chunks) for result in chunk]
+        else:
+            results = render_pages(render)
+    finally:
+        app.config['VIEWS_COUNTING'] = counting
+        app.extensions['object_cache'] = cache
+        _app = _output = None
+
+    for path, rows in results:
+        if rows is None:
+            pages.pop(path, None)
+        else:
+            pages[path] = rows
+    current['pages'] = pages
+    with open(manifest_path, 'w') as file:
+        json.dump(current, file)
+    return len(results), len(remove)
+
+
+def init_freeze(app):
+    """Registers the command that exports the site"""
+
+    @app.cli.command('freeze')
+    @click.option('--output', default='build', help='Directory to write the site to')
+    @click.option('--jobs', default=os.cpu_count(), help='How many processes to render with')
+    @click.option('--full', is_flag=True, help='Render every page instead of only those that changed')
+    def freeze_command(output, jobs, full):
+        """Renders the site to static files"""
+
+        rendered, removed = freeze(app, output, jobs, full)
+        click.echo(f'Rendered {rendered} pages and removed {removed} into {output}')
@@ -0,0 +1,39 @@
+"""Gunicorn settings for Blogly, loaded automatically from the working directory."""
+
+import os
+import shutil
+import tempfile
+
+# Workers write their metrics here so /metrics can merge them, see metrics.py
+os.environ.setdefault('prometheus_multiproc_dir',
+                      os.path.join(tempfile.gettempdir(), 'blogly-metrics'))
+
+# Open /events/posts streams each hold a thread, see events.py. Keep DB_POOL_SIZE
+# below this so requests queue for connections when Postgres slows, see admission.py
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Workers using more memory than this finish their requests and are replaced, see memory.py
+RSS_LIMIT = int(float(os.environ.get('MEMORY_RSS_LIMIT_MB', 0)) * 2**20)
+
+
+def on_starting(server):
+    """Clears metrics left behind by a previous run"""
+
+    directory = os.environ['prometheus_multiproc_dir']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that has exited"""
+
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_request(worker, req, environ, resp):
+    """Recycles the worker once it is over the RSS limit"""
+
+    if RSS_LIMIT:
+        from memory import recycle_if_over
+        recycle_if_over(worker, RSS_LIMIT)
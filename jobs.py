@@ -0,0 +1,165 @@
+"""Background jobs for Blogly.
+
+Jobs are rows in the job table. Routes enqueue them and return immediately,
+and a separate worker process (worker.py) claims them with
+SELECT ... FOR UPDATE SKIP LOCKED so any number of workers can run side by side.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import time
+import traceback
+
+from flask import current_app
+from feeds import refresh_feeds
+from models import db, Job, User, Post, PostTag
+from surrogate import purge
+
+log = logging.getLogger(__name__)
+
+# Maps a job kind to the function that runs it
+HANDLERS = {}
+
+# A running job whose worker has not been heard from in this long is reclaimed
+LEASE = timedelta(minutes=10)
+
+
+def handler(kind):
+    """Registers the decorated function as the handler for jobs of the given kind"""
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, max_attempts=5, **payload):
+    """Adds a job to the queue, if the app is configured with JOBS_EAGER will run it inline instead"""
+
+    job = Job(kind=kind, payload=payload, max_attempts=max_attempts)
+    db.session.add(job)
+    db.session.commit()
+
+    if current_app.config.get('JOBS_EAGER', False):
+        job.status = 'running'
+        job.attempts += 1
+        run_job(job)
+
+    return job
+
+
+def claim_job():
+    """Claims the next runnable job for this worker, returns None if there is none"""
+
+    now = datetime.utcnow()
+    job = (Job.query
+           .filter(db.or_(db.and_(Job.status == 'queued', Job.run_at <= now),
+                          db.and_(Job.status == 'running', Job.locked_at < now - LEASE)))
+           .order_by(Job.run_at, Job.id)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = 'running'
+    job.locked_at = now
+    job.attempts += 1
+    db.session.commit()
+    return job
+
+
+def run_job(job):
+    """Runs a claimed job, on failure schedules a retry with exponential backoff"""
+
+    func = HANDLERS.get(job.kind)
+    try:
+        if func is None:
+            raise LookupError(f'No handler for job kind {job.kind!r}')
+        func(job, **job.payload)
+    except Exception:
+        db.session.rollback()
+        job.error = traceback.format_exc()
+        if job.attempts >= job.max_attempts or func is None:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=2 ** job.attempts)
+        db.session.commit()
+        return False
+
+    job.status = 'done'
+    job.progress = 1.0
+    job.error = None
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+def report_progress(job, done, total):
+    """Records how far along a job is and commits the work done so far"""
+
+    job.progress = done / total if total else 1.0
+    job.locked_at = datetime.utcnow()
+    db.session.commit()
+
+
+def work(poll_interval=1.0, once=False):
+    """Claims and runs jobs until interrupted, with once=True stops when the queue is empty"""
+
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    log.info('Job worker %s started', worker)
+    while True:
+        job = claim_job()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        ok = run_job(job)
+        log.info('Job %s (%s) %s', job.id, job.kind, 'done' if ok else job.status)
+
+############
+# Handlers #
+############
+
+
+@handler('delete_user')
+def delete_user(job, userid, batch_size=500):
+    """Deletes a user and all of their posts, in batches so progress can be reported"""
+
+    user = User.query.get(userid)
+    if user is None:
+        return
+
+    total = Post.query.filter_by(user_id=userid).count()
+    tag_ids = [tag_id for (tag_id,) in db.session.query(PostTag.tag_id).join(Post)
+               .filter(Post.user_id == userid).distinct()]
+    done = 0
+    deleted = []
+    while True:
+        post_ids = [post_id for (post_id,) in db.session.query(Post.id)
+                    .filter_by(user_id=userid).limit(batch_size)]
+        if not post_ids:
+            break
+        deleted += post_ids
+        PostTag.query.filter(PostTag.post_id.in_(post_ids)).delete(
+            synchronize_session=False)
+        Post.query.filter(Post.id.in_(post_ids)).delete(
+            synchronize_session=False)
+        done += len(post_ids)
+        report_progress(job, done, total + 1)
+
+    User.query.filter_by(id=userid).delete(synchronize_session=False)
+    db.session.commit()
+
+    if tag_ids:
+        enqueue('refresh_related', tag_ids=tag_ids)
+    refresh_feeds(user_feeds=[userid], tag_feeds=tag_ids, posts=deleted, users=[userid])
+    # Only now that the rows are gone, pages cached before this would come straight back
+    # and again once no worker's object cache can still hand out the user
+    purge(f'user-{userid}', 'users', 'posts', *(f'post-{post_id}' for post_id in deleted),
+          *(f'tag-{tag_id}' for tag_id in tag_ids), again_after=current_app.config['OBJECT_CACHE_TTL'])
@@ -0,0 +1,257 @@
+"""Memory tracking for Blogly workers.
+
+Every response sets blogly_worker_rss_bytes to the worker's resident set size.
+When MEMORY_TRACKING is set, tracemalloc also follows every allocation. After
+the first request to each endpoint, and then every MEMORY_SNAPSHOT_EVERY
+requests, a snapshot is taken. The first is kept as the endpoint's baseline,
+and the newest replaces the one before it. Both are written to MEMORY_DIR, so
+the snapshots of every worker outlive it. Tracing makes allocations a few
+times slower, so leave it off unless you are hunting a leak.
+
+Snapshots are taken as the request's app context is torn down, once its
+database session has been removed, so the rows it loaded are gone. Requests
+other threads of the worker are handling at the time are in the snapshot too,
+so hunt leaks with GUNICORN_THREADS=1 to see only what requests leave behind.
+
+Each endpoint's report lists the lines holding the most memory in its newest
+snapshot and the lines whose memory grew the most since its baseline, which is
+what the requests in between left behind. /debug/memory reports on the worker
+that answers it, and needs a header signed with the app's SECRET_KEY, printed
+by `flask memory-token`, which expires after DEBUG_TOKEN_MAX_AGE seconds. `flask memory-report` reads the snapshots of every
+worker from MEMORY_DIR.
+
+Under gunicorn a worker whose RSS passes MEMORY_RSS_LIMIT_MB finishes its
+requests and is replaced, see post_request in gunicorn.conf.py.
+"""
+
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+
+import click
+from flask import abort, g, jsonify, request
+from prometheus_client import Gauge
+from models import db
+from signed_headers import SignedHeader
+
+TOKEN = SignedHeader('X-Blogly-Memory', 'blogly-memory', b'memory')
+
+WORKER_RSS = Gauge('blogly_worker_rss_bytes', 'Resident set size of the worker',
+                   multiprocess_mode='liveall')
+
+# Allocations made by tracemalloc itself and the import system are noise
+FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+]
+
+
+def rss():
+    """Returns the resident set size of this process in bytes"""
+
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Without /proc the peak is the best there is, in bytes on macOS and kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def recycle_if_over(worker, limit):
+    """Tells a gunicorn worker to finish its requests and exit once its RSS passes limit bytes, returns whether it did"""
+
+    size = rss()
+    if not worker.alive or size <= limit:
+        return False
+    worker.log.warning('Worker %s uses %d MB, over the %d MB limit, recycling it',
+                       worker.pid, size // 2**20, limit // 2**20)
+    worker.alive = False
+    return True
+
+
+def site(stat):
+    """Describes the allocations of one line"""
+
+    frame = stat.traceback[0]
+    return {'site': f'{frame.filename}:{frame.lineno}', 'size': stat.size, 'count': stat.count}
+
+
+def growth(stat):
+    """Describes how much a line's allocations grew"""
+
+    frame = stat.traceback[0]
+    return {'site': f'{frame.filename}:{frame.lineno}', 'size': stat.size, 'size_diff': stat.size_diff,
+            'count_diff': stat.count_diff}
+
+
+def report(baseline, latest, top):
+    """Returns the lines holding the most memory in latest and those that grew the most since baseline"""
+
+    return {
+        'traced': sum(stat.size for stat in latest.statistics('filename')),
+        'top': [site(stat) for stat in latest.statistics('lineno')[:top]],
+        'growth': [growth(stat) for stat in latest.compare_to(baseline, 'lineno')[:top] if stat.size_diff > 0],
+    }
+
+
+def snapshot_path(directory, endpoint, pid, which):
+    """Returns where a worker keeps the baseline or latest snapshot of an endpoint"""
+
+    return os.path.join(directory, f'{endpoint}.{pid}.{which}.tracemalloc')
+
+
+class MemoryTracker:
+    """Takes the snapshots of each endpoint of this worker"""
+
+    def __init__(self, app):
+        self.app = app
+        self.requests = {}
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts tracing allocations unless they already are"""
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.app.config['MEMORY_TRACE_FRAMES'])
+
+    def finished(self, endpoint):
+        """Counts a request to endpoint, taking a snapshot if it is the endpoint's turn"""
+
+        with self.lock:
+            count = self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if (count - 1) % self.app.config['MEMORY_SNAPSHOT_EVERY']:
+            return
+        latest = tracemalloc.take_snapshot().filter_traces(FILTERS)
+        with self.lock:
+            baseline = self.snapshots.get(endpoint, (latest, None))[0]
+            self.snapshots[endpoint] = (baseline, latest)
+        self.dump(endpoint, baseline if baseline is latest else None, latest)
+
+    def dump(self, endpoint, baseline, latest):
+        """Writes an endpoint's snapshots to MEMORY_DIR, the baseline only when it is first taken"""
+
+        directory = self.app.config['MEMORY_DIR']
+        os.makedirs(directory, exist_ok=True)
+        if baseline is not None:
+            baseline.dump(snapshot_path(directory, endpoint, os.getpid(), 'baseline'))
+        path = snapshot_path(directory, endpoint, os.getpid(), 'latest')
+        # Written aside and moved into place so the report command never reads half a file
+        latest.dump(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def report(self, endpoint=None, top=10):
+        """Reports on every endpoint with snapshots, or just one"""
+
+        with self.lock:
+            snapshots = dict(self.snapshots)
+            requests = dict(self.requests)
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'pid': os.getpid(),
+            'rss': rss(),
+            'tracing': tracemalloc.is_tracing(),
+            'traced': current,
+            'traced_peak': peak,
+            'endpoints': {name: dict(report(baseline, latest, top), requests=requests[name])
+                          for name, (baseline, latest) in sorted(snapshots.items())
+                          if endpoint in (None, name)},
+        }
+
+    def clear(self):
+        """Forgets every snapshot and request count"""
+
+        with self.lock:
+            self.snapshots.clear()
+            self.requests.clear()
+
+
+def read_snapshots(directory):
+    """Loads the snapshots written by every worker, keyed by endpoint and pid"""
+
+    found = {}
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        if not name.endswith('.tracemalloc'):
+            continue
+        endpoint, pid, which, _ = name.rsplit('.', 3)
+        found.setdefault((endpoint, int(pid)), {})[which] = os.path.join(directory, name)
+    return {key: (tracemalloc.Snapshot.load(paths['baseline']), tracemalloc.Snapshot.load(paths['latest']))
+            for key, paths in found.items() if len(paths) == 2}
+
+
+def init_memory(app):
+    """Registers the memory tracking hooks, the /debug/memory endpoint and the CLI commands on the app"""
+
+    app.config.setdefault('MEMORY_TRACKING', False)
+    app.config.setdefault('MEMORY_TRACE_FRAMES', 1)
+    app.config.setdefault('MEMORY_SNAPSHOT_EVERY', 100)
+    app.config.setdefault('MEMORY_DIR', 'memory_snapshots')
+    app.config.setdefault('DEBUG_TOKEN_MAX_AGE', 3600)
+    tracker = app.extensions['memory'] = MemoryTracker(app)
+
+    @app.before_request
+    def start_tracing():
+        if app.config['MEMORY_TRACKING']:
+            tracker.start()
+
+    @app.after_request
+    def record_rss(response):
+        WORKER_RSS.set(rss())
+        return response
+
+    @app.teardown_request
+    def note_endpoint(exc):
+        # The request is gone by the time the app context is torn down
+        if (app.config['MEMORY_TRACKING'] and tracemalloc.is_tracing()
+                and request.endpoint not in (None, 'show_memory')):
+            g.memory_endpoint = request.endpoint
+
+    @app.teardown_appcontext
+    def take_snapshot(exc):
+        endpoint = g.pop('memory_endpoint', None)
+        if endpoint is None:
+            return
+        # Teardowns run newest first, so Flask-SQLAlchemy would only remove the session after this
+        db.session.remove()
+        tracker.finished(endpoint)
+
+    @app.route('/debug/memory')
+    def show_memory():
+        """Reports this worker's memory as JSON, to holders of the signed header"""
+
+        if not TOKEN.is_signed(app.config['SECRET_KEY'], app.config['DEBUG_TOKEN_MAX_AGE']):
+            abort(403)
+        top = min(request.args.get('top', 10, type=int), 100)
+        return jsonify(tracker.report(request.args.get('endpoint'), top))
+
+    @app.cli.command('memory-token')
+    def memory_token():
+        """Prints the header that unlocks /debug/memory"""
+
+        click.echo(TOKEN.describe(app.config['SECRET_KEY'], app.config['DEBUG_TOKEN_MAX_AGE']))
+
+    @app.cli.command('memory-report')
+    @click.option('--endpoint', default=None, help='Only report on this endpoint')
+    @click.option('--top', default=10, help='How many lines to list')
+    def memory_report(endpoint, top):
+        """Reports the top allocation sites and growth of every worker from the snapshots in MEMORY_DIR"""
+
+        snapshots = read_snapshots(app.config['MEMORY_DIR'])
+        if not snapshots:
+            click.echo(f'No snapshots in {app.config["MEMORY_DIR"]}, is MEMORY_TRACKING set?')
+        for (name, pid), (baseline, latest) in snapshots.items():
+            if endpoint not in (None, name):
+                continue
+            result = report(baseline, latest, top)
+            click.echo(f'{name} in worker {pid}: {result["traced"] / 2**20:.1f} MB traced')
+            click.echo('  Top allocation sites:')
+            for line in result['top']:
+                click.echo(f'    {line["size"] / 1024:10.1f} KiB {line["count"]:8d} blocks  {line["site"]}')
+            click.echo('  Growth since the first snapshot:')
+            for line in result['growth']:
+                click.echo(f'    {line["size_diff"] / 1024:+10.1f} KiB {line["count_diff"]:+8d} blocks  {line["site"]}')
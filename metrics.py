@@ -0,0 +1,107 @@
+"""Prometheus metrics for Blogly.
+
+Under gunicorn each worker is its own process, so metrics are kept in
+prometheus_client's multiprocess mode: gunicorn.conf.py points
+prometheus_multiproc_dir at a shared directory and /metrics merges the files
+written there by every worker. Without that variable (flask run, tests) the
+metrics live in the default in-process registry.
+"""
+
+import os
+import time
+
+from flask import Response, g, has_request_context, request, before_render_template, template_rendered
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_LATENCY = Histogram('blogly_request_duration_seconds',
+                            'Time spent handling a request', ['endpoint', 'method'])
+REQUEST_COUNT = Counter('blogly_requests_total',
+                        'Responses sent', ['endpoint', 'method', 'status'])
+IN_PROGRESS = Gauge('blogly_requests_in_progress', 'Requests being handled',
+                    ['endpoint'], multiprocess_mode='livesum')
+SQL_COUNT = Counter('blogly_sql_statements_total',
+                    'SQL statements executed', ['endpoint'])
+SQL_LATENCY = Histogram('blogly_sql_duration_seconds',
+                        'Time spent executing SQL statements', ['endpoint'])
+TEMPLATE_LATENCY = Histogram('blogly_template_render_seconds',
+                             'Time spent rendering templates', ['template'])
+
+
+def current_endpoint():
+    """Returns the endpoint of the current request, or 'none' outside of a request"""
+
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'none'
+
+
+def registry():
+    """Returns the registry to expose, merging all workers in multiprocess mode"""
+
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return REGISTRY
+    merged = CollectorRegistry()
+    multiprocess.MultiProcessCollector(merged)
+    return merged
+
+
+def init_metrics(app):
+    """Registers the metrics hooks and the /metrics endpoint on the app"""
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_endpoint = current_endpoint()
+        IN_PROGRESS.labels(g.metrics_endpoint).inc()
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_start' in g:
+            REQUEST_LATENCY.labels(g.metrics_endpoint, request.method).observe(
+                time.perf_counter() - g.metrics_start)
+            REQUEST_COUNT.labels(g.metrics_endpoint, request.method,
+                                 response.status_code).inc()
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        endpoint = g.pop('metrics_endpoint', None)
+        if endpoint is not None:
+            IN_PROGRESS.labels(endpoint).dec()
+
+    @before_render_template.connect_via(app)
+    def start_template_timer(sender, template, context, **extra):
+        g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+    @template_rendered.connect_via(app)
+    def record_template(sender, template, context, **extra):
+        starts = g.get('metrics_templates')
+        if starts:
+            TEMPLATE_LATENCY.labels(template.name or 'string').observe(
+                time.perf_counter() - starts.pop())
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_sql_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def record_sql(conn, cursor, statement, parameters, context, executemany):
+        endpoint = current_endpoint()
+        SQL_COUNT.labels(endpoint).inc()
+        SQL_LATENCY.labels(endpoint).observe(
+            time.perf_counter() - conn.info['metrics_start'].pop())
+
+    @event.listens_for(Engine, 'handle_error')
+    def discard_sql_timer(context):
+        starts = context.connection.info.get('metrics_start')
+        if starts:
+            starts.pop()
+
+    @app.route('/metrics')
+    def show_metrics():
+        """Shows the metrics in the Prometheus text format"""
+
+        return Response(generate_latest(registry()), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,82 @@
+"""Online schema migrations for Blogly.
+
+db.create_all runs as every worker starts, so anything it does to an existing
+table holds that table's locks while the worker's requests wait. Schema changes
+to existing tables are therefore left to commands run once per deploy.
+
+`flask add-columns` adds the columns in ADDED_COLUMNS that the database lacks.
+Adding a column with a constant default only changes the catalog, but it still
+needs an ACCESS EXCLUSIVE lock, so it gives up after LOCK_TIMEOUT instead of
+queueing behind a long transaction with every other query on the table queued
+behind it. Columns that are already there are skipped without taking a lock.
+
+`flask build-indexes` builds the indexes in CONCURRENT_INDEXES with CREATE
+INDEX CONCURRENTLY, which lets writes carry on, and drops those in
+DROPPED_INDEXES the same way. A concurrent build that fails leaves an invalid
+index behind, which the next run drops and builds again.
+"""
+
+import click
+from sqlalchemy import text
+
+from models import db, ADDED_COLUMNS, CONCURRENT_INDEXES, DROPPED_INDEXES
+
+# How long adding a column waits for its table's lock before giving up
+LOCK_TIMEOUT = '5s'
+
+
+def add_column(conn, table, column, definition):
+    """Adds a column unless the table already has it, returns whether it added it"""
+
+    exists = conn.execute(text('SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() '
+                               'AND table_name = :table AND column_name = :column'),
+                          table=table, column=column).scalar()
+    if exists:
+        return False
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+    return True
+
+
+def build_index(conn, name, definition):
+    """Builds an index concurrently unless a valid one exists, returns whether it built it"""
+
+    valid = conn.execute(text('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'),
+                         name=name).scalar()
+    if valid:
+        return False
+    if valid is not None:
+        conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    conn.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+    return True
+
+
+def init_migrations(app):
+    """Registers the commands that change existing tables, which create_all leaves alone"""
+
+    @app.cli.command('add-columns')
+    def add_columns():
+        """Adds the columns the database lacks, giving up rather than waiting long for a table's lock"""
+
+        if db.engine.dialect.name != 'postgresql':
+            click.echo('Only Postgres has columns that are added separately')
+            return
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}'")
+            for table, column, definition in ADDED_COLUMNS:
+                added = add_column(conn, table, column, definition)
+                click.echo(f'{"Added" if added else "Already have"} {table}.{column}')
+
+    @app.cli.command('build-indexes')
+    def build_indexes():
+        """Builds the indexes the database lacks without blocking writes to their tables"""
+
+        if db.engine.dialect.name != 'postgresql':
+            click.echo('Only Postgres has indexes that are built separately')
+            return
+        # CONCURRENTLY refuses to run inside a transaction
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for name in DROPPED_INDEXES:
+                conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+            for name, definition in CONCURRENT_INDEXES.items():
+                built = build_index(conn, name, definition)
+                click.echo(f'{"Built" if built else "Already have"} {name}')
@@ -1,12 +1,28 @@
 """Models for Blogly."""
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import Grouping
 from datetime import datetime, timezone
+import os
 
 db = SQLAlchemy()
 
 DEFAULT_IMAGE = '/static/uploads/default_user.png'
 
+# Every route eager-loads the relationships its page uses, see the options in
+# app.py. With STRICT_LOADING set, as the tests do, any other load that would
+# query raises instead, so a page can't quietly grow an extra query per row.
+LAZY = 'raise_on_sql' if os.environ.get('STRICT_LOADING') else 'select'
+
+
+def escape_like(text):
+    """Escapes the LIKE wildcards in text so it is matched literally, using backslash as the escape character"""
+
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
 def connect_db(app):
     """Connect to database."""
 
@@ -14,7 +30,20 @@ def connect_db(app):
     db.init_app(app)
 
 
-class User(db.Model):
+class Versioned:
+    """Mixin for models whose version goes up every time the row is updated, so caches can key on it"""
+
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+
+@event.listens_for(Versioned, 'before_update', propagate=True)
+def bump_version(mapper, connection, target):
+    """Increments the version in SQL so concurrent updates never share a version"""
+
+    target.version = type(target).version + 1
+
+
+class User(Versioned, db.Model):
     """User"""
 
     __tablename__ = "users"
@@ -25,7 +54,7 @@ class User(db.Model):
     image_url = db.Column(
         db.String(), default=DEFAULT_IMAGE)
 
-    posts = db.relationship('Post', cascade="all, delete-orphan")
+    posts = db.relationship('Post', cascade="all, delete-orphan", lazy=LAZY)
 
     def update_user(self, first, last, url):
         """Updates the user with the provided information, if parameter is set to None will not update that field"""
@@ -37,8 +66,32 @@ class User(db.Model):
         if url:
             self.image_url = url
 
+    @classmethod
+    def full_name(cls):
+        """SQL expression for the full name, matching the expression of the trigram index"""
+
+        return cls.first_name + db.literal_column("' '") + cls.last_name
+
+    @classmethod
+    def search(cls, text, page=1, per_page=20):
+        """Returns a page of users whose name resembles text, best matches first, on Postgres this also tolerates typos"""
+
+        name = cls.full_name()
+        pattern = f'%{escape_like(text)}%'
+        if db.engine.dialect.name != 'postgresql':
+            query = (cls.query
+                     .filter(db.func.lower(name).like(pattern.lower(), escape='\\'))
+                     .order_by(cls.last_name, cls.first_name, cls.id))
+        else:
+            query = (cls.query
+                     .filter(db.or_(name.ilike(pattern, escape='\\'),
+                                    # <% is pg_trgm's word similarity operator, with the percent doubled for psycopg2
+                                    db.literal(text).op('<%%')(Grouping(name))))
+                     .order_by(db.func.word_similarity(text, name).desc(), cls.id))
+        return query.paginate(page=page, per_page=per_page, error_out=False)
 
-class Post(db.Model):
+
+class Post(Versioned, db.Model):
     """Post"""
 
     __tablename__ = "post"
@@ -49,9 +102,11 @@ class Post(db.Model):
     created_at = db.Column(db.TIMESTAMP(timezone=True),
                            nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Written in batches by views.py, lags behind by up to VIEWS_FLUSH_INTERVAL
+    views = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
 
-    user = db.relationship('User')
-    post_tags = db.relationship('PostTag', cascade="all, delete-orphan")
+    user = db.relationship('User', lazy=LAZY)
+    post_tags = db.relationship('PostTag', cascade="all, delete-orphan", lazy=LAZY)
 
     def update_post(self, title, content):
         """Updates the post with the provided information, if parameter is set to None will not update that field"""
@@ -61,7 +116,18 @@ class Post(db.Model):
         if content:
             self.content = content
 
-class Tag(db.Model):
+    @classmethod
+    def archive(cls, year, month, page=1, per_page=50):
+        """Returns a page of the posts made in a month, oldest first, loading only what ix_post_archive covers"""
+
+        start, end = month_bounds(year, month)
+        return (cls.query
+                .options(db.load_only(cls.id, cls.title, cls.created_at, cls.version))
+                .filter(cls.created_at >= start, cls.created_at < end)
+                .order_by(cls.created_at, cls.id)
+                .paginate(page=page, per_page=per_page, error_out=False))
+
+class Tag(Versioned, db.Model):
     """tag"""
 
     __tablename__="tag"
@@ -69,7 +135,10 @@ class Tag(db.Model):
     id = db.Column(db.Integer,primary_key=True, autoincrement=True)
     name = db.Column(db.String(), nullable=False, unique=True)
 
-    posts = db.relationship('Post', secondary='post_tag', backref='tags')
+    # Read only, post_tag rows are written through PostTag so deleting a post or
+    # tag never has to load the other side just to delete the same rows twice
+    posts = db.relationship('Post', secondary='post_tag', viewonly=True, sync_backref=False, lazy=LAZY,
+                            backref=db.backref('tags', viewonly=True, sync_backref=False, lazy=LAZY))
 
     def update_tag(self, name):
         """Updates the tag with the provided information, if parameter is set to None will not update that field"""
@@ -77,10 +146,198 @@ class Tag(db.Model):
         if name:
             self.name = name
 
+    def posts_condition(self, post_ids=None, user_id=None):
+        """SQL condition selecting posts by id, or every post of a user"""
+
+        if user_id is not None:
+            return Post.user_id == user_id
+        return id_in(Post.id, post_ids or [])
+
+    def attach(self, post_ids=None, user_id=None):
+        """Tags the given posts, or every post by the given user, in one statement, returns how many were newly tagged"""
+
+        posts = db.select([Post.id, db.literal(self.id, db.Integer)]).where(
+            self.posts_condition(post_ids, user_id))
+        if db.engine.dialect.name == 'postgresql':
+            statement = postgresql.insert(PostTag.__table__).from_select(
+                ['post_id', 'tag_id'], posts).on_conflict_do_nothing()
+        else:
+            statement = PostTag.__table__.insert().from_select(
+                ['post_id', 'tag_id'], posts).prefix_with('OR IGNORE', dialect='sqlite')
+        return db.session.execute(statement).rowcount
+
+    def detach(self, post_ids=None, user_id=None):
+        """Untags the given posts, or every post by the given user, in one statement, returns how many were untagged"""
+
+        if user_id is not None:
+            posts = PostTag.post_id.in_(db.select([Post.id]).where(Post.user_id == user_id))
+        else:
+            posts = id_in(PostTag.post_id, post_ids or [])
+        statement = PostTag.__table__.delete().where(
+            db.and_(PostTag.tag_id == self.id, posts))
+        return db.session.execute(statement).rowcount
+
+    @classmethod
+    def search(cls, prefix, limit=10):
+        """Returns up to limit tags whose name starts with prefix, ignoring case, shortest first"""
+
+        pattern = f'{escape_like(prefix.lower())}%'
+        return (cls.query
+                .filter(db.func.lower(cls.name).like(pattern, escape='\\'))
+                .order_by(db.func.length(cls.name), db.func.lower(cls.name))
+                .limit(limit)
+                .all())
+
+def month_bounds(year, month):
+    """Returns the start of a month and the start of the month after, in UTC"""
+
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start, end
+
+
+def id_in(column, ids):
+    """SQL condition for column being one of ids, as a single array parameter on Postgres"""
+
+    if db.engine.dialect.name != 'postgresql':
+        return column.in_(ids)
+    return column == db.any_(db.bindparam(None, list(ids), type_=postgresql.ARRAY(db.Integer)))
+
+
+# User.search relies on pg_trgm, which needs to exist before its indexes are made
+event.listen(db.metadata, 'before_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm'
+).execute_if(dialect='postgresql'))
+
+# Indexes on tables too busy to lock while they are built. create_all only builds
+# them along with their table, while it is empty, and existing databases build them
+# with `flask build-indexes`, which does so concurrently, see migrations.py.
+CONCURRENT_INDEXES = {
+    # Post.archive reads a range of created_at and only the columns the archive list
+    # shows, so on Postgres it is an index-only scan of the month's slice of this index
+    'ix_post_archive': 'post (created_at, id) INCLUDE (title, version)',
+    # Lets User.search match any part of a name, needs pg_trgm
+    'ix_users_full_name_trgm': "users USING gin ((first_name || ' ' || last_name) gin_trgm_ops)",
+    # Lets Tag.search use an index for any prefix length
+    'ix_tag_name_prefix': 'tag (lower(name) text_pattern_ops)',
+}
+
+
+
+def build_with_tables(indexes):
+    """Makes create_all build each index right after creating its table, the table named first in its definition"""
+
+    for name, definition in indexes.items():
+        event.listen(db.metadata.tables[definition.split()[0]], 'after_create', DDL(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {definition}'
+        ).execute_if(dialect='postgresql'))
+
+
+build_with_tables(CONCURRENT_INDEXES)
+
+# Indexes that have been dropped, from databases that built them before that
+DROPPED_INDEXES = [
+    # post.views is rewritten every VIEWS_FLUSH_INTERVAL, and with an index on it none of
+    # those updates could be HOT, each one adding entries to every index on post. The most
+    # viewed listing sorts the posts instead, which is why it is low priority for admission.
+    'ix_post_views',
+]
+
+# Columns added to tables after they were first deployed. create_all makes them along
+# with a new table, and existing databases add them with `flask add-columns`, see
+# migrations.py, as (table, column, definition).
+ADDED_COLUMNS = [
+    # Versioned's column, on the tables created before it existed
+    ('users', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('post', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('tag', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('post', 'views', 'BIGINT NOT NULL DEFAULT 0'),
+]
+
 class PostTag(db.Model):
     """PostTag"""
 
     __tablename__="post_tag"
 
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True)
\ No newline at end of file
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+
+class RelatedPost(db.Model):
+    """Precomputed related post, ranked by how many tags the two posts share"""
+
+    __tablename__ = "related_post"
+
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    related_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False, index=True)
+    shared_tags = db.Column(db.Integer, nullable=False)
+
+
+class TagPair(db.Model):
+    """How many posts carry both tags, built by analytics.py"""
+
+    __tablename__ = "tag_pair"
+
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    posts = db.Column(db.Integer, nullable=False, index=True)
+
+    tag = db.relationship('Tag', foreign_keys=[tag_id], lazy=LAZY)
+    other = db.relationship('Tag', foreign_keys=[other_id], lazy=LAZY)
+
+
+class TagMonth(db.Model):
+    """How many posts made in a month carry the tag, built by analytics.py"""
+
+    __tablename__ = "tag_month"
+
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)
+    posts = db.Column(db.Integer, nullable=False)
+
+
+class TagSizeBucket(db.Model):
+    """How many tags have between min_posts and max_posts posts, built by analytics.py"""
+
+    __tablename__ = "tag_size_bucket"
+
+    min_posts = db.Column(db.Integer, primary_key=True)
+    max_posts = db.Column(db.Integer, nullable=False)
+    tags = db.Column(db.Integer, nullable=False)
+
+
+class FeedStamp(db.Model):
+    """Token naming the current version of a cached feed or sitemap, replaced when it goes stale, see feeds.py"""
+
+    __tablename__ = "feed_stamp"
+
+    document = db.Column(db.String(), primary_key=True)
+    token = db.Column(db.String(32), nullable=False)
+
+
+class Job(db.Model):
+    """Background job"""
+
+    __tablename__ = "job"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(16), nullable=False,
+                       default='queued', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    error = db.Column(db.String())
+    run_at = db.Column(db.TIMESTAMP(timezone=True),
+                       nullable=False, default=datetime.utcnow, index=True)
+    locked_at = db.Column(db.TIMESTAMP(timezone=True))
+    created_at = db.Column(db.TIMESTAMP(timezone=True),
+                           nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.TIMESTAMP(timezone=True))
+
+    def to_dict(self):
+        """Returns the job status as a dictionary suitable for JSON"""
+
+        return {'id': self.id, 'kind': self.kind, 'status': self.status,
+                'attempts': self.attempts, 'progress': self.progress, 'error': self.error}
@@ -0,0 +1,174 @@
+"""Object cache for Blogly.
+
+Users and tags change rarely but are looked up by primary key on almost every
+page. get, get_or_404 and get_many keep each row's column values in a
+per-worker LRU for OBJECT_CACHE_TTL seconds and hand out instances attached to
+the current session without querying. Nothing is eager-loaded on them, so
+routes query related rows such as a user's posts themselves. At most
+OBJECT_CACHE_MAX_ENTRIES rows are kept.
+
+Routes that change a user or tag call invalidate once they have committed.
+That only reaches the worker handling the request, other workers see the
+change once their copy expires, so OBJECT_CACHE_TTL is how stale a page can be.
+Those routes also purge the row's surrogate key again after OBJECT_CACHE_TTL,
+so a proxy that cached a stale page from another worker drops it too.
+Routes that modify what they load should keep using Model.query.
+
+Lookups are counted in blogly_object_cache_lookups_total by model and result,
+and stats() reports this worker's hit ratio.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+from flask import abort, current_app
+from prometheus_client import Counter
+from sqlalchemy.orm import make_transient_to_detached
+from models import db, id_in
+
+LOOKUPS = Counter('blogly_object_cache_lookups_total',
+                  'Object cache lookups by primary key', ['model', 'result'])
+
+
+class ObjectCache:
+    """LRU of row values keyed by table and primary key, each expiring ttl seconds after it was stored"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the values cached for key, or None if there are none or they expired"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, values):
+        """Caches the values for key, evicting the least recently used rows to stay within max_entries"""
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic() + self.ttl, values)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drops the values cached for key"""
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Drops every row and resets the counts"""
+
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Returns the hit, miss and eviction counts, the hit ratio and the number of cached rows"""
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0, 'size': len(self.entries)}
+
+
+def cache_key(model, ident):
+    """Returns the cache key of a row"""
+
+    return (model.__tablename__, ident)
+
+
+def row_values(obj):
+    """Returns the column values of a loaded instance"""
+
+    return {attr.key: getattr(obj, attr.key) for attr in db.inspect(obj).mapper.column_attrs}
+
+
+def attach(model, values):
+    """Makes an instance from cached values and adds it to the session as if it had been loaded"""
+
+    obj = model(**values)
+    make_transient_to_detached(obj)
+    return db.session.merge(obj, load=False)
+
+
+def get(model, ident):
+    """Returns the instance of model with the primary key ident, from the cache if possible, or None"""
+
+    cache = current_app.extensions['object_cache']
+    values = cache.get(cache_key(model, ident))
+    if values is not None:
+        LOOKUPS.labels(model.__name__, 'hit').inc()
+        return attach(model, values)
+
+    LOOKUPS.labels(model.__name__, 'miss').inc()
+    obj = model.query.get(ident)
+    if obj is not None:
+        cache.set(cache_key(model, ident), row_values(obj))
+    return obj
+
+
+def get_or_404(model, ident):
+    """Like get, but aborts with a 404 if there is no such row"""
+
+    obj = get(model, ident)
+    if obj is None:
+        abort(404)
+    return obj
+
+
+def get_many(model, idents):
+    """Returns the instances of model with the given primary keys in the same order, skipping missing ones
+
+    Rows that are not cached are loaded with a single query."""
+
+    cache = current_app.extensions['object_cache']
+    found = {}
+    missing = []
+    for ident in idents:
+        values = cache.get(cache_key(model, ident))
+        if values is None:
+            missing.append(ident)
+        else:
+            found[ident] = attach(model, values)
+    LOOKUPS.labels(model.__name__, 'hit').inc(len(found))
+    LOOKUPS.labels(model.__name__, 'miss').inc(len(missing))
+
+    if missing:
+        for obj in model.query.filter(id_in(model.id, missing)):
+            cache.set(cache_key(model, obj.id), row_values(obj))
+            found[obj.id] = obj
+    return [found[ident] for ident in idents if ident in found]
+
+
+def invalidate(model, ident):
+    """Drops a row from this worker's cache, call after committing a change to it"""
+
+    current_app.extensions['object_cache'].invalidate(cache_key(model, ident))
+
+
+def init_object_cache(app):
+    """Adds the object cache to the app"""
+
+    app.config.setdefault('OBJECT_CACHE_MAX_ENTRIES', 10000)
+    app.config.setdefault('OBJECT_CACHE_TTL', 60)
+    app.extensions['object_cache'] = ObjectCache(
+        app.config['OBJECT_CACHE_MAX_ENTRIES'], app.config['OBJECT_CACHE_TTL'])
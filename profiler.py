@@ -0,0 +1,106 @@
+"""Opt-in sampling profiler for Blogly requests.
+
+When PROFILER_ENABLED is set, a request is profiled if it carries an
+X-Blogly-Profile header signed with the app's SECRET_KEY in the last
+DEBUG_TOKEN_MAX_AGE seconds, see `flask profile-token`, or if it is picked by
+PROFILER_SAMPLE_RATE. A background thread samples the request thread's stack
+and the result is written to PROFILER_DIR in collapsed stack format, one
+"frame;frame;frame count" line per stack, ready for flamegraph.pl or speedscope.
+"""
+
+from collections import Counter
+import os
+import random
+import sys
+import threading
+import time
+
+import click
+from flask import g, request
+from signed_headers import SignedHeader
+
+TOKEN = SignedHeader('X-Blogly-Profile', 'blogly-profiler', b'profile')
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of another thread at a fixed interval"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stops sampling and waits for the thread to finish"""
+
+        self._done.set()
+        self.join()
+
+
+def wants_profile(app):
+    """Checks whether the current request should be profiled"""
+
+    if TOKEN.is_signed(app.config['SECRET_KEY'], app.config['DEBUG_TOKEN_MAX_AGE']):
+        return True
+    rate = app.config.get('PROFILER_SAMPLE_RATE', 0.0)
+    return rate > 0 and random.random() < rate
+
+
+def write_profile(directory, endpoint, stacks):
+    """Writes collapsed stacks for an endpoint to the profile directory, returns the path"""
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(
+        directory, f'{endpoint}.{int(time.time() * 1000)}.{os.getpid()}.folded')
+    with open(path, 'w') as file:
+        for stack, count in stacks.most_common():
+            file.write(f'{stack} {count}\n')
+    return path
+
+
+def init_profiler(app):
+    """Registers the profiler hooks and CLI command on the app"""
+
+    app.config.setdefault('PROFILER_ENABLED', False)
+    app.config.setdefault('PROFILER_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILER_INTERVAL', 0.005)
+    app.config.setdefault('PROFILER_DIR', 'profiles')
+    app.config.setdefault('DEBUG_TOKEN_MAX_AGE', 3600)
+
+    @app.before_request
+    def start_profiler():
+        if not app.config['PROFILER_ENABLED'] or not wants_profile(app):
+            return
+        g.profiler = Sampler(threading.get_ident(),
+                             app.config['PROFILER_INTERVAL'])
+        g.profiler.start()
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        sampler = g.pop('profiler', None)
+        if sampler is None:
+            return
+        sampler.stop()
+        write_profile(app.config['PROFILER_DIR'],
+                      request.endpoint or 'unknown', sampler.stacks)
+
+    @app.cli.command('profile-token')
+    def profile_token():
+        """Prints the header that turns on profiling for a request"""
+
+        click.echo(TOKEN.describe(app.config['SECRET_KEY'], app.config['DEBUG_TOKEN_MAX_AGE']))
@@ -0,0 +1,144 @@
+"""Related posts for Blogly.
+
+Two posts are related by the number of tags they share. With A the post-tag
+incidence matrix, A @ A.T holds that count for every pair of posts, so the
+related_post table is built by multiplying sparse matrices a chunk of posts at
+a time and keeping the top RELATED_POSTS of each row. When tags change, only
+the posts whose counts can have changed are recomputed, by the refresh_related
+job. Showing a post's related posts is then a single lookup on related_post.
+"""
+
+import click
+import numpy as np
+from scipy import sparse
+
+from jobs import handler
+from models import db, Post, PostTag, RelatedPost, id_in
+
+# How many related posts to keep for each post
+RELATED_POSTS = 5
+
+
+def incidence(post_ids, tag_ids):
+    """Builds the sparse post-tag incidence matrix from post_tag rows, returns it with the post id of each row"""
+
+    posts, rows = np.unique(post_ids, return_inverse=True)
+    _, columns = np.unique(tag_ids, return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)),
+                               shape=(len(posts), columns.max() + 1 if len(columns) else 0))
+    return matrix, posts
+
+
+def top_related(shared, row_posts, column_posts, k):
+    """Picks the k posts sharing the most tags with each row of a shared-tag count matrix
+
+    Ties go to the newer post. Returns arrays of post id, related id, shared tags and rank."""
+
+    shared = shared.tocoo()
+    posts = row_posts[shared.row]
+    related = column_posts[shared.col]
+    counts = shared.data
+    others = posts != related
+    posts, related, counts = posts[others], related[others], counts[others]
+
+    order = np.lexsort((-related, -counts, posts))
+    posts, related, counts = posts[order], related[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, posts[1:] != posts[:-1]]) if len(posts) else np.array([], dtype=int)
+    rank = np.arange(len(posts)) - np.repeat(starts, np.diff(np.r_[starts, len(posts)]))
+    keep = rank < k
+    return posts[keep], related[keep], counts[keep], rank[keep]
+
+
+def load_post_tags(tag_ids=None):
+    """Loads post_tag as two arrays, only the rows for tag_ids if given"""
+
+    query = db.session.query(PostTag.post_id, PostTag.tag_id)
+    if tag_ids is not None:
+        query = query.filter(id_in(PostTag.tag_id, tag_ids))
+    rows = np.array(query.all(), dtype=np.int64).reshape(-1, 2)
+    return rows[:, 0], rows[:, 1]
+
+
+def store_related(post_ids, posts, related, counts, rank):
+    """Replaces the related posts of post_ids with the given rows"""
+
+    if len(post_ids):
+        RelatedPost.query.filter(id_in(RelatedPost.post_id, [int(post_id) for post_id in post_ids])).delete(
+            synchronize_session=False)
+    if len(posts):
+        db.session.execute(RelatedPost.__table__.insert(), [
+            {'post_id': int(post), 'related_id': int(other), 'shared_tags': int(count), 'rank': int(position)}
+            for post, other, count, position in zip(posts, related, counts, rank)])
+
+
+def rebuild_related(k=RELATED_POSTS, chunk_size=5000):
+    """Recomputes the related posts of every post"""
+
+    RelatedPost.query.delete(synchronize_session=False)
+    matrix, posts = incidence(*load_post_tags())
+    transposed = matrix.T.tocsc()
+    for start in range(0, len(posts), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        store_related([], *top_related(matrix[chunk] @ transposed, posts[chunk], posts, k))
+        db.session.commit()
+    db.session.commit()
+
+
+def refresh_related(post_ids=(), tag_ids=(), k=RELATED_POSTS, chunk_size=5000):
+    """Recomputes the related posts of post_ids and of every post tagged with one of tag_ids, a chunk of posts at a time"""
+
+    affected = set(post_ids)
+    if tag_ids:
+        affected.update(post_id for (post_id,) in db.session.query(PostTag.post_id)
+                        .filter(id_in(PostTag.tag_id, list(tag_ids))).distinct())
+    if not affected:
+        return
+
+    # Only tags of the affected posts can contribute to their counts
+    tags = [tag_id for (tag_id,) in db.session.query(PostTag.tag_id)
+            .filter(id_in(PostTag.post_id, list(affected))).distinct()]
+    matrix, posts = incidence(*load_post_tags(tags))
+    rows = np.flatnonzero(np.isin(posts, list(affected)))
+    # Affected posts left without tags have no row, they only lose their related posts
+    store_related(sorted(affected - set(posts[rows].tolist())), [], [], [], [])
+    # A popular tag affects most posts, so the product is taken in slices as in rebuild_related
+    transposed = matrix.T.tocsc()
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        store_related(posts[chunk], *top_related(matrix[chunk] @ transposed, posts[chunk], posts, k))
+    db.session.commit()
+
+
+def related_posts(post_id):
+    """Returns the posts related to a post, most related first"""
+
+    return (Post.query
+            .join(RelatedPost, RelatedPost.related_id == Post.id)
+            .filter(RelatedPost.post_id == post_id)
+            .order_by(RelatedPost.rank)
+            .all())
+
+
+@handler('refresh_related')
+def refresh_related_job(job, post_ids=(), tag_ids=()):
+    """Recomputes related posts after tags changed"""
+
+    refresh_related(post_ids, tag_ids)
+
+
+@handler('rebuild_related')
+def rebuild_related_job(job):
+    """Recomputes the related posts of every post"""
+
+    rebuild_related()
+
+
+def init_related(app):
+    """Registers the command that rebuilds every post's related posts"""
+
+    @app.cli.command('rebuild-related')
+    def rebuild_related_command():
+        """Recomputes the related posts of every post"""
+
+        rebuild_related()
+        click.echo(f'Rebuilt related posts, {RelatedPost.query.count()} rows')
@@ -0,0 +1,44 @@
+"""Signed request headers that unlock Blogly's debugging features.
+
+The profiler and /debug/memory are turned on per request by a header whose
+value is signed with the app's SECRET_KEY, so anyone who can run the app's CLI
+can make one and nobody else can. Each feature signs with its own salt, so a
+header for one does not unlock the other. Headers carry the time they were
+made and stop working DEBUG_TOKEN_MAX_AGE seconds later, so one that leaks
+into a log or a proxy trace does not unlock anything for long.
+"""
+
+from flask import request
+from itsdangerous import BadSignature, TimestampSigner
+
+
+class SignedHeader:
+    """A request header carrying a value signed with the app's SECRET_KEY and the time it was signed"""
+
+    def __init__(self, name, salt, value):
+        self.name = name
+        self.salt = salt
+        self.value = value
+
+    def make_token(self, secret_key):
+        """Makes the value of the header"""
+
+        return TimestampSigner(secret_key, salt=self.salt).sign(self.value).decode()
+
+    def describe(self, secret_key, max_age):
+        """Returns the header as a line to paste into a request and how long it works, as printed by the token
+        commands"""
+
+        return f'{self.name}: {self.make_token(secret_key)}\nValid for {max_age} seconds'
+
+    def is_signed(self, secret_key, max_age):
+        """Checks whether the current request carries a correctly signed header made at most max_age seconds ago"""
+
+        token = request.headers.get(self.name)
+        if not token:
+            return False
+        try:
+            TimestampSigner(secret_key, salt=self.salt).unsign(token, max_age=max_age)
+        except BadSignature:
+            return False
+        return True
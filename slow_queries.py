@@ -0,0 +1,183 @@
+"""Slow-query log for Blogly.
+
+Any statement slower than SLOW_QUERY_THRESHOLD seconds is handed to a
+background thread, which collects a plan for it on its own connection, so the
+request that ran the query does not wait. Reads get an EXPLAIN (ANALYZE,
+BUFFERS) plan, which runs them again. Writes only get a plain EXPLAIN, as
+running an UPDATE or DELETE again would take its row locks a second time, and
+every plan is collected inside a transaction that is rolled back regardless.
+
+Each worker appends its records as JSON lines to its own file next to
+SLOW_QUERY_LOG, slow_queries.<pid>.log by default, which rotates once it
+reaches SLOW_QUERY_MAX_BYTES. Workers sharing one file would each rotate it
+under the others. `flask slow-queries` reads the files of every worker.
+"""
+
+from datetime import datetime
+import glob
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import queue
+import time
+
+import click
+from flask import has_request_context, request
+from background import ProcessThread
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class SlowQueryRecorder:
+    """Explains slow statements and writes them to the rotating log off the request path"""
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = queue.Queue(maxsize=1000)
+        self.handler = None
+        self.path = None
+        self.thread = ProcessThread(self.run, 'slow-query-writer')
+
+    def record(self, engine, statement, parameters, duration):
+        """Queues a slow statement to be explained and logged, drops it if the queue is full"""
+
+        record = {
+            'at': datetime.utcnow().isoformat(),
+            'duration': round(duration, 6),
+            'endpoint': request.endpoint if has_request_context() else None,
+            'statement': statement,
+            'parameters': parameters,
+        }
+        # Only started once a query is slow, so nothing runs while SLOW_QUERY_THRESHOLD is unset
+        self.thread.start()
+        try:
+            self.pending.put_nowait((engine, record))
+        except queue.Full:
+            pass
+
+    def flush(self):
+        """Waits until every queued statement has been written"""
+
+        self.pending.join()
+
+    def run(self):
+        while True:
+            engine, record = self.pending.get()
+            try:
+                record['plan'] = explain(
+                    engine, record['statement'], record['parameters'])
+                self.write(record)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'Could not record slow query')
+            finally:
+                self.pending.task_done()
+
+    def write(self, record):
+        """Appends a record to this worker's log, reopening it if the configured path has changed"""
+
+        config = self.app.config
+        path = worker_path(config['SLOW_QUERY_LOG'], os.getpid())
+        if self.path != path:
+            if self.handler is not None:
+                self.handler.close()
+            self.path = path
+            self.handler = RotatingFileHandler(self.path, maxBytes=config['SLOW_QUERY_MAX_BYTES'],
+                                               backupCount=config['SLOW_QUERY_BACKUPS'])
+        self.handler.emit(logging.makeLogRecord(
+            {'msg': json.dumps(record, default=str)}))
+
+
+def worker_path(path, pid):
+    """Returns the log file of one worker, its pid added before the extension of SLOW_QUERY_LOG"""
+
+    root, extension = os.path.splitext(path)
+    return f'{root}.{pid}{extension}'
+
+
+def explain_command(statement):
+    """Returns the EXPLAIN to run for a statement, which only runs it again if it is a read"""
+
+    if statement.lstrip().upper().startswith('SELECT'):
+        return 'EXPLAIN (ANALYZE, BUFFERS)'
+    return 'EXPLAIN'
+
+
+def explain(engine, statement, parameters):
+    """Returns the plan for a statement, or None if the database has no such thing"""
+
+    if engine.dialect.name != 'postgresql':
+        return None
+    # An executemany is explained using its first set of parameters
+    if isinstance(parameters, list) and parameters:
+        parameters = parameters[0]
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            rows = conn.execute(
+                f'{explain_command(statement)} {statement}', parameters)
+            return '\n'.join(row[0] for row in rows)
+        finally:
+            transaction.rollback()
+
+
+def read_records(path):
+    """Reads the records from the logs of every worker and their rotated backups, oldest first"""
+
+    root, extension = os.path.splitext(path)
+    records = []
+    for name in glob.glob(f'{glob.escape(root)}.*{glob.escape(extension)}*'):
+        with open(name) as file:
+            records.extend(json.loads(line) for line in file if line.strip())
+    records.sort(key=lambda record: record['at'])
+    return records
+
+
+def init_slow_queries(app):
+    """Registers the slow-query listeners and CLI command on the app"""
+
+    app.config.setdefault('SLOW_QUERY_THRESHOLD', None)
+    app.config.setdefault('SLOW_QUERY_LOG', 'slow_queries.log')
+    app.config.setdefault('SLOW_QUERY_MAX_BYTES', 10 * 1024 * 1024)
+    app.config.setdefault('SLOW_QUERY_BACKUPS', 5)
+
+    recorder = SlowQueryRecorder(app)
+    app.extensions['slow_queries'] = recorder
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def check_query_time(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['slow_query_start'].pop()
+        threshold = app.config['SLOW_QUERY_THRESHOLD']
+        if threshold is None or duration < threshold or statement.startswith('EXPLAIN'):
+            return
+        recorder.record(conn.engine, statement, parameters, duration)
+
+    @event.listens_for(Engine, 'handle_error')
+    def discard_query_timer(context):
+        starts = context.connection.info.get('slow_query_start')
+        if starts:
+            starts.pop()
+
+    @app.cli.command('slow-queries')
+    @click.option('--limit', default=20, help='How many of the slowest queries to show')
+    @click.option('--endpoint', default=None, help='Only show queries from this endpoint')
+    @click.option('--plans/--no-plans', default=False, help='Show the EXPLAIN plan of each query')
+    def show_slow_queries(limit, endpoint, plans):
+        """Shows the slowest queries in the slow-query log"""
+
+        records = read_records(app.config['SLOW_QUERY_LOG'])
+        if endpoint:
+            records = [record for record in records if record['endpoint'] == endpoint]
+        records.sort(key=lambda record: record['duration'], reverse=True)
+        for record in records[:limit]:
+            click.echo(f"{record['duration'] * 1000:9.1f} ms  {record['at']}  {record['endpoint']}")
+            click.echo(f"    {' '.join(record['statement'].split())}")
+            click.echo(f"    parameters: {record['parameters']}")
+            if plans and record.get('plan'):
+                for line in record['plan'].splitlines():
+                    click.echo(f'    | {line}')
@@ -0,0 +1,20 @@
+// Reloads the page when one of its posts changes, once the reader turns live updates on.
+// Streams are only opened on request as each one holds a server thread, see events.py
+document.querySelectorAll('[data-live-posts]').forEach(function (button) {
+    button.addEventListener('click', function () {
+        button.disabled = true;
+        const source = new EventSource(button.dataset.livePosts);
+        ['created', 'updated', 'deleted'].forEach(function (kind) {
+            source.addEventListener(kind, function () {
+                source.close();
+                window.location.reload();
+            });
+        });
+        // A busy server answers 503, which EventSource does not retry, so let the reader try again
+        source.addEventListener('error', function () {
+            if (source.readyState === EventSource.CLOSED) {
+                button.disabled = false;
+            }
+        });
+    });
+});
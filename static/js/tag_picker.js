@@ -0,0 +1,53 @@
+// Autocompletes tags on the post forms from /tags/search, adding a checked box for each chosen tag
+document.querySelectorAll('[data-tag-picker]').forEach(function (input) {
+    const picker = document.getElementById(input.dataset.tagPicker);
+    const options = document.getElementById(input.getAttribute('list'));
+    let found = {};
+
+    input.addEventListener('input', function () {
+        const name = input.value;
+        if (name in found) {
+            addTag(found[name], name);
+            input.value = '';
+            return;
+        }
+        if (!name) {
+            return;
+        }
+        fetch('/tags/search?q=' + encodeURIComponent(name))
+            .then(function (resp) { return resp.json(); })
+            .then(function (tags) {
+                found = {};
+                options.innerHTML = '';
+                tags.forEach(function (tag) {
+                    found[tag.name] = tag.id;
+                    const option = document.createElement('option');
+                    option.value = tag.name;
+                    options.appendChild(option);
+                });
+            });
+    });
+
+    function addTag(id, name) {
+        if (document.getElementById(id)) {
+            document.getElementById(id).checked = true;
+            return;
+        }
+        const div = document.createElement('div');
+        div.className = 'form-check';
+        const box = document.createElement('input');
+        box.type = 'checkbox';
+        box.className = 'form-check-input';
+        box.name = 'tags';
+        box.id = id;
+        box.value = id;
+        box.checked = true;
+        const label = document.createElement('label');
+        label.htmlFor = id;
+        label.className = 'form-check-label';
+        label.textContent = name;
+        div.appendChild(box);
+        div.appendChild(label);
+        picker.appendChild(div);
+    }
+});
@@ -0,0 +1,242 @@
+"""Surrogate keys for a caching proxy in front of Blogly.
+
+Every successful GET response carries a SURROGATE_KEY_HEADER naming the rows
+it was rendered from, user-3, post-17 or tag-5, collected as the request loads
+them from the database or the object cache. Pages listing every row of a kind
+also carry users, posts or tags, which are purged when a row is created or
+deleted. A page that would name more than SURROGATE_MAX_KEYS rows of a kind
+carries user-any, post-any or tag-any instead, which is purged along with any
+row of that kind.
+
+Write routes call purge with the keys they made stale once they have
+committed. Keys are gathered per worker and POSTed to SURROGATE_PURGE_URL as
+{"surrogate_keys": [...]} by a background thread every
+SURROGATE_PURGE_INTERVAL seconds, SURROGATE_PURGE_BATCH keys per request, with
+SURROGATE_PURGE_HEADERS added for authentication. Without a purge URL nothing
+is sent.
+
+Edits to users and tags are purged a second time once OBJECT_CACHE_TTL has
+passed. Other workers may still hold the old row in their object cache, see
+object_cache.py, and render it into the page the proxy fetches after the first
+purge. By the second one every such copy has expired. A worker that exits
+before the second purge is due sends it early on its way out. `flask purge-stub` runs a local endpoint that prints what it is sent.
+"""
+
+import atexit
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+import urllib.request
+
+import click
+from flask import current_app, g, has_request_context, request
+from background import ProcessThread
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+# Key prefix of each table whose rows are named in keys
+PREFIXES = {'users': 'user', 'post': 'post', 'tag': 'tag'}
+
+
+def add_keys(*keys):
+    """Adds keys to the response of the current request"""
+
+    g.setdefault('surrogate_keys', set()).update(keys)
+
+
+@event.listens_for(Session, 'loaded_as_persistent')
+@event.listens_for(Session, 'detached_to_persistent')
+def record_row(session, instance):
+    """Names each row a request loads, whether from a query or from the object cache"""
+
+    prefix = PREFIXES.get(getattr(instance, '__tablename__', None))
+    if prefix is not None and has_request_context():
+        # Merged instances get their values after this event, their identity before it
+        add_keys(f'{prefix}-{inspect(instance).identity[0]}')
+
+
+def response_keys(keys, max_keys):
+    """Returns the keys to send for a page, collapsing kinds with more than max_keys rows into their -any key"""
+
+    rows = {}
+    others = set()
+    for key in keys:
+        prefix, _, ident = key.rpartition('-')
+        if prefix in PREFIXES.values() and ident.isdigit():
+            rows.setdefault(prefix, set()).add(key)
+        else:
+            others.add(key)
+    for prefix, named in rows.items():
+        others |= named if len(named) <= max_keys else {f'{prefix}-any'}
+    return sorted(others)
+
+
+def purge_keys(keys):
+    """Adds the -any key of the kind of every row key, so pages that collapsed their keys are purged too"""
+
+    expanded = set(keys)
+    for key in keys:
+        prefix, _, ident = key.rpartition('-')
+        if prefix in PREFIXES.values() and ident.isdigit():
+            expanded.add(f'{prefix}-any')
+    return expanded
+
+
+class Purger:
+    """Gathers keys to purge and sends them to the purge endpoint in batches"""
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = set()
+        # Heap of (when, keys) to purge again once when has passed
+        self.delayed = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = ProcessThread(self.run, 'surrogate-purger')
+
+    def add(self, keys, again_after=None):
+        """Queues keys to be purged, and purged again again_after seconds later if given"""
+
+        if not self.app.config['SURROGATE_PURGE_URL']:
+            return
+        with self.lock:
+            self.pending |= purge_keys(keys)
+            if again_after is not None:
+                heapq.heappush(self.delayed, (time.monotonic() + again_after, sorted(purge_keys(keys))))
+            full = len(self.pending) >= self.app.config['SURROGATE_PURGE_BATCH']
+        self.start()
+        if full:
+            self.wakeup.set()
+
+    def start(self):
+        """Starts the sending thread unless this process already has one, forked workers each start their own"""
+
+        if self.app.config['SURROGATE_PURGE_INTERVAL']:
+            self.thread.start()
+
+    def run(self):
+        """Sends the pending keys every SURROGATE_PURGE_INTERVAL seconds, or sooner when woken"""
+
+        while True:
+            self.wakeup.wait(self.app.config['SURROGATE_PURGE_INTERVAL'])
+            self.wakeup.clear()
+            self.flush_quietly()
+
+    def flush(self, final=False):
+        """Sends the pending keys and the delayed ones that are due, or all of them if final, returns how many
+        requests it took
+
+        Keys whose request fails are put back to be retried by the next flush."""
+
+        with self.lock:
+            now = time.monotonic()
+            while self.delayed and (final or self.delayed[0][0] <= now):
+                self.pending.update(heapq.heappop(self.delayed)[1])
+            keys, self.pending = sorted(self.pending), set()
+        size = self.app.config['SURROGATE_PURGE_BATCH']
+        sent = 0
+        for start in range(0, len(keys), size):
+            try:
+                self.send(keys[start:start + size])
+            except Exception:
+                with self.lock:
+                    self.pending.update(keys[start:])
+                raise
+            sent += 1
+        return sent
+
+    def flush_quietly(self, final=False):
+        """Flushes from outside a request, logging rather than raising errors"""
+
+        try:
+            self.flush(final)
+        except Exception:
+            self.app.logger.exception('Could not purge surrogate keys')
+
+    def send(self, keys):
+        """POSTs one batch of keys to the purge endpoint"""
+
+        body = json.dumps({'surrogate_keys': keys}).encode()
+        headers = dict(self.app.config['SURROGATE_PURGE_HEADERS'], **{'Content-Type': 'application/json'})
+        purge = urllib.request.Request(self.app.config['SURROGATE_PURGE_URL'], data=body,
+                                       headers=headers, method='POST')
+        with urllib.request.urlopen(purge, timeout=self.app.config['SURROGATE_PURGE_TIMEOUT']) as resp:
+            resp.read()
+
+
+def purge(*keys, again_after=None):
+    """Purges pages carrying any of keys from the proxy, call after committing the change
+
+    With again_after, the keys are purged a second time that many seconds later."""
+
+    current_app.extensions['surrogate_purger'].add(keys, again_after)
+
+
+class PurgeStub(ThreadingHTTPServer):
+    """Purge endpoint that keeps what it is sent in purges, for tests and local development"""
+
+    def __init__(self, port=0, echo=False):
+        self.purges = []
+        self.echo = echo
+        super().__init__(('127.0.0.1', port), PurgeStubHandler)
+
+    @property
+    def url(self):
+        """The URL to set SURROGATE_PURGE_URL to"""
+
+        return f'http://127.0.0.1:{self.server_address[1]}/purge'
+
+    def start(self):
+        """Serves from a background thread"""
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class PurgeStubHandler(BaseHTTPRequestHandler):
+    """Records the keys of each purge request"""
+
+    def do_POST(self):
+        keys = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['surrogate_keys']
+        self.server.purges.append(keys)
+        if self.server.echo:
+            print('Purge', ' '.join(keys), flush=True)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def init_surrogate(app):
+    """Registers the surrogate key hook and the purge stub command on the app"""
+
+    app.config.setdefault('SURROGATE_KEY_HEADER', 'Surrogate-Key')
+    app.config.setdefault('SURROGATE_MAX_KEYS', 200)
+    app.config.setdefault('SURROGATE_PURGE_URL', None)
+    app.config.setdefault('SURROGATE_PURGE_HEADERS', {})
+    app.config.setdefault('SURROGATE_PURGE_INTERVAL', 1)
+    app.config.setdefault('SURROGATE_PURGE_BATCH', 256)
+    app.config.setdefault('SURROGATE_PURGE_TIMEOUT', 5)
+    purger = app.extensions['surrogate_purger'] = Purger(app)
+    atexit.register(purger.flush_quietly, final=True)
+
+    @app.after_request
+    def add_surrogate_keys(response):
+        keys = g.get('surrogate_keys')
+        if keys and request.method in ('GET', 'HEAD') and response.status_code == 200:
+            response.headers[app.config['SURROGATE_KEY_HEADER']] = ' '.join(
+                response_keys(keys, app.config['SURROGATE_MAX_KEYS']))
+        return response
+
+    @app.cli.command('purge-stub')
+    @click.option('--port', default=8089, help='Port to listen on')
+    def purge_stub(port):
+        """Runs a purge endpoint that prints the keys it is sent"""
+
+        stub = PurgeStub(port, echo=True)
+        click.echo(f'Set SURROGATE_PURGE_URL={stub.url}')
+        stub.serve_forever()
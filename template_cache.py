@@ -0,0 +1,34 @@
+"""Persistent Jinja bytecode cache for Blogly.
+
+Compiled templates are kept in TEMPLATE_CACHE_DIR so a fresh gunicorn worker
+loads bytecode instead of compiling base.html and friends on its first
+requests. `flask precompile-templates` fills the cache at build time.
+"""
+
+import os
+
+import click
+from jinja2 import FileSystemBytecodeCache
+
+
+def init_template_cache(app):
+    """Gives the app's Jinja environment a bytecode cache and registers the precompile command"""
+
+    app.config.setdefault('TEMPLATE_CACHE_DIR', '.jinja_cache')
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        # Must be set before the environment is first used, which is when Flask creates it
+        app.jinja_options = dict(app.jinja_options,
+                                 bytecode_cache=FileSystemBytecodeCache(directory))
+
+    @app.cli.command('precompile-templates')
+    def precompile_templates():
+        """Compiles every template into the bytecode cache"""
+
+        if app.jinja_env.bytecode_cache is None:
+            raise click.ClickException('TEMPLATE_CACHE_DIR is not set')
+        names = app.jinja_env.list_templates()
+        for name in names:
+            app.jinja_env.get_template(name)
+        click.echo(f'Compiled {len(names)} templates into {app.jinja_env.bytecode_cache.directory}')
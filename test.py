@@ -1,47 +1,91 @@
-from unittest import TestCase
-from app import app, db, User, Post, Tag, PostTag, DEFAULT_IMAGE
+from datetime import date, datetime, timezone
+from flask import Flask, g
+import logging
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+from PIL import Image
+from itsdangerous import TimestampSigner
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy.exc import InvalidRequestError
+
+from testing import DatabaseTestCase, setup_test_database
+
+# Must be set before app is imported, as it connects on import
+os.environ['DATABASE_URL'] = setup_test_database()
+
+from app import app, db, User, Post, Tag, PostTag, RelatedPost, Job, DEFAULT_IMAGE
+from models import FeedStamp, TagPair, TagMonth, TagSizeBucket
+import jobs
+import memory
+import profiler
+import slow_queries
+import compression
+import fragments
+import related
+import admission
+import analytics
+import views
+import object_cache
+import events
+import feeds
+import freeze
+import surrogate
+import migrations
+import background
 
 app.config['TESTING'] = True
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///bloglytest'
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['JOBS_EAGER'] = True
+# Views are flushed by the tests that need them
+app.config['VIEWS_FLUSH_INTERVAL'] = 0
+# Notifications sent inside the rolled back test transactions would never arrive
+app.config['EVENTS_NOTIFY'] = False
+app.config['FEED_CACHE_DIR'] = tempfile.mkdtemp(prefix='blogly-feeds-')
+# Purges are flushed by the tests that need them
+app.config['SURROGATE_PURGE_INTERVAL'] = 0
+app.config['AVATAR_DIR'] = tempfile.mkdtemp(prefix='blogly-avatars-')
 
 TEST_IMAGE = 'https://homepages.cae.wisc.edu/~ece533/images/airplane.png'
 
 
-class FlaskTests(TestCase):
+class FlaskTests(DatabaseTestCase):
     """Tests the routes in app.py"""
 
-    def setUp(self):
-        """Recreates the tables for a fresh start and populates them with a single user and post"""
-
-        # Creates empty tables
-        db.drop_all()
-        db.create_all()
-
-        # Adds a single user
-        new_user = User(first_name='John', last_name='Doe')
-        db.session.add(new_user)
-        db.session.commit()
-
-        # Adds a single post to new_user
-        new_post = Post(title='A Test', content='Testing posts', user_id=1)
-        db.session.add(new_post)
-        db.session.commit()
+    # A single user with a single post, tagged with a single tag
+    fixtures = [
+        (User, [{'id': 1, 'first_name': 'John', 'last_name': 'Doe'}]),
+        (Post, [{'id': 1, 'title': 'A Test', 'content': 'Testing posts', 'user_id': 1}]),
+        (Tag, [{'id': 1, 'name': 'Testing'}]),
+        (PostTag, [{'post_id': 1, 'tag_id': 1}]),
+    ]
 
-        # Adds a single tag
-        new_tag = Tag(name='Testing')
-        db.session.add(new_tag)
-        db.session.commit()
-
-        # Tags 'A Test' as 'Testing'
-        new_post_tag = PostTag(post_id=1, tag_id=1)
-        db.session.add(new_post_tag)
-        db.session.commit()
+    def setUp(self):
+        """Starts each test from just the fixtures"""
+
+        super().setUp()
+        # Ids are reused after each rollback, so cached fragments must go too
+        app.extensions['fragment_cache'].clear()
+        app.extensions['view_counter'].counts.clear()
+        app.extensions['object_cache'].clear()
+        shutil.rmtree(app.config['FEED_CACHE_DIR'], ignore_errors=True)
+        app.extensions['surrogate_purger'].pending.clear()
+        app.extensions['surrogate_purger'].delayed.clear()
+        shutil.rmtree(app.config['AVATAR_DIR'], ignore_errors=True)
+        app.extensions['admission'].wait = 0.0
 
     def tearDown(self):
         """Clear any fouled transactions"""
         db.session.rollback()
+        super().tearDown()
 
     def test_redirect_home_page(self):
         with app.test_client() as client:
@@ -72,6 +116,53 @@ class FlaskTests(TestCase):
             self.assertIn('href="/users/new"', html)
             self.assertNotIn('WARNINGS GO HERE', html)
 
+    def test_search_users(self):
+        with app.test_client() as client:
+            db.session.add_all([User(first_name='Jane', last_name='Doe'),
+                                User(first_name='Bob', last_name='Builder')])
+            db.session.commit()
+
+            resp = client.get('/users/search?q=doe')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<h1>Search Users</h1>', html)
+            self.assertIn('<li><a href="/users/1">John Doe</a></li>', html)
+            self.assertIn('<li><a href="/users/2">Jane Doe</a></li>', html)
+            self.assertNotIn('Bob Builder', html)
+            self.assertNotIn('WARNINGS GO HERE', html)
+
+    def test_search_users_pages(self):
+        with app.test_client() as client:
+            db.session.add_all([User(first_name='John', last_name=f'Doe{i}') for i in range(25)])
+            db.session.commit()
+
+            html = client.get('/users/search?q=john').get_data(as_text=True)
+            self.assertEqual(html.count('<li><a href="/users/'), 20)
+            self.assertIn('href="/users/search?q=john&page=2"', html)
+
+            html2 = client.get('/users/search?q=john&page=2').get_data(as_text=True)
+            self.assertEqual(html2.count('<li><a href="/users/'), 6)
+            self.assertIn('href="/users/search?q=john&page=1"', html2)
+
+    def test_search_users_with_typo(self):
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('Typo tolerance needs pg_trgm')
+        with app.test_client() as client:
+            resp = client.get('/users/search?q=Jhon')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<li><a href="/users/1">John Doe</a></li>', html)
+
+    def test_search_users_no_results(self):
+        with app.test_client() as client:
+            resp = client.get('/users/search?q=zzzzzz')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<li>No users found</li>', html)
+
     def test_user_page(self):
         with app.test_client() as client:
             resp = client.get('/users/1')
@@ -415,9 +506,8 @@ class FlaskTests(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<h1>Add a Post for John Doe</h1>', html)
             self.assertIn('href="/users/1"', html)
-            self.assertIn(
-                '<input type="checkbox" class="form-check-input" name="tags" id="1" value="1">', html)
-            self.assertIn(
+            self.assertIn('id="tag-search"', html)
+            self.assertNotIn(
                 '<label for="1" class="form-check-label">Testing</label>', html)
             self.assertNotIn('WARNINGS GO HERE', html)
             self.assertNotIn(
@@ -445,7 +535,7 @@ class FlaskTests(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, 'http://localhost/users/1')
 
-            post = Post.query.get_or_404(2)
+            post = Post.query.options(db.selectinload(Post.tags)).filter_by(id=2).one()
             post_tags = PostTag.query.all()
             self.assertEqual('More CONTENT!!!', post.content)
             self.assertEqual(len(post.tags), 0)
@@ -469,7 +559,7 @@ class FlaskTests(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, 'http://localhost/users/1')
 
-            post = Post.query.get_or_404(2)
+            post = Post.query.options(db.selectinload(Post.tags)).filter_by(id=2).one()
             post_tags = PostTag.query.all()
             self.assertEqual('More CONTENT!!!', post.content)
             self.assertEqual(len(post.tags), 1)
@@ -588,8 +678,36 @@ class FlaskTests(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<h1>Edit Post</h1>', html)
             self.assertIn('href="/users/1"', html)
+            self.assertIn(
+                '<input type="checkbox" class="form-check-input" name="tags" id="1" value="1" checked>', html)
+            self.assertIn(
+                '<label for="1" class="form-check-label">Testing</label>', html)
+            self.assertIn('id="tag-search"', html)
             self.assertNotIn('WARNINGS GO HERE', html)
 
+    def test_edit_post_form_only_shows_post_tags(self):
+        with app.test_client() as client:
+            new_tag = Tag(name='More Testing')
+            db.session.add(new_tag)
+            db.session.commit()
+
+            resp = client.get('/posts/1/edit')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('>Testing</label>', html)
+            self.assertNotIn('>More Testing</label>', html)
+
+    def test_edit_post_ignores_unknown_tags(self):
+        with app.test_client() as client:
+            resp = client.post('/posts/1/edit', data={'tags': ['1', '7', 'a']})
+
+            self.assertEqual(resp.status_code, 302)
+
+            post_tags = PostTag.query.all()
+            self.assertEqual(len(post_tags), 1)
+            self.assertEqual(post_tags[0].tag_id, 1)
+
     def test_edit_non_post(self):
         with app.test_client() as client:
             resp = client.get('/posts/2/edit')
@@ -1022,6 +1140,32 @@ class FlaskTests(TestCase):
             self.assertIn('href="/tags/1/edit"', html)
             self.assertNotIn('WARNINGS GO HERE', html)
 
+    def test_search_tags(self):
+        with app.test_client() as client:
+            for name in ['Testable', 'Tested 100%', 'Other']:
+                db.session.add(Tag(name=name))
+            db.session.commit()
+
+            resp = client.get('/tags/search?q=tEsT')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([tag['name'] for tag in resp.json],
+                             ['Testing', 'Testable', 'Tested 100%'])
+            self.assertEqual(resp.json[0]['id'], 1)
+
+            resp2 = client.get('/tags/search?q=Tested 100%&limit=1')
+            self.assertEqual([tag['name'] for tag in resp2.json], ['Tested 100%'])
+
+            # A negative LIMIT is an error on Postgres and no limit at all on sqlite
+            resp5 = client.get('/tags/search?q=t&limit=-1')
+            self.assertEqual([tag['name'] for tag in resp5.json], ['Testing'])
+
+            resp3 = client.get('/tags/search?q=%')
+            self.assertEqual(resp3.json, [])
+
+            resp4 = client.get('/tags/search')
+            self.assertEqual(resp4.json, [])
+
     def test_not_tag_page(self):
         with app.test_client() as client:
             resp = client.get('/tags/2')
@@ -1147,6 +1291,55 @@ class FlaskTests(TestCase):
             self.assertIn('href="/tags/new"', html)
             self.assertNotIn('WARNINGS GO HERE', html)
 
+    def test_attach_tag_to_posts(self):
+        with app.test_client() as client:
+            db.session.add_all([Tag(name='Bulk'),
+                                Post(title='Second', content='More', user_id=1)])
+            db.session.commit()
+
+            resp = client.post('/tags/2/attach', json={'posts': [1, 2, 99]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {'tag': 2, 'attached': 2})
+            self.assertEqual(len(PostTag.query.filter_by(tag_id=2).all()), 2)
+
+            # Attaching again changes nothing
+            resp2 = client.post('/tags/2/attach', data={'posts': ['1', '2']})
+            self.assertEqual(resp2.json, {'tag': 2, 'attached': 0})
+
+    def test_attach_tag_to_user_posts(self):
+        with app.test_client() as client:
+            db.session.add(Post(title='Second', content='More', user_id=1))
+            db.session.commit()
+
+            resp = client.post('/tags/1/attach', data={'user': '1'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {'tag': 1, 'attached': 1})
+            self.assertEqual(len(PostTag.query.all()), 2)
+
+    def test_detach_tag(self):
+        with app.test_client() as client:
+            db.session.add(Post(title='Second', content='More', user_id=1))
+            db.session.commit()
+            client.post('/tags/1/attach', data={'user': '1'})
+
+            resp = client.post('/tags/1/detach', json={'posts': [2, 3]})
+            self.assertEqual(resp.json, {'tag': 1, 'detached': 1})
+
+            resp2 = client.post('/tags/1/detach', json={'user': 1})
+            self.assertEqual(resp2.json, {'tag': 1, 'detached': 1})
+            self.assertEqual(len(PostTag.query.all()), 0)
+
+    def test_bulk_tagging_needs_targets(self):
+        with app.test_client() as client:
+            self.assertEqual(client.post('/tags/1/attach').status_code, 400)
+            self.assertEqual(client.post('/tags/1/detach', json={'posts': ['a']}).status_code, 400)
+            self.assertEqual(client.post('/tags/1/attach', json=[1, 2]).status_code, 400)
+            self.assertEqual(client.post('/tags/1/attach', json={'user': True}).status_code, 400)
+            self.assertEqual(client.post('/tags/1/attach', json={'posts': [True]}).status_code, 400)
+            self.assertEqual(client.post('/tags/2/attach', json={'posts': [1]}).status_code, 404)
+
     def test_delete_non_tag(self):
         with app.test_client() as client:
             resp = client.post('/tags/2/delete')
@@ -1158,3 +1351,1304 @@ class FlaskTests(TestCase):
             resp = client.get('/tags/a/delete')
 
             self.assertEqual(resp.status_code, 404)
+
+    ########
+    # Jobs #
+    ########
+
+    def test_delete_user_queued(self):
+        app.config['JOBS_EAGER'] = False
+        try:
+            with app.test_client() as client:
+                resp = client.post('/users/1/delete')
+
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(len(User.query.all()), 1)
+
+                job = Job.query.one()
+                self.assertEqual(job.kind, 'delete_user')
+                self.assertEqual(job.status, 'queued')
+
+                with self.assertLogs('jobs', 'INFO') as logs:
+                    jobs.work(once=True)
+
+                self.assertIn(f'INFO:jobs:Job {job.id} (delete_user) done', logs.output)
+                self.assertEqual(len(User.query.all()), 0)
+                self.assertEqual(len(Post.query.all()), 0)
+                self.assertEqual(len(PostTag.query.all()), 0)
+
+                resp2 = client.get(f'/jobs/{job.id}')
+                self.assertEqual(resp2.status_code, 200)
+                self.assertEqual(resp2.json['status'], 'done')
+                self.assertEqual(resp2.json['progress'], 1.0)
+        finally:
+            app.config['JOBS_EAGER'] = True
+
+    def test_failed_job_is_retried(self):
+        calls = []
+
+        @jobs.handler('flaky')
+        def flaky(job):
+            calls.append(job.attempts)
+            if len(calls) == 1:
+                raise RuntimeError('Try again')
+        self.addCleanup(jobs.HANDLERS.pop, 'flaky')
+
+        with app.app_context():
+            app.config['JOBS_EAGER'] = False
+            try:
+                job = jobs.enqueue('flaky')
+            finally:
+                app.config['JOBS_EAGER'] = True
+
+            self.assertFalse(jobs.run_job(jobs.claim_job()))
+            self.assertEqual(job.status, 'queued')
+            self.assertIn('Try again', job.error)
+
+            # Backoff pushes the retry into the future
+            self.assertIsNone(jobs.claim_job())
+            job.run_at = job.created_at
+            db.session.commit()
+
+            self.assertTrue(jobs.run_job(jobs.claim_job()))
+            self.assertEqual(job.status, 'done')
+            self.assertEqual(calls, [1, 2])
+
+    def test_unknown_job_fails(self):
+        with app.app_context():
+            app.config['JOBS_EAGER'] = False
+            try:
+                job = jobs.enqueue('no_such_job', max_attempts=2)
+            finally:
+                app.config['JOBS_EAGER'] = True
+
+            claimed = jobs.claim_job()
+            self.assertEqual(claimed.id, job.id)
+            self.assertFalse(jobs.run_job(claimed))
+            self.assertEqual(claimed.status, 'failed')
+            self.assertIn('No handler', claimed.error)
+            self.assertIsNone(jobs.claim_job())
+
+    def test_non_job_page(self):
+        with app.test_client() as client:
+            resp = client.get('/jobs/1')
+
+            self.assertEqual(resp.status_code, 404)
+
+    ############
+    # Profiler #
+    ############
+
+    def test_profile_with_signed_header(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['PROFILER_ENABLED'] = True
+            app.config['PROFILER_DIR'] = directory
+            try:
+                with app.test_client() as client:
+                    token = profiler.TOKEN.make_token(app.config['SECRET_KEY'])
+                    resp = client.get('/users', headers={profiler.TOKEN.name: token})
+
+                    self.assertEqual(resp.status_code, 200)
+
+                # The profile is written when the request context is torn down
+                files = os.listdir(directory)
+                self.assertEqual(len(files), 1)
+                self.assertTrue(files[0].startswith('show_users.'))
+                self.assertTrue(files[0].endswith('.folded'))
+            finally:
+                app.config['PROFILER_ENABLED'] = False
+
+    def test_profile_ignores_bad_signature(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['PROFILER_ENABLED'] = True
+            app.config['PROFILER_DIR'] = directory
+            try:
+                with app.test_client() as client:
+                    resp = client.get('/users', headers={profiler.TOKEN.name: 'profile.forged'})
+
+                    self.assertEqual(resp.status_code, 200)
+
+                self.assertEqual(os.listdir(directory), [])
+            finally:
+                app.config['PROFILER_ENABLED'] = False
+
+    ###########
+    # Metrics #
+    ###########
+
+    def test_metrics_page(self):
+        with app.test_client() as client:
+            client.get('/users/1')
+            resp = client.get('/metrics')
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(
+                'blogly_request_duration_seconds_count{endpoint="show_user",method="GET"}', text)
+            self.assertIn(
+                'blogly_requests_total{endpoint="show_user",method="GET",status="200"}', text)
+            self.assertIn('blogly_requests_in_progress{endpoint="show_metrics"} 1.0', text)
+            self.assertIn('blogly_sql_statements_total{endpoint="show_user"}', text)
+            self.assertIn('blogly_sql_duration_seconds_count{endpoint="show_user"}', text)
+            self.assertIn(
+                'blogly_template_render_seconds_count{template="users/user.html"}', text)
+
+    ################
+    # Slow queries #
+    ################
+
+    def test_slow_query_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'slow.log')
+            app.config['SLOW_QUERY_THRESHOLD'] = 0
+            app.config['SLOW_QUERY_LOG'] = path
+            try:
+                with app.test_client() as client:
+                    resp = client.get('/users/1')
+
+                    self.assertEqual(resp.status_code, 200)
+                app.extensions['slow_queries'].flush()
+            finally:
+                app.config['SLOW_QUERY_THRESHOLD'] = None
+
+            self.assertTrue(os.path.exists(os.path.join(directory, f'slow.{os.getpid()}.log')))
+            records = slow_queries.read_records(path)
+            record = next(record for record in records
+                          if record['endpoint'] == 'show_user' and 'FROM users' in record['statement'])
+            self.assertIn('FROM users', record['statement'])
+            self.assertIn('1', str(record['parameters']))
+            if db.engine.dialect.name == 'postgresql':
+                self.assertIn('Execution Time', record['plan'])
+
+            result = app.test_cli_runner().invoke(
+                args=['slow-queries', '--endpoint', 'show_user', '--plans'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('show_user', result.output)
+
+    def test_slow_query_writer_starts_with_the_first_slow_query(self):
+        recorder = slow_queries.SlowQueryRecorder(app)
+        self.assertIsNone(recorder.thread.pid)
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['SLOW_QUERY_LOG'], path = os.path.join(directory, 'slow.log'), app.config['SLOW_QUERY_LOG']
+            self.addCleanup(app.config.__setitem__, 'SLOW_QUERY_LOG', path)
+            with app.app_context():
+                recorder.record(db.engine, 'SELECT 1', {}, 1.0)
+            recorder.flush()
+
+            self.assertEqual(recorder.thread.pid, os.getpid())
+            self.assertEqual(len(slow_queries.read_records(app.config['SLOW_QUERY_LOG'])), 1)
+
+    def test_slow_writes_are_not_run_again_to_explain_them(self):
+        self.assertEqual(slow_queries.explain_command('  select * FROM users'), 'EXPLAIN (ANALYZE, BUFFERS)')
+        self.assertEqual(slow_queries.explain_command('UPDATE users SET first_name = %(name)s'), 'EXPLAIN')
+        self.assertEqual(slow_queries.explain_command('DELETE FROM posts'), 'EXPLAIN')
+
+    def test_slow_query_logs_of_every_worker_are_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'slow.log')
+            written = [('slow.1.log.1', '2024-01-01'), ('slow.2.log', '2024-01-03'), ('slow.1.log', '2024-01-02')]
+            for name, at in written:
+                with open(os.path.join(directory, name), 'w') as file:
+                    file.write(json.dumps({'at': at}) + '\n')
+
+            self.assertEqual([record['at'] for record in slow_queries.read_records(path)],
+                             ['2024-01-01', '2024-01-02', '2024-01-03'])
+
+    #############
+    # Templates #
+    #############
+
+    def test_precompile_templates(self):
+        directory = tempfile.mkdtemp(prefix='blogly-templates-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        # The cache was made from TEMPLATE_CACHE_DIR when the app was set up, so swap it
+        self.addCleanup(setattr, app.jinja_env, 'bytecode_cache', app.jinja_env.bytecode_cache)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        # Templates already loaded would not be compiled again
+        app.jinja_env.cache.clear()
+
+        result = app.test_cli_runner().invoke(args=['precompile-templates'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(f'Compiled {len(app.jinja_env.list_templates())} templates into {directory}', result.output)
+        self.assertEqual(len(os.listdir(directory)), len(app.jinja_env.list_templates()))
+
+    ###############
+    # Compression #
+    ###############
+
+    def test_gzip_page(self):
+        with app.test_client() as client:
+            resp = client.get('/users', headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            html = gzip.decompress(resp.get_data()).decode()
+            self.assertIn('<h1>Users</h1>', html)
+
+    def test_brotli_page(self):
+        if compression.brotli is None:
+            self.skipTest('Brotli is not installed')
+        with app.test_client() as client:
+            resp = client.get('/users', headers={'Accept-Encoding': 'gzip;q=0.8, br'})
+
+            self.assertEqual(resp.headers['Content-Encoding'], 'br')
+            html = compression.brotli.decompress(resp.get_data()).decode()
+            self.assertIn('<h1>Users</h1>', html)
+
+    def test_uncompressed_page(self):
+        with app.test_client() as client:
+            resp = client.get('/users', headers={'Accept-Encoding': 'identity'})
+
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertIn('<h1>Users</h1>', resp.get_data(as_text=True))
+
+    def test_small_and_compressed_bodies_are_not_compressed(self):
+        with app.test_client() as client:
+            resp = client.get(DEFAULT_IMAGE, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.content_type, 'image/png')
+            self.assertNotIn('Content-Encoding', resp.headers)
+            resp.close()
+
+            resp2 = client.get('/tags/search?q=T', headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', resp2.headers)
+            self.assertEqual(resp2.json, [{'id': 1, 'name': 'Testing'}])
+
+    def test_streamed_response_is_compressed(self):
+        streaming = Flask('streaming')
+        compression.init_compression(streaming)
+
+        @streaming.route('/stream')
+        def stream():
+            return streaming.response_class((f'<p>{i}</p>' for i in range(1000)), mimetype='text/html')
+
+        resp = streaming.test_client().get('/stream', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(gzip.decompress(resp.get_data()).decode(),
+                         ''.join(f'<p>{i}</p>' for i in range(1000)))
+
+    def test_choose_encoding(self):
+        self.assertEqual(compression.choose_encoding('gzip, deflate'), 'gzip')
+        self.assertIsNone(compression.choose_encoding(''))
+        self.assertIsNone(compression.choose_encoding('gzip;q=0, br;q=0'))
+        self.assertEqual(compression.choose_encoding('*'), 'br' if compression.brotli else 'gzip')
+
+    #############
+    # Fragments #
+    #############
+
+    def test_fragment_follows_edits(self):
+        with app.test_client() as client:
+            cache = app.extensions['fragment_cache']
+
+            client.get('/users')
+            self.assertIn(('user-item', ('users', 1, 1)), cache.entries)
+
+            client.post('/users/1/edit', data={'first_name': 'Jane'})
+            html = client.get('/users').get_data(as_text=True)
+
+            self.assertIn('<li><a href="/users/1">Jane Doe</a></li>', html)
+            self.assertIn(('user-item', ('users', 1, 2)), cache.entries)
+
+    def test_fragment_cache_is_bounded(self):
+        cache = fragments.FragmentCache(max_bytes=10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+        cache.get('a')
+        cache.set('c', '123')
+
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.size, 8)
+
+        cache.set('d', '12345678901')
+        self.assertIsNone(cache.get('d'))
+
+    #################
+    # Related posts #
+    #################
+
+    def related_ids(self, post_id):
+        return [post.id for post in related.related_posts(post_id)]
+
+    def test_related_posts_follow_tags(self):
+        with app.test_client() as client:
+            db.session.add(Tag(name='Other'))
+            db.session.commit()
+
+            client.post('/users/1/posts/new', data={'title': 'Two', 'content': 'x', 'tags': ['1']})
+            client.post('/users/1/posts/new', data={'title': 'Three', 'content': 'x', 'tags': ['1', '2']})
+            self.assertEqual(self.related_ids(1), [3, 2])
+            self.assertEqual(self.related_ids(2), [3, 1])
+
+            # Post 2 now shares both tags with post 3
+            client.post('/posts/2/edit', data={'tags': ['1', '2']})
+            self.assertEqual(self.related_ids(2), [3, 1])
+            self.assertEqual(self.related_ids(3), [2, 1])
+            self.assertEqual(RelatedPost.query.filter_by(post_id=3, related_id=2).one().shared_tags, 2)
+
+            client.post('/tags/1/detach', json={'posts': [1]})
+            self.assertEqual(self.related_ids(1), [])
+            self.assertEqual(self.related_ids(3), [2])
+
+            client.post('/posts/2/delete')
+            self.assertEqual(self.related_ids(3), [])
+
+    def test_post_page_shows_related_posts(self):
+        with app.test_client() as client:
+            client.post('/users/1/posts/new', data={'title': 'Two', 'content': 'x', 'tags': ['1']})
+
+            html = client.get('/posts/1').get_data(as_text=True)
+            self.assertIn('<h2>Related Posts</h2>', html)
+            self.assertIn('<li><a href="/posts/2">Two</a></li>', html)
+
+    def test_rebuild_related_posts(self):
+        with app.app_context():
+            db.session.add_all([Tag(name='Other')] +
+                               [Post(title=f'Post {i}', content='x', user_id=1) for i in range(2, 8)])
+            db.session.commit()
+            db.session.add_all([PostTag(post_id=i, tag_id=1 + i % 2) for i in range(2, 8)] +
+                               [PostTag(post_id=7, tag_id=1)])
+            db.session.commit()
+
+            related.rebuild_related(k=3, chunk_size=2)
+
+            self.assertEqual(self.related_ids(1), [7, 6, 4])
+            self.assertEqual(self.related_ids(7), [6, 5, 4])
+            self.assertEqual(RelatedPost.query.count(), 19)
+
+            result = app.test_cli_runner().invoke(args=['rebuild-related'])
+            self.assertEqual(result.exit_code, 0)
+
+    def test_refresh_related_in_chunks(self):
+        with app.app_context():
+            db.session.add_all([Tag(name='Other')] +
+                               [Post(title=f'Post {i}', content='x', user_id=1) for i in range(2, 8)])
+            db.session.commit()
+            db.session.add_all([PostTag(post_id=i, tag_id=1 + i % 2) for i in range(2, 8)] +
+                               [PostTag(post_id=7, tag_id=1)])
+            db.session.commit()
+            related.rebuild_related(k=3)
+            expected = {post_id: self.related_ids(post_id) for post_id in range(1, 8)}
+
+            RelatedPost.query.delete()
+            related.refresh_related(tag_ids=[1, 2], k=3, chunk_size=2)
+
+            self.assertEqual({post_id: self.related_ids(post_id) for post_id in range(1, 8)}, expected)
+
+    #############
+    # Analytics #
+    #############
+
+    def test_build_tag_analytics(self):
+        with app.app_context():
+            db.session.add_all([Tag(name='Two'), Tag(name='Unused'),
+                                Post(title='Old', content='x', user_id=1,
+                                     created_at=datetime(2020, 1, 15, tzinfo=timezone.utc))])
+            db.session.commit()
+            db.session.add_all([PostTag(post_id=2, tag_id=1), PostTag(post_id=2, tag_id=2)])
+            db.session.commit()
+
+            analytics.build_tag_analytics(chunk_size=1)
+
+            pairs = {(pair.tag_id, pair.other_id): pair.posts for pair in TagPair.query}
+            self.assertEqual(pairs, {(1, 1): 2, (2, 2): 1, (1, 2): 1})
+            self.assertEqual(TagMonth.query.filter_by(tag_id=2).one().month, date(2020, 1, 1))
+            self.assertEqual(sum(month.posts for month in TagMonth.query.filter_by(tag_id=1)), 2)
+            buckets = {bucket.min_posts: (bucket.max_posts, bucket.tags) for bucket in TagSizeBucket.query}
+            self.assertEqual(buckets, {0: (0, 1), 1: (1, 1), 2: (3, 1)})
+
+    def test_tag_analytics_skip_tags_made_while_building(self):
+        original = analytics.chunks
+
+        def chunks_after_new_tag(chunk_size):
+            late = Tag(name='Late')
+            db.session.add(late)
+            db.session.flush()
+            db.session.add(PostTag(post_id=1, tag_id=late.id))
+            db.session.flush()
+            yield from original(chunk_size)
+
+        analytics.chunks = chunks_after_new_tag
+        self.addCleanup(setattr, analytics, 'chunks', original)
+        with app.app_context():
+            analytics.build_tag_analytics()
+
+            self.assertEqual({(pair.tag_id, pair.other_id): pair.posts for pair in TagPair.query}, {(1, 1): 1})
+            self.assertEqual([month.tag_id for month in TagMonth.query], [1])
+
+    def test_tag_analytics_page(self):
+        with app.test_client() as client:
+            resp = client.get('/tags/analytics')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<h1>Tag Analytics</h1>', html)
+            self.assertIn('flask build-tag-analytics', html)
+
+            result = app.test_cli_runner().invoke(args=['build-tag-analytics'])
+            self.assertEqual(result.exit_code, 0)
+
+            html2 = client.get('/tags/analytics').get_data(as_text=True)
+            self.assertIn('<tr><td><a href="/tags/1">Testing</a></td><td>1</td></tr>', html2)
+            self.assertNotIn('WARNINGS GO HERE', html2)
+
+    ###########
+    # Archive #
+    ###########
+
+    def test_archive(self):
+        with app.app_context():
+            db.session.add_all([
+                Post(title='Late January', content='x', user_id=1,
+                     created_at=datetime(2020, 1, 31, 23, 59, tzinfo=timezone.utc)),
+                Post(title='Early January', content='x', user_id=1,
+                     created_at=datetime(2020, 1, 1, tzinfo=timezone.utc)),
+                Post(title='February', content='x', user_id=1,
+                     created_at=datetime(2020, 2, 1, tzinfo=timezone.utc)),
+                Post(title='Last December', content='x', user_id=1,
+                     created_at=datetime(2019, 12, 31, 23, 59, tzinfo=timezone.utc)),
+            ])
+            db.session.commit()
+
+            self.assertEqual([post.title for post in Post.archive(2020, 1).items],
+                             ['Early January', 'Late January'])
+            self.assertEqual([post.title for post in Post.archive(2019, 12).items], ['Last December'])
+            self.assertEqual(Post.archive(2020, 1, per_page=1).pages, 2)
+
+        with app.test_client() as client:
+            resp = client.get('/archive/2020/1')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<h1>Posts from 2020-01</h1>', html)
+            self.assertLess(html.index('Early January'), html.index('Late January'))
+            self.assertNotIn('February</a>', html)
+            self.assertIn('href="/archive/2019/12"', html)
+            self.assertIn('href="/archive/2020/2"', html)
+
+    def test_archive_empty_and_invalid_months(self):
+        with app.test_client() as client:
+            resp = client.get('/archive/1999/12')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('No posts this month', resp.get_data(as_text=True))
+            self.assertIn('href="/archive/2000/1"', resp.get_data(as_text=True))
+            self.assertEqual(client.get('/archive/2020/13').status_code, 404)
+            self.assertEqual(client.get('/archive/2020/0').status_code, 404)
+
+    def test_archive_index_is_built_concurrently(self):
+        for valid, built, statements in [
+                (True, False, []),
+                (None, True, ['CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_post_archive ON post (created_at, id)']),
+                (False, True, ['DROP INDEX CONCURRENTLY IF EXISTS ix_post_archive',
+                               'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_post_archive ON post (created_at, id)'])]:
+            executed = []
+
+            def execute(statement, **params):
+                executed.append(statement)
+                return SimpleNamespace(scalar=lambda: valid)
+
+            conn = SimpleNamespace(execute=execute)
+            self.assertEqual(migrations.build_index(conn, 'ix_post_archive', 'post (created_at, id)'), built)
+            self.assertEqual(executed[1:], statements)
+
+        if db.engine.dialect.name != 'postgresql':
+            result = app.test_cli_runner().invoke(args=['build-indexes'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Only Postgres', result.output)
+
+    def test_columns_are_only_added_when_missing(self):
+        for exists, added, statements in [
+                (1, False, []),
+                (None, True, ['ALTER TABLE post ADD COLUMN IF NOT EXISTS views BIGINT NOT NULL DEFAULT 0'])]:
+            executed = []
+
+            def execute(statement, **params):
+                executed.append(statement)
+                return SimpleNamespace(scalar=lambda: exists)
+
+            conn = SimpleNamespace(execute=execute)
+            self.assertEqual(migrations.add_column(conn, 'post', 'views', 'BIGINT NOT NULL DEFAULT 0'), added)
+            self.assertEqual(executed[1:], statements)
+
+        if db.engine.dialect.name != 'postgresql':
+            result = app.test_cli_runner().invoke(args=['add-columns'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Only Postgres', result.output)
+
+    #########
+    # Views #
+    #########
+
+    def test_views_are_counted_in_memory_then_flushed(self):
+        counter = app.extensions['view_counter']
+        with app.test_client() as client:
+            for _ in range(3):
+                self.assertEqual(client.get('/posts/1').status_code, 200)
+
+        self.assertEqual(counter.pending(), 3)
+        with app.app_context():
+            self.assertEqual(Post.query.get(1).views, 0)
+
+            self.assertEqual(counter.flush(), 1)
+            self.assertEqual(counter.pending(), 0)
+            self.assertEqual(Post.query.get(1).views, 3)
+            self.assertEqual(Post.query.get(1).version, 1)
+            self.assertEqual(counter.flush(), 0)
+
+    def test_failed_flush_keeps_views(self):
+        counter = app.extensions['view_counter']
+        counter.add(1)
+        counter.add(1)
+        with app.app_context():
+            original = views.ADD_VIEWS
+            views.ADD_VIEWS = Post.__table__.update().values(views=db.text('no_such_column'))
+            try:
+                with self.assertRaises(Exception):
+                    counter.flush()
+            finally:
+                views.ADD_VIEWS = original
+
+            self.assertEqual(counter.pending(), 2)
+            counter.flush()
+            self.assertEqual(Post.query.get(1).views, 2)
+
+    def test_most_viewed(self):
+        with app.app_context():
+            db.session.add(Post(title='Popular', content='x', user_id=1, views=10))
+            db.session.commit()
+            app.extensions['view_counter'].add(1)
+            app.extensions['view_counter'].flush()
+
+        with app.test_client() as client:
+            resp = client.get('/posts/most-viewed')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<h1>Most Viewed Posts</h1>', html)
+            self.assertLess(html.index('Popular</a> <small>10 views</small>'),
+                            html.index('A Test</a> <small>1 views</small>'))
+
+    def test_background_thread_starts_once_per_process(self):
+        started = []
+        thread = background.ProcessThread(lambda: started.append(threading.current_thread().name), 'test-thread')
+        for _ in range(3):
+            thread.start()
+        # What a forked worker sees, the pid of its parent
+        thread.pid = -1
+        thread.start()
+        deadline = time.monotonic() + 5
+        while len(started) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(started, ['test-thread', 'test-thread'])
+
+    ################
+    # Object cache #
+    ################
+
+    def test_object_cache_lru_and_ttl(self):
+        cache = object_cache.ObjectCache(max_entries=2, ttl=60)
+        cache.set('a', {'id': 1})
+        cache.set('b', {'id': 2})
+        self.assertEqual(cache.get('a'), {'id': 1})
+        cache.set('c', {'id': 3})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), {'id': 3})
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'evictions': 1,
+                                         'hit_ratio': 2 / 3, 'size': 2})
+
+        expired = object_cache.ObjectCache(max_entries=2, ttl=0)
+        expired.set('a', {'id': 1})
+        self.assertIsNone(expired.get('a'))
+        self.assertEqual(expired.stats()['size'], 0)
+
+    def test_object_cache_serves_users_without_querying(self):
+        with app.test_client() as client:
+            client.get('/users/1')
+            statements = []
+            record = lambda *args: statements.append(args[2])
+            db.event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                resp = client.get('/users/1')
+            finally:
+                db.event.remove(db.engine, 'before_cursor_execute', record)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('John Doe', resp.get_data(as_text=True))
+            self.assertIn('A Test', resp.get_data(as_text=True))
+            self.assertFalse([statement for statement in statements if 'FROM users' in statement])
+            self.assertEqual(app.extensions['object_cache'].stats()['hits'], 1)
+
+    def test_object_cache_is_invalidated_by_edits(self):
+        with app.test_client() as client:
+            client.get('/users/1')
+            client.get('/tags/1')
+            client.post('/users/1/edit', data={'first_name': 'Jane'})
+            client.post('/tags/1/edit', data={'tag_name': 'Renamed'})
+
+            self.assertIn('Jane Doe', client.get('/users/1').get_data(as_text=True))
+            self.assertIn('<h1>Renamed</h1>', client.get('/tags/1').get_data(as_text=True))
+
+            client.post('/tags/1/delete')
+            self.assertEqual(client.get('/tags/1').status_code, 404)
+            client.post('/users/1/delete')
+            self.assertEqual(client.get('/users/1').status_code, 404)
+
+    def test_post_page_uses_cached_user_and_tags(self):
+        with app.app_context():
+            db.session.add(Tag(name='Second'))
+            db.session.add(PostTag(post_id=1, tag_id=2))
+            db.session.commit()
+
+        with app.test_client() as client:
+            client.get('/tags/2')
+            html = client.get('/posts/1').get_data(as_text=True)
+
+            self.assertIn('<i>By John Doe</i>', html)
+            self.assertIn('>Testing</a>', html)
+            self.assertIn('>Second</a>', html)
+            stats = app.extensions['object_cache'].stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+
+    ##########
+    # Events #
+    ##########
+
+    def test_post_events_stream(self):
+        with app.app_context():
+            db.session.add(User(first_name='Jane', last_name='Roe'))
+            db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get('/events/posts?user=1', buffered=False)
+            chunks = iter(resp.response)
+
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+            self.assertEqual(next(chunks), b'retry: 3000\n\n')
+
+            client.post('/users/2/posts/new', data={'title': 'Other', 'content': 'x'})
+            client.post('/users/1/posts/new', data={'title': 'Mine', 'content': 'x', 'tags': ['1']})
+            self.assertEqual(next(chunks), b'event: created\ndata: {"event": "created", "post": 3, '
+                                           b'"user": 1, "tags": [1]}\n\n')
+
+            client.post('/posts/1/edit', data={'title': 'Edited', 'content': 'x'})
+            self.assertIn(b'"event": "updated", "post": 1, "user": 1, "tags": [1]', next(chunks))
+
+            client.post('/posts/1/delete')
+            self.assertIn(b'"event": "deleted", "post": 1, "user": 1, "tags": []', next(chunks))
+
+            resp.close()
+            self.assertEqual(app.extensions['events'].subscribers, set())
+
+    def test_post_events_filter_by_tag(self):
+        with app.test_client() as client:
+            resp = client.get('/events/posts?tag=1', buffered=False)
+            chunks = iter(resp.response)
+            next(chunks)
+
+            client.post('/users/1/posts/new', data={'title': 'Untagged', 'content': 'x'})
+            client.post('/users/1/posts/new', data={'title': 'Tagged', 'content': 'x', 'tags': ['1']})
+
+            self.assertIn(b'"post": 3', next(chunks))
+            resp.close()
+
+    def test_post_event_streams_are_capped(self):
+        app.config['EVENTS_MAX_STREAMS'], limit = 1, app.config['EVENTS_MAX_STREAMS']
+        self.addCleanup(app.config.__setitem__, 'EVENTS_MAX_STREAMS', limit)
+        with app.test_client() as client:
+            first = client.get('/events/posts', buffered=False)
+            resp = client.get('/events/posts?tag=1', buffered=False)
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '2')
+            first.close()
+            resp = client.get('/events/posts?tag=1', buffered=False)
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+    def test_pages_do_not_open_streams_until_asked(self):
+        with app.test_client() as client:
+            html = client.get('/users/1').get_data(as_text=True)
+
+            self.assertIn('<ul>', html)
+            self.assertIn('<button type="button" class="btn btn-outline-secondary" '
+                          'data-live-posts="/events/posts?user=1">Live updates</button>', html)
+
+    def test_slow_subscribers_are_dropped(self):
+        broker = events.Broker(app)
+        app.config['EVENTS_QUEUE_SIZE'], size = 1, app.config['EVENTS_QUEUE_SIZE']
+        try:
+            subscriber = broker.subscribe()
+        finally:
+            app.config['EVENTS_QUEUE_SIZE'] = size
+        chunks = events.stream(broker, subscriber, None, None, keepalive=1)
+        next(chunks)
+
+        broker.broadcast({'event': 'created', 'post': 1, 'user': 1, 'tags': []})
+        broker.broadcast({'event': 'created', 'post': 2, 'user': 1, 'tags': []})
+
+        self.assertEqual(broker.subscribers, set())
+        self.assertEqual(list(chunks), [])
+
+    #########
+    # Feeds #
+    #########
+
+    def test_user_and_tag_feeds(self):
+        with app.test_client() as client:
+            resp = client.get('/users/1/feed.atom')
+            xml = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'application/atom+xml')
+            self.assertIn('<title>Posts by John Doe</title>', xml)
+            self.assertIn('<entry>\n<title>A Test</title>\n<id>http://localhost:5000/posts/1</id>', xml)
+            self.assertIn('<author><name>John Doe</name></author>', xml)
+
+            resp = client.get('/tags/1/feed.atom')
+            self.assertIn('<title>Posts tagged Testing</title>', resp.get_data(as_text=True))
+            self.assertIn('<title>A Test</title>', resp.get_data(as_text=True))
+
+            self.assertEqual(client.get('/users/99/feed.atom').status_code, 404)
+            self.assertEqual(client.get('/tags/99/feed.atom').status_code, 404)
+
+    def cached_files(self):
+        """Returns the files in the feed cache, relative to it"""
+
+        directory = app.config['FEED_CACHE_DIR']
+        return sorted(os.path.relpath(os.path.join(root, name), directory)
+                      for root, _, names in os.walk(directory) for name in names)
+
+    def test_feeds_go_stale_when_what_they_list_changes(self):
+        with app.test_client() as client:
+            client.get('/users/1/feed.atom')
+            client.get('/sitemaps/posts-0.xml')
+            client.get('/sitemaps/users-0.xml')
+            users_shard = self.cached_files()[1]
+
+            client.post('/users/1/posts/new', data={'title': 'Fresh', 'content': 'x', 'tags': ['1']})
+
+            # Stale everywhere, as the tokens naming the current files live in the database
+            stale = {stamp.document for stamp in FeedStamp.query}
+            self.assertEqual(stale, {'users/1.atom', 'tags/1.atom', 'sitemaps/posts-0.xml', 'sitemap.xml'})
+            self.assertIn('<title>Fresh</title>', client.get('/users/1/feed.atom').get_data(as_text=True))
+            self.assertIn('<loc>http://localhost:5000/posts/2</loc>',
+                          client.get('/sitemaps/posts-0.xml').get_data(as_text=True))
+            client.get('/sitemaps/users-0.xml')
+            files = self.cached_files()
+            self.assertEqual(len(files), 3)
+            self.assertIn(users_shard, files)
+
+            client.post('/posts/2/delete')
+            self.assertNotIn('<title>Fresh</title>', client.get('/users/1/feed.atom').get_data(as_text=True))
+            self.assertEqual(len(self.cached_files()), 3)
+
+    def test_renaming_a_user_refreshes_the_tag_feeds_naming_them(self):
+        stub = self.purge_stub()
+        with app.test_client() as client:
+            self.assertIn('<name>John Doe</name>', client.get('/tags/1/feed.atom').get_data(as_text=True))
+            client.post('/users/1/edit', data={'first_name': 'Jane'})
+
+            self.assertIn('tags/1.atom', {stamp.document for stamp in FeedStamp.query})
+            self.assertIn('<name>Jane Doe</name>', client.get('/tags/1/feed.atom').get_data(as_text=True))
+            app.extensions['surrogate_purger'].flush()
+            self.assertEqual(stub.purges, [['tag-1', 'tag-any', 'user-1', 'user-any']])
+
+    def test_sitemap_shards(self):
+        app.config['SITEMAP_SHARD_SIZE'], size = 2, app.config['SITEMAP_SHARD_SIZE']
+        try:
+            with app.app_context():
+                db.session.add_all([Post(title=f'Post {n}', content='x', user_id=1) for n in range(3)])
+                db.session.commit()
+
+            with app.test_client() as client:
+                index = client.get('/sitemap.xml').get_data(as_text=True)
+                self.assertEqual(index.count('<sitemap>'), 4)
+                self.assertIn('<loc>http://localhost:5000/sitemaps/posts-1.xml</loc>', index)
+                self.assertNotIn('posts-2.xml', index)
+
+                resp = client.get('/sitemaps/posts-1.xml')
+                shard = resp.get_data(as_text=True)
+                self.assertEqual(resp.mimetype, 'application/xml')
+                self.assertEqual(shard.count('<url>'), 2)
+                self.assertIn('<url><loc>http://localhost:5000/posts/3</loc><lastmod>', shard)
+                self.assertIn('<loc>http://localhost:5000/posts/4</loc>', shard)
+
+                self.assertIn('<url><loc>http://localhost:5000/tags/1</loc></url>',
+                              client.get('/sitemaps/tags-0.xml').get_data(as_text=True))
+                self.assertEqual(client.get('/sitemaps/posts-2.xml').status_code, 404)
+                self.assertEqual(client.get('/sitemaps/pages-0.xml').status_code, 404)
+        finally:
+            app.config['SITEMAP_SHARD_SIZE'] = size
+
+    ##########
+    # Freeze #
+    ##########
+
+    def test_freeze(self):
+        output = tempfile.mkdtemp(prefix='blogly-freeze-')
+        self.addCleanup(shutil.rmtree, output)
+        with app.app_context():
+            rendered, removed = freeze.freeze(app, output)
+
+            self.assertEqual((rendered, removed), (5, 0))
+            with open(os.path.join(output, 'posts', '1', 'index.html')) as file:
+                self.assertIn('<h1>A Test</h1>', file.read())
+            with open(os.path.join(output, 'users', 'index.html')) as file:
+                self.assertIn('John Doe', file.read())
+            self.assertTrue(os.path.exists(os.path.join(output, 'tags', '1', 'index.html')))
+            self.assertTrue(os.path.exists(os.path.join(output, 'static', 'js', 'tag_picker.js')))
+            self.assertEqual(app.extensions['view_counter'].pending(), 0)
+
+            self.assertEqual(freeze.freeze(app, output), (0, 0))
+
+    def test_freeze_renders_only_what_changed(self):
+        output = tempfile.mkdtemp(prefix='blogly-freeze-')
+        self.addCleanup(shutil.rmtree, output)
+        with app.app_context():
+            db.session.add(User(first_name='Jane', last_name='Roe'))
+            db.session.commit()
+            freeze.freeze(app, output)
+            manifest_path = os.path.join(output, freeze.MANIFEST)
+
+            Post.query.get(1).update_post('Edited', None)
+            db.session.commit()
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            self.assertEqual(freeze.stale_pages(manifest, freeze.snapshot()),
+                             ({'/posts/1', '/users/1', '/tags/1'}, set()))
+            self.assertEqual(freeze.freeze(app, output), (3, 0))
+            with open(os.path.join(output, 'users', '1', 'index.html')) as file:
+                self.assertIn('Edited', file.read())
+
+            db.session.add(Post(title='New', content='x', user_id=2))
+            db.session.add(Tag(name='Fresh'))
+            db.session.commit()
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            self.assertEqual(freeze.stale_pages(manifest, freeze.snapshot()),
+                             ({'/posts/2', '/users/2', '/tags', '/tags/2'}, set()))
+            freeze.freeze(app, output)
+
+            db.session.delete(Tag.query.get(2))
+            db.session.add(PostTag(post_id=2, tag_id=1))
+            db.session.commit()
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            self.assertEqual(freeze.stale_pages(manifest, freeze.snapshot()),
+                             ({'/posts/2', '/tags/1', '/tags'}, {'/tags/2'}))
+            self.assertEqual(freeze.freeze(app, output), (3, 1))
+            self.assertFalse(os.path.exists(os.path.join(output, 'tags', '2', 'index.html')))
+
+    def test_freeze_command(self):
+        output = tempfile.mkdtemp(prefix='blogly-freeze-')
+        self.addCleanup(shutil.rmtree, output)
+        result = app.test_cli_runner().invoke(args=['freeze', '--output', output, '--jobs', '1'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Rendered 5 pages and removed 0', result.output)
+
+    ##################
+    # Surrogate keys #
+    ##################
+
+    def purge_stub(self):
+        """Points purges at a local stub for the length of a test"""
+
+        stub = surrogate.PurgeStub().start()
+        self.addCleanup(stub.server_close)
+        self.addCleanup(stub.shutdown)
+        app.config['SURROGATE_PURGE_URL'] = stub.url
+        self.addCleanup(app.config.__setitem__, 'SURROGATE_PURGE_URL', None)
+        return stub
+
+    def test_read_responses_name_their_rows(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get('/tags/1').headers['Surrogate-Key'], 'post-1 tag-1')
+            self.assertEqual(client.get('/posts/1').headers['Surrogate-Key'], 'post-1 tag-1 user-1')
+            self.assertEqual(client.get('/users').headers['Surrogate-Key'], 'user-1 users')
+            # From the object cache this time
+            self.assertEqual(client.get('/posts/1').headers['Surrogate-Key'], 'post-1 tag-1 user-1')
+            self.assertEqual(client.get('/users/1/feed.atom').headers['Surrogate-Key'], 'post-1 user-1')
+            # From the cached file, without loading any rows
+            self.assertEqual(client.get('/users/1/feed.atom').headers['Surrogate-Key'], 'user-1')
+            self.assertNotIn('Surrogate-Key', client.get('/tags/99').headers)
+
+    def test_surrogate_keys_collapse_past_the_limit(self):
+        self.assertEqual(surrogate.response_keys({'post-1', 'post-2', 'post-3', 'tag-1', 'posts'}, 2),
+                         ['post-any', 'posts', 'tag-1'])
+        self.assertEqual(surrogate.purge_keys(['tag-5', 'tags']), {'tag-5', 'tag-any', 'tags'})
+
+    def test_write_routes_purge_their_keys(self):
+        stub = self.purge_stub()
+        purger = app.extensions['surrogate_purger']
+        with app.test_client() as client:
+            client.post('/tags/1/edit', data={'tag_name': 'Renamed'})
+            self.assertEqual(purger.flush(), 1)
+            self.assertEqual(stub.purges, [['tag-1', 'tag-any']])
+
+            client.post('/users/1/posts/new', data={'title': 'New', 'content': 'x', 'tags': ['1']})
+            client.post('/users/new', data={'first_name': 'Jane', 'last_name': 'Roe'})
+            purger.flush()
+            self.assertEqual(stub.purges[1], ['posts', 'tag-1', 'tag-any', 'user-1', 'user-any', 'users'])
+
+    def test_edits_are_purged_again_once_other_workers_caches_expire(self):
+        stub = self.purge_stub()
+        purger = app.extensions['surrogate_purger']
+        app.config['OBJECT_CACHE_TTL'], ttl = 0.2, app.config['OBJECT_CACHE_TTL']
+        self.addCleanup(app.config.__setitem__, 'OBJECT_CACHE_TTL', ttl)
+        own = app.extensions['object_cache']
+        self.addCleanup(app.extensions.__setitem__, 'object_cache', own)
+        # Another worker, which read the user before the edit
+        other = object_cache.ObjectCache(100, app.config['OBJECT_CACHE_TTL'])
+        with app.test_client() as client:
+            app.extensions['object_cache'] = other
+            client.get('/users/1')
+            app.extensions['object_cache'] = own
+            client.post('/users/1/edit', data={'first_name': 'Jane'})
+            purger.flush()
+
+            # The proxy refetches the page from the other worker, and caches it stale
+            app.extensions['object_cache'] = other
+            self.assertIn('John Doe', client.get('/users/1').get_data(as_text=True))
+            keys = ['tag-1', 'tag-any', 'user-1', 'user-any']
+            self.assertEqual(stub.purges, [keys])
+
+            time.sleep(0.25)
+            purger.flush()
+            self.assertEqual(stub.purges, [keys, keys])
+            self.assertIn('Jane Doe', client.get('/users/1').get_data(as_text=True))
+
+    def test_delayed_purges_are_sent_on_exit(self):
+        stub = self.purge_stub()
+        purger = app.extensions['surrogate_purger']
+        with app.app_context():
+            surrogate.purge('tag-1', again_after=60)
+            purger.flush()
+            self.assertEqual(purger.flush(), 0)
+            self.assertEqual(purger.flush(final=True), 1)
+
+        self.assertEqual(stub.purges, [['tag-1', 'tag-any'], ['tag-1', 'tag-any']])
+
+    def test_deleted_users_are_purged_once_gone(self):
+        stub = self.purge_stub()
+        with app.test_client() as client:
+            client.post('/users/1/delete')
+            app.extensions['surrogate_purger'].flush()
+
+        self.assertEqual(stub.purges, [['post-1', 'post-any', 'posts', 'tag-1', 'tag-any',
+                                        'user-1', 'user-any', 'users']])
+
+    def test_searches_are_purged_with_their_lists(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get('/tags/search?q=zz').headers['Surrogate-Key'], 'tags')
+            self.assertEqual(client.get('/tags/search?q=te').headers['Surrogate-Key'], 'tag-1 tags')
+            self.assertEqual(client.get('/users/search?q=zz').headers['Surrogate-Key'], 'users')
+
+    def test_purges_are_batched_and_retried(self):
+        stub = self.purge_stub()
+        purger = app.extensions['surrogate_purger']
+        app.config['SURROGATE_PURGE_BATCH'], batch = 2, app.config['SURROGATE_PURGE_BATCH']
+        self.addCleanup(app.config.__setitem__, 'SURROGATE_PURGE_BATCH', batch)
+        with app.app_context():
+            surrogate.purge('users', 'tags', 'posts')
+
+            self.assertEqual(purger.flush(), 2)
+            self.assertEqual(stub.purges, [['posts', 'tags'], ['users']])
+
+            surrogate.purge('users')
+            app.config['SURROGATE_PURGE_URL'] = 'http://127.0.0.1:1/purge'
+            with self.assertRaises(OSError):
+                purger.flush()
+            self.assertEqual(purger.pending, {'users'})
+
+    ###########
+    # Avatars #
+    ###########
+
+    def image_file(self, size, mode='RGB', format='PNG'):
+        """Returns an upload of a generated image"""
+
+        data = io.BytesIO()
+        Image.new(mode, size, 'red').save(data, format)
+        data.seek(0)
+        return data, f'avatar.{format.lower()}'
+
+    def test_avatar_upload_is_downscaled_and_served_immutable(self):
+        with app.test_client() as client:
+            resp = client.post('/users/new', data={'first_name': 'Jane', 'last_name': 'Roe',
+                                                   'avatar': self.image_file((1000, 500))},
+                               content_type='multipart/form-data')
+            self.assertEqual(resp.status_code, 302)
+
+            image_url = User.query.filter_by(first_name='Jane').one().image_url
+            self.assertRegex(image_url, r'^/avatars/[0-9a-f]{64}\.jpg$')
+            resp = client.get(image_url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+            self.assertEqual(Image.open(io.BytesIO(resp.get_data())).size, (256, 128))
+            resp.close()
+
+    def test_identical_avatars_are_stored_once(self):
+        with app.test_client() as client:
+            client.post('/users/1/edit', data={'avatar': self.image_file((300, 300), 'RGBA')},
+                        content_type='multipart/form-data')
+            client.post('/users/new', data={'first_name': 'Jane', 'last_name': 'Roe',
+                                            'avatar': self.image_file((300, 300), 'RGBA')},
+                        content_type='multipart/form-data')
+
+            urls = {user.image_url for user in User.query}
+            self.assertEqual(len(urls), 1)
+            self.assertTrue(urls.pop().endswith('.png'))
+            self.assertEqual(len(os.listdir(app.config['AVATAR_DIR'])), 1)
+
+    def test_invalid_avatar_is_rejected(self):
+        with app.test_client() as client:
+            resp = client.post('/users/1/edit', data={'first_name': 'James',
+                                                      'avatar': (io.BytesIO(b'not an image'), 'a.png')},
+                               content_type='multipart/form-data')
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn('Avatar not accepted: not an image', resp.get_data(as_text=True))
+            self.assertEqual(User.query.get(1).first_name, 'John')
+
+            app.config['AVATAR_MAX_PIXELS'], limit = 100, app.config['AVATAR_MAX_PIXELS']
+            self.addCleanup(app.config.__setitem__, 'AVATAR_MAX_PIXELS', limit)
+            resp = client.post('/users/1/edit', data={'avatar': self.image_file((20, 20))},
+                               content_type='multipart/form-data')
+            self.assertIn('image is too large', resp.get_data(as_text=True))
+
+    ###########
+    # Loading #
+    ###########
+
+    def count_queries(self, client, path):
+        """Returns how many statements a request for path runs, with nothing cached"""
+
+        app.extensions['object_cache'].clear()
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual(client.get(path).status_code, 200)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', record)
+        return len(statements)
+
+    def test_pages_run_the_same_queries_however_many_rows_they_show(self):
+        pages = ['/users/1', '/posts/1', '/posts/1/edit', '/tags/1', '/users', '/tags']
+        with app.test_client() as client:
+            before = {path: self.count_queries(client, path) for path in pages}
+
+            db.session.add_all([Tag(id=2, name='More'), Tag(id=3, name='Most')])
+            db.session.add_all([Post(id=ident, title=f'Post {ident}', content='x', user_id=1) for ident in (2, 3, 4)])
+            db.session.flush()
+            db.session.add_all([PostTag(post_id=1, tag_id=2), PostTag(post_id=1, tag_id=3)]
+                               + [PostTag(post_id=ident, tag_id=1) for ident in (2, 3, 4)])
+            db.session.commit()
+            db.session.expunge_all()
+
+            self.assertEqual({path: self.count_queries(client, path) for path in pages}, before)
+
+    def test_unplanned_lazy_loads_raise(self):
+        db.session.expunge_all()
+        post = Post.query.get(1)
+
+        with self.assertRaises(InvalidRequestError):
+            post.tags
+        with self.assertRaises(InvalidRequestError):
+            post.user
+
+        db.session.expunge_all()
+        post = Post.query.options(db.joinedload(Post.user), db.selectinload(Post.tags)).get(1)
+        self.assertEqual(post.user.first_name, 'John')
+        self.assertEqual([tag.name for tag in post.tags], ['Testing'])
+
+    ##########
+    # Memory #
+    ##########
+
+    def track_memory(self, every=2):
+        """Turns on allocation tracking into a fresh directory for the length of a test"""
+
+        directory = tempfile.mkdtemp(prefix='blogly-memory-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        settings = {'MEMORY_TRACKING': True, 'MEMORY_DIR': directory, 'MEMORY_SNAPSHOT_EVERY': every}
+        for key, value in settings.items():
+            self.addCleanup(app.config.__setitem__, key, app.config[key])
+            app.config[key] = value
+        self.addCleanup(app.extensions['memory'].clear)
+        self.addCleanup(tracemalloc.stop)
+        return directory
+
+    def test_memory_snapshots_are_taken_once_the_session_is_gone(self):
+        self.track_memory()
+        tracker = app.extensions['memory']
+        sessions = []
+        finished = tracker.finished
+        tracker.finished = lambda endpoint: sessions.append((endpoint, db.session.registry.has())) or finished(endpoint)
+        self.addCleanup(delattr, tracker, 'finished')
+        with app.test_client() as client:
+            client.get('/users/1')
+
+        self.assertEqual(sessions, [('show_user', False)])
+
+    def test_memory_snapshots_per_endpoint(self):
+        directory = self.track_memory()
+        token = memory.TOKEN.make_token(app.config['SECRET_KEY'])
+        with app.test_client() as client:
+            for _ in range(3):
+                client.get('/users')
+            client.get('/tags')
+
+            resp = client.get('/debug/memory?top=5', headers={memory.TOKEN.name: token})
+            data = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(data['tracing'])
+            self.assertGreater(data['rss'], 0)
+            self.assertEqual(set(data['endpoints']), {'show_users', 'show_tags'})
+            self.assertEqual(data['endpoints']['show_users']['requests'], 3)
+            self.assertLessEqual(len(data['endpoints']['show_users']['top']), 5)
+            self.assertTrue(data['endpoints']['show_users']['top'][0]['site'])
+
+            resp = client.get('/debug/memory?endpoint=show_tags', headers={memory.TOKEN.name: token})
+            self.assertEqual(list(resp.get_json()['endpoints']), ['show_tags'])
+
+        self.assertEqual(sorted(name.split('.')[0] for name in os.listdir(directory)),
+                         ['show_tags', 'show_tags', 'show_users', 'show_users'])
+        result = app.test_cli_runner().invoke(args=['memory-report', '--endpoint', 'show_users'])
+        self.assertIn(f'show_users in worker {os.getpid()}', result.output)
+        self.assertIn('Growth since the first snapshot', result.output)
+        self.assertNotIn('show_tags', result.output)
+
+    def test_memory_endpoint_needs_signed_header(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get('/debug/memory').status_code, 403)
+            self.assertEqual(client.get('/debug/memory', headers={memory.TOKEN.name: 'memory.forged'}).status_code, 403)
+            # A profiler token is signed with another salt
+            profile_token = profiler.TOKEN.make_token(app.config['SECRET_KEY'])
+            self.assertEqual(client.get('/debug/memory', headers={memory.TOKEN.name: profile_token}).status_code, 403)
+
+            result = app.test_cli_runner().invoke(args=['memory-token'])
+            self.assertIn(f'{memory.TOKEN.name}: memory.', result.output)
+            self.assertIn(f'Valid for {app.config["DEBUG_TOKEN_MAX_AGE"]} seconds', result.output)
+            # One made too long ago has expired
+            signer = TimestampSigner(app.config['SECRET_KEY'], salt=memory.TOKEN.salt)
+            signer.get_timestamp = lambda: int(time.time()) - app.config['DEBUG_TOKEN_MAX_AGE'] - 10
+            expired = signer.sign(memory.TOKEN.value).decode()
+            self.assertEqual(client.get('/debug/memory', headers={memory.TOKEN.name: expired}).status_code, 403)
+
+            token = memory.TOKEN.make_token(app.config['SECRET_KEY'])
+            resp = client.get('/debug/memory', headers={memory.TOKEN.name: token})
+            self.assertFalse(resp.get_json()['tracing'])
+            self.assertEqual(resp.get_json()['endpoints'], {})
+            self.assertIn('blogly_worker_rss_bytes', client.get('/metrics').get_data(as_text=True))
+
+    def test_worker_is_recycled_over_rss_limit(self):
+        worker = SimpleNamespace(alive=True, pid=os.getpid(), log=logging.getLogger('test'))
+
+        self.assertFalse(memory.recycle_if_over(worker, memory.rss() * 2))
+        self.assertTrue(worker.alive)
+        self.assertTrue(memory.recycle_if_over(worker, 1024))
+        self.assertFalse(worker.alive)
+
+    #############
+    # Admission #
+    #############
+
+    def saturate(self, in_flight=0, wait=0.0):
+        """Pretends the worker is already handling in_flight requests that waited wait seconds for the pool"""
+
+        tracker = app.extensions['admission']
+        tracker.in_flight += in_flight
+        self.addCleanup(setattr, tracker, 'in_flight', tracker.in_flight - in_flight)
+        tracker.wait, tracker.measured = wait, time.monotonic()
+
+    def test_requests_are_shed_past_the_in_flight_limit(self):
+        self.saturate(in_flight=app.config['ADMISSION_MAX_IN_FLIGHT'])
+        with app.test_client() as client:
+            resp = client.get('/users')
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '2')
+            self.assertEqual(client.post('/tags/new', data={'tag_name': 'New'}).status_code, 503)
+            self.assertIsNone(Tag.query.filter_by(name='New').first())
+
+            metrics = client.get('/metrics').get_data(as_text=True)
+            self.assertIn('blogly_admission_decisions_total{decision="shed_in_flight",priority="high"}', metrics)
+            self.assertIn('blogly_admission_decisions_total{decision="shed_in_flight",priority="low"}', metrics)
+
+    def test_writes_are_shed_before_reads(self):
+        self.saturate(in_flight=app.config['ADMISSION_MAX_IN_FLIGHT_LOW'])
+        with app.test_client() as client:
+            self.assertEqual(client.get('/users').status_code, 200)
+            self.assertEqual(client.get('/users/search?q=John').status_code, 503)
+            self.assertEqual(client.post('/tags/new', data={'tag_name': 'New'}).status_code, 503)
+        self.assertEqual(app.extensions['admission'].in_flight, app.config['ADMISSION_MAX_IN_FLIGHT_LOW'])
+
+    def test_requests_are_shed_while_the_pool_is_slow(self):
+        self.saturate(wait=0.3)
+        with app.test_client() as client:
+            self.assertEqual(client.get('/users/1').status_code, 200)
+            self.assertEqual(client.post('/tags/new', data={'tag_name': 'New'}).status_code, 503)
+
+            # Nothing has waited since, so the estimate decays and writes get through again
+            app.extensions['admission'].measured -= 10 * app.config['ADMISSION_HALF_LIFE']
+            self.assertEqual(client.post('/tags/new', data={'tag_name': 'New'}).status_code, 302)
+
+    def test_pool_wait_times_the_connection_alone(self):
+        tracker = admission.Admission(app)
+        pool = SimpleNamespace(connect=lambda: time.sleep(0.05) or 'connection')
+        tracker.watch(pool)
+        tracker.watch(pool)
+        with app.test_request_context('/users'):
+            # Time spent on the request before its first query is not waiting for the pool
+            g.admission_start = time.perf_counter() - 5
+            self.assertEqual(pool.connect(), 'connection')
+            pool.connect()
+            # Not admitted by the app's own tracker, so it has nothing to release
+            del g.admission_start
+
+        self.assertGreaterEqual(tracker.wait, admission.SMOOTHING * 0.05)
+        self.assertLess(tracker.wait, admission.SMOOTHING * 1)
+
+    def test_pool_wait_leaves_out_new_connections(self):
+        tracker = admission.Admission(app)
+
+        def connect():
+            # What the pool's connect event says when it opens a connection
+            g.admission_opened = True
+            time.sleep(0.05)
+
+        pool = SimpleNamespace(connect=connect)
+        tracker.watch(pool)
+        with app.test_request_context('/users'):
+            g.admission_start = time.perf_counter()
+            pool.connect()
+            self.assertFalse(g.get('admission_waited'))
+            del g.admission_start
+
+        self.assertEqual(tracker.wait, 0.0)
+        if db.engine.dialect.name == 'postgresql':
+            options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+            self.assertLess(options['pool_size'] + options['max_overflow'], 8)
+
+    def test_requests_queued_too_long_are_shed(self):
+        with app.test_client() as client:
+            stale = f'{(time.time() - 60) * 1000:.0f}'
+            self.assertEqual(client.get('/users', headers={'X-Request-Start': stale}).status_code, 503)
+            fresh = f't={time.time():.3f}'
+            self.assertEqual(client.get('/users', headers={'X-Request-Start': fresh}).status_code, 200)
+        self.assertIsNone(admission.queue_time('garbage', time.time()))
+
+    def test_monitoring_is_never_shed(self):
+        self.saturate(in_flight=app.config['ADMISSION_MAX_IN_FLIGHT'], wait=60)
+        with app.test_client() as client:
+            self.assertEqual(client.get('/metrics').status_code, 200)
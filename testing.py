@@ -0,0 +1,219 @@
+"""Test harness for Blogly.
+
+DatabaseTestCase creates the schema once per test run instead of once per
+test. Each test runs inside a transaction on a single connection that is
+rolled back afterwards, and the app's session works inside a SAVEPOINT on that
+connection, so commits and rollbacks made by the routes stay within the test.
+Fixtures are declared on the class and inserted with one executemany per table.
+
+Run the suite across N processes with
+
+    python testing.py -j N [module]
+
+Every process gets its own database, named after TEST_DATABASE_URL with the
+worker number appended, which is created on start and dropped on exit. The
+same happens for each pytest-xdist worker.
+"""
+
+import argparse
+import atexit
+import os
+import subprocess
+import sys
+import unittest
+from unittest import TestCase
+
+from sqlalchemy import Integer, create_engine, event, func, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, scoped_session
+
+# Relationships raise rather than query unless a route eager-loads them, see
+# LAZY in models.py. Set here so every way of running the tests gets it.
+os.environ.setdefault('STRICT_LOADING', '1')
+
+from models import db
+
+DEFAULT_TEST_DATABASE_URL = 'postgresql:///bloglytest'
+
+_schema_ready = False
+
+
+def worker_id():
+    """Returns the id of this parallel test worker, or None when the tests run in a single process"""
+
+    return os.environ.get('BLOGLY_TEST_WORKER') or os.environ.get('PYTEST_XDIST_WORKER')
+
+
+def setup_test_database():
+    """Returns the database URL for this test process, creating a database of its own if it is a parallel worker"""
+
+    url = make_url(os.environ.get('TEST_DATABASE_URL', DEFAULT_TEST_DATABASE_URL))
+    worker = worker_id()
+    if worker is None:
+        return str(url)
+
+    if url.get_backend_name() == 'sqlite':
+        root, ext = os.path.splitext(url.database)
+        url.database = f'{root}_{worker}{ext}'
+        atexit.register(remove_file, url.database)
+        return str(url)
+
+    name = f'{url.database}_{worker}'
+    server = make_url(str(url))
+    server.database = 'postgres'
+    engine = create_engine(server, isolation_level='AUTOCOMMIT')
+    with engine.connect() as conn:
+        conn.execute(f'DROP DATABASE IF EXISTS "{name}"')
+        conn.execute(f'CREATE DATABASE "{name}"')
+    atexit.register(drop_database, engine, name)
+    url.database = name
+    return str(url)
+
+
+def drop_database(engine, name):
+    """Drops a worker's database once its own connections are closed"""
+
+    db.get_engine().dispose()
+    with engine.connect() as conn:
+        conn.execute(f'DROP DATABASE IF EXISTS "{name}"')
+    engine.dispose()
+
+
+def remove_file(path):
+    """Removes a worker's sqlite database"""
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def create_schema():
+    """Recreates the tables, once per test run"""
+
+    global _schema_ready
+    if _schema_ready:
+        return
+    if db.engine.dialect.name == 'sqlite':
+        use_sqlite_savepoints(db.engine)
+    db.drop_all()
+    db.create_all()
+    _schema_ready = True
+
+
+def use_sqlite_savepoints(engine):
+    """Makes pysqlite leave transactions to SQLAlchemy, which SAVEPOINT needs"""
+
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin_transaction(conn):
+        conn.execute('BEGIN')
+
+    engine.dispose()
+
+
+def reset_sequences(connection):
+    """Points each id sequence just past the highest id, as Postgres sequences ignore rollbacks"""
+
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in db.metadata.sorted_tables:
+        primary_key = list(table.primary_key.columns)
+        if len(primary_key) != 1 or not isinstance(primary_key[0].type, Integer):
+            continue
+        column = primary_key[0]
+        connection.execute(select([func.setval(
+            func.pg_get_serial_sequence(table.name, column.name),
+            select([func.coalesce(func.max(column), 0) + 1]).as_scalar(),
+            False)]))
+
+
+class DatabaseTestCase(TestCase):
+    """Runs each test in a transaction that is rolled back, with the class's fixtures loaded"""
+
+    # List of (model, rows) to insert before each test, in dependency order
+    fixtures = []
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        create_schema()
+
+    def setUp(self):
+        """Opens the test transaction, points the app's session at it and loads the fixtures"""
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.app_session = db.session
+        db.session = scoped_session(self.make_session)
+
+        for model, rows in self.fixtures:
+            self.connection.execute(model.__table__.insert(), rows)
+        reset_sequences(self.connection)
+
+    def tearDown(self):
+        """Throws away everything the test did"""
+
+        db.session.remove()
+        db.session = self.app_session
+        # Returning the connection to the pool rolls back self.transaction, doing it
+        # explicitly while the session's SAVEPOINT is still registered makes SQLAlchemy warn
+        self.connection.close()
+
+    def make_session(self):
+        """Makes a session that works inside a SAVEPOINT on the test connection"""
+
+        session = Session(bind=self.connection)
+        session.begin_nested()
+
+        @event.listens_for(session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        return session
+
+
+def run_worker(module, worker, workers):
+    """Runs every workers-th test of the module, starting at worker, returns whether they all passed"""
+
+    suite = unittest.defaultTestLoader.loadTestsFromName(module)
+    tests = []
+    pending = [suite]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, unittest.TestSuite):
+            pending.extend(reversed(list(item)))
+        else:
+            tests.append(item)
+    share = unittest.TestSuite(tests[worker::workers])
+    result = unittest.TextTestRunner(verbosity=1).run(share)
+    return result.wasSuccessful()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the Blogly tests across several processes')
+    parser.add_argument('module', nargs='?', default='test')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if worker_id() is not None:
+        sys.exit(0 if run_worker(args.module, int(worker_id()), args.jobs) else 1)
+
+    processes = []
+    for worker in range(args.jobs):
+        env = dict(os.environ, BLOGLY_TEST_WORKER=str(worker))
+        processes.append(subprocess.Popen([sys.executable, __file__, args.module, '-j', str(args.jobs)],
+                                          env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+    failed = 0
+    for worker, process in enumerate(processes):
+        output = process.communicate()[0].decode()
+        print(f'===== worker {worker} =====\n{output}')
+        failed += process.returncode != 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Post view counts for Blogly.
+
+Showing a post only adds to a counter in the worker's memory. A background
+thread writes the counts every VIEWS_FLUSH_INTERVAL seconds as one
+UPDATE post SET views = views + delta per viewed post, all in one transaction
+and in post id order, so a hot post costs one row lock per flush instead of
+one per view and flushes from different workers never deadlock. The thread is
+woken early once VIEWS_FLUSH_MAX_PENDING posts have pending views, and the
+counts are flushed when the process exits, so a worker that is killed loses at
+most VIEWS_FLUSH_INTERVAL seconds of views.
+
+With VIEWS_FLUSH_INTERVAL set to 0 no thread is started and counts stay
+pending until flush is called.
+"""
+
+import atexit
+from collections import Counter
+import threading
+
+from flask import current_app
+from background import ProcessThread
+from models import db, Post
+
+# Adds a batch of deltas, executed once per viewed post
+ADD_VIEWS = (Post.__table__.update()
+             .where(Post.id == db.bindparam('post_id'))
+             .values(views=Post.views + db.bindparam('delta')))
+
+
+class ViewCounter:
+    """Counts views in memory and adds them to post.views in batches"""
+
+    def __init__(self, app):
+        self.app = app
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = ProcessThread(self.run, 'view-counter')
+
+    def add(self, post_id):
+        """Counts a view of a post"""
+
+        with self.lock:
+            self.counts[post_id] += 1
+            full = len(self.counts) >= self.app.config['VIEWS_FLUSH_MAX_PENDING']
+        self.start()
+        if full:
+            self.wakeup.set()
+
+    def pending(self):
+        """Returns the number of views not yet written"""
+
+        with self.lock:
+            return sum(self.counts.values())
+
+    def start(self):
+        """Starts the flushing thread unless this process already has one, forked workers each start their own"""
+
+        if self.app.config['VIEWS_FLUSH_INTERVAL']:
+            self.thread.start()
+
+    def run(self):
+        """Flushes the counts every VIEWS_FLUSH_INTERVAL seconds, or sooner when woken"""
+
+        while True:
+            self.wakeup.wait(self.app.config['VIEWS_FLUSH_INTERVAL'])
+            self.wakeup.clear()
+            self.flush_in_context()
+
+    def flush(self):
+        """Writes the pending views to the database, returns how many posts were updated
+
+        If the write fails the views are put back to be retried by the next flush."""
+
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+        if not counts:
+            return 0
+        try:
+            db.session.execute(ADD_VIEWS, [{'post_id': post_id, 'delta': delta}
+                                           for post_id, delta in sorted(counts.items())])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self.lock:
+                self.counts.update(counts)
+            raise
+        return len(counts)
+
+    def flush_in_context(self):
+        """Flushes from outside a request, logging rather than raising errors"""
+
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            self.app.logger.exception('Could not write post views')
+
+
+def record_view(post_id):
+    """Counts a view of a post, it shows up in post.views after the next flush"""
+
+    if current_app.config['VIEWS_COUNTING']:
+        current_app.extensions['view_counter'].add(post_id)
+
+
+def most_viewed(limit=20):
+    """Returns the most viewed posts, most views first"""
+
+    return (Post.query
+            .order_by(Post.views.desc(), Post.id)
+            .limit(limit)
+            .all())
+
+
+def init_views(app):
+    """Sets up view counting for the app, flushing whatever is pending when the process exits"""
+
+    # Turned off when pages are rendered for something other than a reader, such as freeze.py
+    app.config.setdefault('VIEWS_COUNTING', True)
+    app.config.setdefault('VIEWS_FLUSH_INTERVAL', 5)
+    app.config.setdefault('VIEWS_FLUSH_MAX_PENDING', 10000)
+    counter = app.extensions['view_counter'] = ViewCounter(app)
+    atexit.register(counter.flush_in_context)
@@ -0,0 +1,11 @@
+"""Runs the Blogly background job worker."""
+
+import logging
+
+from app import app
+import jobs
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    with app.app_context():
+        jobs.work()